@@ -5,6 +5,7 @@ import random
 import time
 import json
 import threading
+import re
 from uuid import uuid4
 from flask import Flask, render_template, request, jsonify, session, redirect, url_for
 from packaging.version import Version
@@ -26,6 +27,140 @@ except Exception as e:
 # 用于存储后台任务的状态和结果
 tasks = {}
 
+# --- 镜像与 tiup 组件缓存 ---
+# 基础镜像只包含 tiup 和 playground，每个容器都要重新下载 tidb/tikv/pd/tiflash。
+# 这里把 ~/.tiup/components 放到一个共享的 docker volume 中：每个版本只下载一次 (串行预热)，
+# 之后的测试容器只读挂载该 volume，启动时不再访问网络。
+# 开启 BAKE_VERSION_IMAGES 时，还会用仓库里的 Dockerfile (TIDB_VERSION 构建参数) 为每个版本构建
+# 自带组件的镜像，构建失败时回退到共享 volume。
+PLAYGROUND_IMAGE = os.environ.get('PLAYGROUND_IMAGE', 'hub.pingcap.net/qa/tidb-playground:latest')
+TIUP_COMPONENTS_VOLUME = os.environ.get('TIUP_COMPONENTS_VOLUME', 'tidb-tester-tiup-components')
+TIUP_COMPONENTS_DIR = '/root/.tiup/components'
+TIUP_COMPONENTS_MODE = 'ro'  # 测试容器只读挂载，避免并发容器同时写入同一个组件目录
+BAKE_VERSION_IMAGES = os.environ.get('BAKE_VERSION_IMAGES', '0') == '1'
+BAKED_IMAGE_REPO = 'tidb-tester-playground'
+PLAYGROUND_COMPONENTS = ('tidb', 'tikv', 'pd', 'tiflash')
+DOCKERFILE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+prepared_versions = {}  # 版本 -> (镜像名, volumes)
+version_locks = {}
+version_locks_lock = threading.Lock()
+
+# --- 内存准入与 tmpfs 数据目录 ---
+# 测试容器用完即弃，可以把 playground 的数据目录挂载为大小受限的 tmpfs，避免大量容器同时启动时 fsync 打满磁盘。
+# 每个容器按拓扑估算进程内存和数据目录大小，在内存预算内登记后才启动；内存放不下数据目录时退回磁盘。
+# 容器停止 (清理环境) 后登记随之失效。
+RAM_DATA_DIRS = os.environ.get('RAM_DATA_DIRS', '0') == '1'  # 请求未指定 ram_data_dir 时的默认值
+CONTAINER_DATA_DIR = '/root/.tiup/data'
+CONTAINER_TOPOLOGY = {'tidb': 1, 'tikv': 3, 'pd': 1, 'tiflash': 1}  # 关闭拓扑推断时的固定拓扑
+COMPONENT_MEMORY_MB = {'tidb': 512, 'tikv': 1024, 'pd': 256, 'tiflash': 1024}  # 每个组件进程的常驻内存估算
+COMPONENT_DATA_MB = {'tidb': 32, 'tikv': 256, 'pd': 64, 'tiflash': 256}  # 每个组件的数据目录 (含 WAL、日志) 估算
+RAM_DATA_SIZE_FACTOR = 2  # tmpfs 大小上限为数据目录估算值的倍数
+RAM_DATA_HEADROOM_MB = 1024  # 使用 tmpfs 后宿主机 MemAvailable 至少保留的余量
+MEMORY_BUDGET_FRACTION = 0.8
+MEMORY_BUDGET_MB = int(os.environ.get('MEMORY_BUDGET_MB') or 0)  # 0 表示 MemTotal * MEMORY_BUDGET_FRACTION
+ADMISSION_TIMEOUT = 600  # 等待内存预算的最长时间 (秒)，超时后仍然启动
+memory_reservations = {}  # container id (启动前为临时 id) -> 登记的内存 (MB)
+memory_lock = threading.Lock()
+
+
+# --- 拓扑推断 ---
+# 默认根据测试 SQL 推断能复现问题的最小拓扑，代替固定的 --kv 3 --tiflash 1：TiFlash 启动最慢、最占内存，
+# 只有用到 TiFlash 时才启动；放置规则、多副本、store 相关的问题才需要多个 TiKV。
+# 规则与 tiup_without_docker/app.py 中的拓扑推断保持一致，修改时两边同步。
+AUTO_TOPOLOGY = os.environ.get('AUTO_TOPOLOGY', '1') == '1'  # 请求未指定 auto_topology 时的默认值
+MINIMAL_TOPOLOGY = {'tidb': 1, 'tikv': 1, 'pd': 1, 'tiflash': 0}
+# (组件, 最少数量, 正则, 原因)
+TOPOLOGY_RULES = [
+    ('tiflash', 1, re.compile(r'tiflash', re.IGNORECASE), '用到了 TiFlash (副本、引擎或 hint)'),
+    ('tiflash', 1, re.compile(r'(?<![a-z])mpp(?![a-z])', re.IGNORECASE), '用到了 MPP 执行'),
+    ('tikv', 3, re.compile(r'placement\s+policy|primary_region|survival_preferences|constraints\s*=',
+                           re.IGNORECASE), '用到了放置规则，默认 3 副本分布在不同 store 上'),
+    ('tikv', 3, re.compile(r'tikv_store_status|tikv_region_peers|scatter|transfer.?leader|store_id|max.replicas',
+                           re.IGNORECASE), '依赖多个 TiKV store 或多副本'),
+    ('tikv', 3, re.compile(r'(?:kill|stop|pause)\S*\s+.{0,40}tikv', re.IGNORECASE),
+     '检查脚本会停止 TiKV 节点，需要多副本继续服务'),
+    ('pd', 3, re.compile(r'(?:transfer|resign).{0,20}pd.{0,10}leader|pd.{0,10}leader.{0,20}(?:transfer|resign)',
+                         re.IGNORECASE), '需要切换 PD leader'),
+    ('tidb', 2, re.compile(r'ddl.?owner|resign.?owner', re.IGNORECASE), '需要在多个 TiDB 之间切换 DDL owner'),
+]
+PLACEMENT_PEERS_RE = re.compile(r'\b(followers|learners)\s*=\s*(\d+)', re.IGNORECASE)
+
+
+def infer_topology(sql):
+    """根据测试 SQL 推断最小拓扑，返回 (拓扑, 原因列表)"""
+    text = sql or ''
+    topology = dict(MINIMAL_TOPOLOGY)
+    reasons = []
+
+    def need(component, count, reason):
+        if topology[component] < count:
+            topology[component] = count
+        reasons.append(f"{component} ≥ {count}: {reason}")
+
+    for component, count, pattern, reason in TOPOLOGY_RULES:
+        match = pattern.search(text)
+        if match:
+            need(component, count, f"{reason} ({match.group(0).strip()[:40]})")
+    # 显式指定副本数时，每个 follower / learner 需要一个独立的 store；多个放置策略取各自的最大值
+    peers = {'followers': 0, 'learners': 0}
+    for kind, count in PLACEMENT_PEERS_RE.findall(text):
+        peers[kind.lower()] = max(peers[kind.lower()], int(count))
+    if peers['followers'] or peers['learners']:
+        need('tikv', 1 + peers['followers'] + peers['learners'],
+             f"放置规则要求 {peers['followers']} 个 follower、{peers['learners']} 个 learner")
+    if not reasons:
+        reasons.append('没有发现需要 TiFlash、多个 TiKV 或其他额外组件的特性，使用最小拓扑')
+    return topology, reasons
+
+
+def task_topology(data, task_id):
+    """按请求选择任务的拓扑并把选择原因写入日志"""
+    if data.get('auto_topology', AUTO_TOPOLOGY) in (False, 'false', '0', 0):
+        return dict(CONTAINER_TOPOLOGY)
+    topology, reasons = infer_topology(data.get('sql'))
+    tasks[task_id]['log'].append(f"自动选择拓扑 (TiDB {topology['tidb']} / TiKV {topology['tikv']} / "
+                                 f"PD {topology['pd']} / TiFlash {topology['tiflash']}): {'；'.join(reasons)}")
+    tasks[task_id]['topology_reasons'] = reasons
+    return topology
+
+
+# --- 启动耗时模型 ---
+# 按 (版本, 拓扑) 记录最近的容器启动耗时，等待 TiDB 就绪的上限取 p99 × 1.5：卡住的容器尽早失败，
+# 启动慢的拓扑也不会被过早判为超时。只用同版本同拓扑的样本：容器内第一次启动某个版本要先下载组件，
+# 借用其他版本的热启动耗时会被过早判为超时。样本不足时使用固定的默认上限。
+READY_POLL_INTERVAL = 2
+DEFAULT_READY_TIMEOUT = 240
+READY_TIMEOUT_MIN = 30
+READY_TIMEOUT_MAX = 1800
+BOOT_SAMPLES_MAX = 50
+BOOT_SAMPLES_MIN = 5
+boot_samples = {}  # (版本, 拓扑) -> 最近的启动耗时 (秒)
+boot_samples_lock = threading.Lock()
+
+
+class ReadyTimeout(Exception):
+    """TiDB 在等待上限内没有就绪；说明不了是否复现问题，不能记为失败"""
+
+
+def record_boot_seconds(version, topology, seconds):
+    key = (version, tuple(sorted(topology.items())))
+    with boot_samples_lock:
+        samples = boot_samples.setdefault(key, [])
+        samples.append(seconds)
+        del samples[:-BOOT_SAMPLES_MAX]
+
+
+def ready_timeout(version, topology):
+    """同版本同拓扑的样本不足时使用默认上限"""
+    with boot_samples_lock:
+        samples = list(boot_samples.get((version, tuple(sorted(topology.items()))), []))
+    if len(samples) < BOOT_SAMPLES_MIN:
+        return DEFAULT_READY_TIMEOUT
+    ordered = sorted(samples)
+    p99 = ordered[min(len(ordered) - 1, int(0.99 * len(ordered)))]
+    return min(READY_TIMEOUT_MAX, max(READY_TIMEOUT_MIN, p99 * 1.5))
+
 
 # --- 辅助函数 ---
 
@@ -58,6 +193,136 @@ def get_tidb_versions():
         return ["v7.1.0", "v7.0.0", "v6.5.0", "v6.1.0", "v5.4.0", "v4.0.8"]
 
 
+def _version_lock(version):
+    with version_locks_lock:
+        return version_locks.setdefault(version, threading.Lock())
+
+
+def warm_components_cache(version, task_id):
+    """在共享 volume 中安装指定版本的组件；已安装时 tiup install 直接返回"""
+    tasks[task_id]['log'].append(f"版本 {version}: 正在预热共享的 tiup 组件缓存...")
+    components = [f"{c}:{version}" for c in PLAYGROUND_COMPONENTS]
+    docker_client.containers.run(
+        PLAYGROUND_IMAGE,
+        ["install"] + components,
+        entrypoint=["tiup"],
+        volumes={TIUP_COMPONENTS_VOLUME: {'bind': TIUP_COMPONENTS_DIR, 'mode': 'rw'}},
+        remove=True
+    )
+
+
+def build_version_image(version, task_id):
+    """用仓库中的 Dockerfile 构建自带该版本组件的镜像，已存在时直接复用"""
+    tag = f"{BAKED_IMAGE_REPO}:{version}"
+    try:
+        docker_client.images.get(tag)
+        return tag
+    except docker.errors.ImageNotFound:
+        pass
+    tasks[task_id]['log'].append(f"版本 {version}: 正在构建预置组件的镜像 {tag} (只需一次)...")
+    # 与版本无关的层 (系统依赖、tiup、playground) 在各版本之间共享构建缓存
+    docker_client.images.build(path=DOCKERFILE_DIR, dockerfile='Dockerfile', tag=tag,
+                               buildargs={'TIDB_VERSION': version}, rm=True)
+    return tag
+
+
+def prepare_version(version, task_id):
+    """返回启动该版本容器使用的 (镜像名, volumes)；同一版本的准备工作只做一次"""
+    with _version_lock(version):
+        if version in prepared_versions:
+            return prepared_versions[version]
+        prepared = None
+        if BAKE_VERSION_IMAGES:
+            try:
+                prepared = (build_version_image(version, task_id), {})
+            except (docker.errors.BuildError, docker.errors.APIError) as e:
+                tasks[task_id]['log'].append(f"版本 {version}: 构建镜像失败，改用共享组件缓存: {e}")
+        if prepared is None:
+            warm_components_cache(version, task_id)
+            prepared = (PLAYGROUND_IMAGE,
+                        {TIUP_COMPONENTS_VOLUME: {'bind': TIUP_COMPONENTS_DIR, 'mode': TIUP_COMPONENTS_MODE}})
+        prepared_versions[version] = prepared
+        return prepared
+
+
+def _meminfo_mb(field):
+    """读取宿主机 /proc/meminfo 中的字段 (MB)，读取失败返回 None"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def memory_budget_mb():
+    if MEMORY_BUDGET_MB:
+        return MEMORY_BUDGET_MB
+    total = _meminfo_mb('MemTotal')
+    return int(total * MEMORY_BUDGET_FRACTION) if total else None
+
+
+def _prune_reservations():
+    """去掉已经停止 (被自动删除) 的容器的登记"""
+    with memory_lock:
+        ids = [i for i in memory_reservations if not i.startswith('pending-')]
+    for container_id in ids:
+        try:
+            docker_client.containers.get(container_id)
+        except docker.errors.NotFound:
+            with memory_lock:
+                memory_reservations.pop(container_id, None)
+        except docker.errors.APIError:
+            pass
+
+
+def admit_container(version, task_id, ram_data_dir, topology):
+    """
+    启动容器前的内存准入，返回 (登记 id, tmpfs 挂载参数)。tmpfs 参数为 None 时数据目录在容器的磁盘层上。
+    预算不足时等待其他容器停止，最多等待 ADMISSION_TIMEOUT 秒。
+    """
+    process_mb = sum(COMPONENT_MEMORY_MB[c] * n for c, n in topology.items())
+    data_mb = sum(COMPONENT_DATA_MB[c] * n for c, n in topology.items())
+    reservation = f"pending-{uuid4().hex}"
+    deadline = time.time() + ADMISSION_TIMEOUT
+    waiting = False
+    while True:
+        _prune_reservations()
+        budget = memory_budget_mb()
+        available = _meminfo_mb('MemAvailable')
+        with memory_lock:
+            reserved = sum(memory_reservations.values())
+            # 没有其他登记时总是放行，避免单个容器永远无法启动
+            room = budget - reserved if budget and memory_reservations else float('inf')
+            if ram_data_dir and available is not None and available - process_mb - data_mb >= RAM_DATA_HEADROOM_MB \
+                    and process_mb + data_mb <= room:
+                memory_reservations[reservation] = process_mb + data_mb
+                tasks[task_id]['log'].append(f"版本 {version}: 数据目录挂载为 tmpfs (上限 "
+                                             f"{data_mb * RAM_DATA_SIZE_FACTOR} MB)。")
+                return reservation, {CONTAINER_DATA_DIR: f'size={data_mb * RAM_DATA_SIZE_FACTOR}m'}
+            if process_mb <= room or time.time() > deadline:
+                memory_reservations[reservation] = process_mb
+                if ram_data_dir:
+                    tasks[task_id]['log'].append(f"版本 {version}: 可用内存或内存预算不足以再容纳约 {data_mb} MB "
+                                                 f"的数据目录，数据目录使用磁盘。")
+                return reservation, None
+        if not waiting:
+            waiting = True
+            tasks[task_id]['log'].append(f"版本 {version}: 容器内存预算不足 (已登记 {reserved} MB，预算 {budget} MB)，"
+                                         f"等待其他容器停止 (可点击清理环境)...")
+        time.sleep(2)
+
+
+def bind_reservation(reservation, container_id):
+    """容器启动后把登记转到容器 id 上，容器停止后由 _prune_reservations 释放"""
+    with memory_lock:
+        memory_mb = memory_reservations.pop(reservation, None)
+        if memory_mb is not None and container_id:
+            memory_reservations[container_id] = memory_mb
+
+
 def find_free_port():
     """查找一个未被占用的端口"""
     return random.randint(10000, 20000)
@@ -108,28 +373,42 @@ def test_single_version(version, sql, expected_result, task_id, index):
 
     container = None
     result_data = {}
+    reservation = None
     try:
-        image_name = f'hub.pingcap.net/qa/tidb-playground:latest'
+        image_name, volumes = prepare_version(version, task_id)
+        topology = tasks[task_id].get('topology', CONTAINER_TOPOLOGY)
+        reservation, tmpfs = admit_container(version, task_id, tasks[task_id].get('ram_data_dir', RAM_DATA_DIRS),
+                                             topology)
         container = docker_client.containers.run(
             image_name,
-            ["--db.host", "0.0.0.0", "--db.config", "/root/.tiup/config.toml", f"{version}", "--without-monitor", "--kv", "3", "--tiflash", "1"],
+            ["--db.host", "0.0.0.0", "--db.config", "/root/.tiup/config.toml", f"{version}", "--without-monitor",
+             "--db", str(topology['tidb']), "--kv", str(topology['tikv']), "--pd", str(topology['pd']),
+             "--tiflash", str(topology['tiflash'])],
             detach=True,
             ports={'4000/tcp': sql_port, '2379/tcp': dashboard_port},
+            volumes=volumes,
+            tmpfs=tmpfs or {},
             remove=True  # 设置 docker 在容器停止时自动删除
         )
+        bind_reservation(reservation, container.id)
 
         log_message = f"版本 {version}: 容器 {container.short_id} 已启动，等待 TiDB 服务就绪..."
         tasks[task_id]['log'].append(log_message)
         print(log_message)
 
+        # 组件已在本地，集群通常几秒内就绪，缩短轮询间隔；等待上限由历史启动耗时推断
         ready = False
-        for _ in range(24):
-            time.sleep(10)
+        started = time.time()
+        timeout = ready_timeout(version, topology)
+        tasks[task_id]['log'].append(f"版本 {version}: 启动等待上限 {timeout:.0f} 秒。")
+        while time.time() - started < timeout:
+            time.sleep(READY_POLL_INTERVAL)
             try:
                 conn = mysql.connector.connect(host='127.0.0.1', port=sql_port, user='root', password='',
                                                connection_timeout=5)
                 conn.close()
                 ready = True
+                record_boot_seconds(version, topology, time.time() - started)
                 log_message = f"版本 {version}: TiDB 服务在端口 {sql_port} 上已就绪。"
                 tasks[task_id]['log'].append(log_message)
                 print(log_message)
@@ -138,7 +417,7 @@ def test_single_version(version, sql, expected_result, task_id, index):
                 continue
 
         if not ready:
-            raise Exception("TiDB 服务启动超时")
+            raise ReadyTimeout(f"TiDB 服务启动超时 ({timeout:.0f} 秒)")
 
         actual_result, success = run_sql_on_tidb(sql, sql_port)
 
@@ -154,10 +433,15 @@ def test_single_version(version, sql, expected_result, task_id, index):
             'dashboard_port': dashboard_port,
             'expected': expected_result,
             'actual': actual_result,
+            'data_dir_medium': 'tmpfs' if tmpfs else 'disk',
+            'topology': topology,
         }
 
+    except ReadyTimeout as e:
+        tasks[task_id]['log'].append(f"版本 {version}: {e}，无法判断是否复现。")
+        result_data = {'version': version, 'status': '超时', 'error': str(e)}
     except docker.errors.ImageNotFound as e:
-        error_msg = f"Docker image tidb-playground:latest 不存在。"
+        error_msg = f"Docker image {PLAYGROUND_IMAGE} 不存在。"
         tasks[task_id]['log'].append(f"版本 {version}: {error_msg}")
         result_data = {'version': version, 'status': '失败', 'error': error_msg}
     except Exception as e:
@@ -167,6 +451,8 @@ def test_single_version(version, sql, expected_result, task_id, index):
     finally:
         if container:
             result_data['container_id'] = container.id
+        elif reservation:
+            bind_reservation(reservation, None)  # 容器没有启动，释放登记
         tasks[task_id]['results'][index] = result_data
 
 
@@ -175,12 +461,12 @@ def test_single_version(version, sql, expected_result, task_id, index):
 @app.route('/')
 def index():
     versions = get_tidb_versions()
-    return render_template('index.html', versions=versions)
+    return render_template('index.html', versions=versions, auto_topology=AUTO_TOPOLOGY)
 
 
 @app.route('/locate')
 def locate():
-    return render_template('locate.html')
+    return render_template('locate.html', auto_topology=AUTO_TOPOLOGY)
 
 
 @app.route('/start_test', methods=['POST'])
@@ -196,8 +482,10 @@ def start_test():
         'status': 'running',
         'log': [],
         'results': [{} for _ in selected_versions],
-        'type': 'test'
+        'type': 'test',
+        'ram_data_dir': bool(data.get('ram_data_dir', RAM_DATA_DIRS))
     }
+    tasks[task_id]['topology'] = task_topology(data, task_id)
 
     # 在主请求线程中，将 task_id 与当前用户的 session 关联
     session.setdefault('task_ids', []).append(task_id)
@@ -242,8 +530,10 @@ def start_locate():
         'status': 'running',
         'log': [],
         'results': [],
-        'type': 'locate'
+        'type': 'locate',
+        'ram_data_dir': bool(data.get('ram_data_dir', RAM_DATA_DIRS))
     }
+    tasks[task_id]['topology'] = task_topology(data, task_id)
 
     # 【重要】在这里同样需要将 task_id 与当前用户的 session 关联
     session.setdefault('task_ids', []).append(task_id)
@@ -256,8 +546,17 @@ def start_locate():
     return jsonify({'task_id': task_id})
 
 
+def _nearest_unskipped(mid, low, high, skipped):
+    """从 mid 开始向两侧交替寻找最近的未被跳过的位置，找不到返回 None"""
+    for distance in range(0, high - low + 1):
+        for idx in (mid + distance, mid - distance):
+            if low <= idx <= high and idx not in skipped:
+                return idx
+    return None
+
+
 def run_binary_search(start_v_str, end_v_str, sql, expected, task_id):
-    """二分查找逻辑 (最终修正版)"""
+    """二分查找逻辑 (最终修正版)；容器启动超时的版本无法判断是否复现，改为测试相邻版本"""
     all_versions = get_tidb_versions()
 
     def binary_search_logic(start_version, end_version):
@@ -272,9 +571,13 @@ def run_binary_search(start_v_str, end_v_str, sql, expected, task_id):
 
         low, high = 0, len(search_space) - 1
         first_bad_version = None
+        skipped = set()
 
         while low <= high:
-            mid_idx = (low + high) // 2
+            mid_idx = _nearest_unskipped((low + high) // 2, low, high, skipped)
+            if mid_idx is None:
+                tasks[task_id]['log'].append(f"⚠️ 剩余的 {high - low + 1} 个版本均启动超时，无法继续缩小范围。")
+                break
             version_to_test = search_space[mid_idx]
 
             # 【修复】获取下一个可用的索引号
@@ -293,11 +596,19 @@ def run_binary_search(start_v_str, end_v_str, sql, expected, task_id):
                 high = mid_idx - 1
             elif result_data.get('status') == '成功':
                 low = mid_idx + 1
+            elif result_data.get('status') == '超时':
+                tasks[task_id]['log'].append(f"⏭️ 版本 {version_to_test} 的容器启动超时，改为测试相邻版本。")
+                skipped.add(mid_idx)
             else:
                 tasks[task_id]['log'].append(f"版本 {version_to_test} 测试时发生环境错误，定位中止。")
                 tasks[task_id]['status'] = 'error'
                 return None
 
+        if first_bad_version:
+            uncertain = [search_space[i] for i in sorted(skipped)
+                         if low <= i < search_space.index(first_bad_version)]
+            if uncertain:
+                tasks[task_id]['log'].append(f"⚠️ 以下版本启动超时未能测试，问题也可能由它们引入: {', '.join(uncertain)}")
         return first_bad_version
 
     # --- 主逻辑 ---
@@ -362,6 +673,8 @@ def clean_env():
                     container = docker_client.containers.get(c_id)
                     container.stop(timeout=10)
                     cleaned_ids.append(container.short_id)
+                    with memory_lock:
+                        memory_reservations.pop(c_id, None)
                 except docker.errors.NotFound:
                     pass
                 except Exception as e:
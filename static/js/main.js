@@ -96,6 +96,8 @@ document.addEventListener('DOMContentLoaded', function() {
             const versions = Array.from(selectedOptions).map(el => el.value);
             const sql = document.getElementById('sql-query').value;
             const expected = document.getElementById('expected-result').value;
+            const ram_data_dir = document.getElementById('ram-data-dir').checked;
+            const auto_topology = document.getElementById('auto-topology').checked;
 
             if (versions.length === 0) {
                 alert('请至少选择一个 TiDB 版本');
@@ -108,7 +110,7 @@ document.addEventListener('DOMContentLoaded', function() {
             const response = await fetch('/start_test', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ versions, sql, expected })
+                body: JSON.stringify({ versions, sql, expected, ram_data_dir, auto_topology })
             });
 
             const data = await response.json();
@@ -155,6 +157,8 @@ document.addEventListener('DOMContentLoaded', function() {
             const start_version = document.getElementById('start-version').value;
             const sql = document.getElementById('sql-query').value;
             const expected = document.getElementById('expected-result').value;
+            const ram_data_dir = document.getElementById('ram-data-dir').checked;
+            const auto_topology = document.getElementById('auto-topology').checked;
 
             if (!bug_version) {
                 alert('请填写“Bug 上报版本”');
@@ -167,7 +171,8 @@ document.addEventListener('DOMContentLoaded', function() {
             const response = await fetch('/start_locate', {
                 method: 'POST',
                 headers: { 'Content-Type': 'application/json' },
-                body: JSON.stringify({ bug_version, start_version, sql, expected_result: expected })
+                body: JSON.stringify({ bug_version, start_version, sql, expected_result: expected, ram_data_dir,
+                                       auto_topology })
             });
 
             const data = await response.json();
@@ -0,0 +1,44 @@
+import importlib.util
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+NATIVE_DIR = os.path.join(ROOT, 'tiup_without_docker')
+
+
+def _load(name, path, work_dir):
+    """两个后端的模块都叫 app，按文件路径以不同的模块名导入；导入时读取的缓存文件放在临时目录中"""
+    cwd = os.getcwd()
+    os.chdir(work_dir)
+    try:
+        spec = importlib.util.spec_from_file_location(name, path)
+        module = importlib.util.module_from_spec(spec)
+        sys.modules[name] = module
+        spec.loader.exec_module(module)
+    finally:
+        os.chdir(cwd)
+    return module
+
+
+@pytest.fixture(scope='session')
+def native_app(tmp_path_factory):
+    """tiup_without_docker/app.py (本机 tiup playground 后端)"""
+    sys.path.insert(0, NATIVE_DIR)
+    return _load('native_app', os.path.join(NATIVE_DIR, 'app.py'), tmp_path_factory.mktemp('native'))
+
+
+@pytest.fixture(scope='session')
+def docker_app(tmp_path_factory):
+    """仓库根目录的 app.py (Docker 后端)；连不上 Docker 时 docker_client 为 None，不影响纯逻辑函数"""
+    return _load('docker_app', os.path.join(ROOT, 'app.py'), tmp_path_factory.mktemp('docker'))
+
+
+@pytest.fixture
+def task_id(native_app):
+    """在 native_app.tasks 中登记一个运行中的任务，测试结束后删除"""
+    task_id = 'test-task'
+    native_app.tasks[task_id] = {'status': 'running', 'log': [], 'results': [], 'probe_options': {}}
+    yield task_id
+    native_app.tasks.pop(task_id, None)
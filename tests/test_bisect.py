@@ -0,0 +1,109 @@
+import pytest
+
+COMMITS = [f"{i:040x}" for i in range(1, 41)]
+
+
+def make_probe(bad_index, statuses=None):
+    """bad_index 之前的 commit 返回 Success，之后返回 Failure；statuses 覆盖指定 commit 的结果"""
+    probed = []
+
+    def probe(commit):
+        probed.append(commit)
+        if statuses and commit in statuses:
+            return statuses[commit]
+        return 'Failure' if COMMITS.index(commit) >= bad_index else 'Success'
+    return probe, probed
+
+
+@pytest.mark.parametrize('ways', [None, lambda: 1, lambda: 3, lambda: 8])
+def test_bisect_finds_first_bad_commit(native_app, task_id, ways):
+    for bad in (0, 1, 17, 39):
+        probe, _ = make_probe(bad)
+        first_bad, culprits = native_app.bisect_commits(COMMITS, probe, task_id, ways=ways)
+        assert first_bad == COMMITS[bad]
+        assert culprits == [COMMITS[bad]]
+
+
+def test_bisect_without_bad_commit(native_app, task_id):
+    probe, _ = make_probe(len(COMMITS))
+    assert native_app.bisect_commits(COMMITS, probe, task_id) == (None, [])
+
+
+@pytest.mark.parametrize('ways', [None, lambda: 4])
+def test_bisect_skips_report_culprit_range(native_app, task_id, ways):
+    # 问题由 commit 20 引入，但 18、19 无法编译：三者都可能是引入问题的 commit
+    skipped = {COMMITS[18]: 'Skip', COMMITS[19]: 'Skip'}
+    probe, probed = make_probe(20, skipped)
+    first_bad, culprits = native_app.bisect_commits(COMMITS, probe, task_id, ways=ways)
+    assert first_bad == COMMITS[20]
+    assert culprits == [COMMITS[18], COMMITS[19], COMMITS[20]]
+    assert len(probed) == len(set(probed))
+
+
+def test_bisect_skip_away_from_boundary_is_not_a_culprit(native_app, task_id):
+    probe, _ = make_probe(30, {COMMITS[5]: 'Skip', COMMITS[19]: 'Skip'})
+    first_bad, culprits = native_app.bisect_commits(COMMITS, probe, task_id)
+    assert first_bad == COMMITS[30]
+    assert culprits == [COMMITS[30]]
+
+
+def test_bisect_stops_when_everything_left_is_skipped(native_app, task_id):
+    probe, _ = make_probe(0, {c: 'Skip' for c in COMMITS})
+    assert native_app.bisect_commits(COMMITS, probe, task_id) == (None, [])
+    assert any('无法继续缩小范围' in line for line in native_app.tasks[task_id]['log'])
+
+
+def test_bisect_maps_inconclusive_and_timeout(native_app, task_id):
+    # Inconclusive 视为 Skip；Timeout 默认视为复现
+    probe, _ = make_probe(10, {COMMITS[9]: 'Inconclusive', COMMITS[10]: 'Timeout'})
+    first_bad, culprits = native_app.bisect_commits(COMMITS, probe, task_id)
+    assert first_bad == COMMITS[10]
+    assert culprits == [COMMITS[9], COMMITS[10]]
+
+    native_app.tasks[task_id]['probe_options']['timeout_is_bad'] = False
+    probe, _ = make_probe(11, {COMMITS[10]: 'Timeout'})
+    first_bad, culprits = native_app.bisect_commits(COMMITS, probe, task_id)
+    assert first_bad == COMMITS[11]
+    assert culprits == [COMMITS[10], COMMITS[11]]
+
+
+def test_bisect_aborts_on_environment_error(native_app, task_id):
+    probe, _ = make_probe(10, {c: 'Error' for c in COMMITS})
+    assert native_app.bisect_commits(COMMITS, probe, task_id) == (None, None)
+    assert native_app.tasks[task_id]['status'] == 'error'
+
+
+def test_bisect_points_are_spread_and_unskipped(native_app):
+    assert native_app._bisect_points(0, 39, 1, set()) == [19]
+    points = native_app._bisect_points(0, 39, 3, {10})
+    assert len(points) == 3 and 10 not in points and points == sorted(points)
+    assert native_app._bisect_points(0, 1, 4, {0, 1}) == []
+
+
+def test_docker_bisection_tests_neighbour_of_timed_out_version(docker_app, monkeypatch):
+    versions = ['v7.1.0', 'v7.5.0', 'v8.0.0', 'v8.1.0', 'v8.2.0', 'v8.3.0', 'v8.4.0', 'v8.5.0']
+    timed_out = {'v8.1.0'}
+    tested = []
+
+    def fake_test(version, sql, expected, task_id, index):
+        tested.append(version)
+        if version in timed_out:
+            status = '超时'
+        else:
+            status = '失败' if docker_app.Version(version) >= docker_app.Version('v8.1.0') else '成功'
+        docker_app.tasks[task_id]['results'][index] = {'version': version, 'status': status}
+
+    monkeypatch.setattr(docker_app, 'get_tidb_versions', lambda: versions)
+    monkeypatch.setattr(docker_app, 'test_single_version', fake_test)
+    monkeypatch.setattr(docker_app.time, 'sleep', lambda seconds: None)
+    docker_app.tasks['docker-task'] = {'status': 'running', 'log': [], 'results': []}
+    try:
+        docker_app.run_binary_search('v7.1.0', 'v8.5.0', 'select 1', '1', 'docker-task')
+        task = docker_app.tasks['docker-task']
+        assert task['status'] == 'complete'
+        # v8.1.0 启动超时无法判断，定位到下一个出错的版本并把 v8.1.0 列为可能的来源
+        assert task['final_result'].endswith('v8.2.0')
+        assert any('v8.1.0' in line and '问题也可能由它们引入' in line for line in task['log'])
+        assert tested.count('v8.1.0') == 1
+    finally:
+        docker_app.tasks.pop('docker-task', None)
@@ -0,0 +1,71 @@
+import pytest
+
+
+@pytest.mark.parametrize('text', [
+    "(1, 'a')",
+    "(1, 'a'), (2, 'b')",
+    "(1, '(,)'), (2, 'it''s')",
+    "(1, \"a\\\"b\"),(2, `c`)",
+    "((1)), (2)",
+])
+def test_is_values_list(native_app, text):
+    assert native_app.is_values_list(text)
+
+
+@pytest.mark.parametrize('text', [
+    "(1) ON DUPLICATE KEY UPDATE a = 1",
+    "(1) AS new",
+    "(1),",
+    "(1) (2)",
+    "(1, 'a'",
+    "(1, 'a)",
+    "(1))",
+])
+def test_is_not_values_list(native_app, text):
+    assert not native_app.is_values_list(text)
+
+
+def test_consecutive_inserts_into_same_table_are_merged(native_app):
+    statements = [
+        "INSERT INTO t VALUES (1, 'a')",
+        "insert into t values (2, 'b'), (3, 'c')",
+        "INSERT INTO t VALUES (4, 'd')",
+    ]
+    assert native_app.batch_insert_statements(statements) == [
+        "INSERT INTO t VALUES (1, 'a'),(2, 'b'), (3, 'c'),(4, 'd')"]
+
+
+def test_merge_stops_at_other_tables_and_statements(native_app):
+    statements = [
+        "INSERT INTO t VALUES (1)",
+        "INSERT INTO t (a) VALUES (2)",
+        "INSERT INTO t (a) VALUES (3)",
+        "UPDATE t SET a = a + 1",
+        "INSERT INTO t VALUES (4)",
+        "INSERT INTO s VALUES (5)",
+    ]
+    assert native_app.batch_insert_statements(statements) == [
+        "INSERT INTO t VALUES (1)",
+        "INSERT INTO t (a) VALUES (2),(3)",
+        "UPDATE t SET a = a + 1",
+        "INSERT INTO t VALUES (4)",
+        "INSERT INTO s VALUES (5)",
+    ]
+
+
+def test_inserts_with_extra_clauses_are_kept_as_is(native_app):
+    statements = [
+        "INSERT INTO t VALUES (1)",
+        "INSERT INTO t VALUES (1) ON DUPLICATE KEY UPDATE a = 2",
+        "INSERT INTO t VALUES (3)",
+    ]
+    assert native_app.batch_insert_statements(statements) == statements
+
+
+def test_merged_insert_respects_size_limit(native_app, monkeypatch):
+    monkeypatch.setattr(native_app, 'FIXTURE_BATCH_BYTES', 20)
+    statements = [f"INSERT INTO t VALUES ({i}, 'xx')" for i in range(5)]
+    batched = native_app.batch_insert_statements(statements)
+    assert len(batched) > 1
+    assert ''.join(batched).count("'xx'") == 5
+    assert all(len(s.split(' VALUES ', 1)[1]) <= 20 for s in batched)
@@ -0,0 +1,65 @@
+import math
+
+import pytest
+
+
+def test_single_reproduction_is_bad_without_false_alarms(native_app):
+    sprt = native_app.SequentialProbabilityRatioTest(repro_rate=0.3, confidence=0.95, max_repeats=20)
+    assert sprt.add(False) is None
+    assert sprt.add(True) == 'bad'
+    assert sprt.status() == 'Failure'
+    assert sprt.summary()['llr'] == 'inf'
+
+
+def test_good_verdict_after_expected_number_of_passes(native_app):
+    sprt = native_app.SequentialProbabilityRatioTest(repro_rate=0.3, confidence=0.95, max_repeats=100)
+    # 约 ln(β/(1-α)) / ln(1-repro_rate) 次未复现后判定为 good
+    expected = math.ceil(math.log(0.05 / 0.95) / math.log(0.7))
+    decisions = [sprt.add(False) for _ in range(expected)]
+    assert decisions[:-1] == [None] * (expected - 1)
+    assert decisions[-1] == 'good'
+    assert sprt.status() == 'Success'
+
+
+def test_inconclusive_at_max_repeats(native_app):
+    sprt = native_app.SequentialProbabilityRatioTest(repro_rate=0.3, confidence=0.95, max_repeats=3)
+    assert [sprt.add(False) for _ in range(3)] == [None, None, 'inconclusive']
+    assert sprt.status() == 'Inconclusive'
+    assert sprt.summary()['trials'] == 3
+
+
+def test_false_alarms_need_more_evidence(native_app):
+    sprt = native_app.SequentialProbabilityRatioTest(repro_rate=0.5, false_alarm_rate=0.1, confidence=0.95,
+                                                     max_repeats=50)
+    assert sprt.add(True) is None
+    decision = None
+    while decision is None:
+        decision = sprt.add(True)
+    assert decision == 'bad'
+    assert sprt.failures == sprt.trials > 1
+
+
+def test_certain_reproduction_passes_once(native_app):
+    sprt = native_app.SequentialProbabilityRatioTest(repro_rate=1.0, confidence=0.95, max_repeats=20)
+    assert sprt.add(False) == 'good'
+
+
+def test_parse_flaky_options(native_app):
+    assert native_app.parse_flaky_options({}) is None
+    assert native_app.parse_flaky_options({'flaky': 'false'}) is None
+    options = native_app.parse_flaky_options({'flaky': True, 'flaky_repro_rate': '0.4'})
+    assert options['repro_rate'] == 0.4
+    assert options['false_alarm_rate'] == 0
+    native_app.SequentialProbabilityRatioTest(**options)
+
+
+@pytest.mark.parametrize('data', [
+    {'flaky_repro_rate': 'x'},
+    {'flaky_repro_rate': 2},
+    {'flaky_repro_rate': 0.2, 'flaky_false_alarm_rate': 0.3},
+    {'flaky_confidence': 0.4},
+    {'flaky_max_repeats': -1},
+])
+def test_parse_flaky_options_rejects_invalid(native_app, data):
+    with pytest.raises(ValueError):
+        native_app.parse_flaky_options(dict(data, flaky=True))
@@ -0,0 +1,62 @@
+import pytest
+
+SAMPLES = [
+    'select 1',
+    'create table t (a int); insert into t values (1)',
+    'alter table t set tiflash replica 1',
+    'select /*+ read_from_storage(tiflash[t]) */ * from t',
+    'set tidb_allow_mpp = 1; select count(*) from t',
+    'create placement policy p1 primary_region="r1" regions="r1,r2"',
+    'create placement policy p2 followers=4',
+    'create placement policy p3 followers=2 learners=1',
+    'select * from information_schema.tikv_region_peers',
+    'split table t between (0) and (100) regions 10; -- scatter',
+    'admin resign ddl owner',
+    'pd-ctl member leader transfer pd-1',
+    'select * from t where note = "compact"',
+]
+
+
+def test_minimal_topology_for_plain_sql(native_app):
+    topology, reasons = native_app.infer_topology(['select 1', None])
+    assert topology == native_app.MINIMAL_TOPOLOGY
+    assert len(reasons) == 1
+
+
+@pytest.mark.parametrize('sql, component, count', [
+    ('alter table t set tiflash replica 1', 'tiflash', 1),
+    ('set tidb_allow_mpp = 1', 'tiflash', 1),
+    ('create placement policy p primary_region="r1"', 'tikv', 3),
+    ('create placement policy p followers=4', 'tikv', 5),
+    ('admin resign ddl owner', 'tidb', 2),
+])
+def test_rules_raise_component_count(native_app, sql, component, count):
+    topology, _ = native_app.infer_topology([sql])
+    assert topology[component] == count
+
+
+def test_mpp_inside_word_does_not_need_tiflash(native_app):
+    topology, _ = native_app.infer_topology(['select * from mppx'])
+    assert topology['tiflash'] == 0
+
+
+def test_check_script_and_log_checks_count(native_app):
+    topology, _ = native_app.infer_topology(['select 1', 'kill -9 $(pgrep tikv-server | head -1)'])
+    assert topology['tikv'] == 3
+    log_checks = native_app.parse_log_checks('forbidden@tiflash: panic')
+    topology, _ = native_app.infer_topology(['select 1'], log_checks)
+    assert topology['tiflash'] == 1
+
+
+def test_rule_tables_are_identical(native_app, docker_app):
+    def rules(module):
+        return [(c, n, p.pattern, p.flags, r) for c, n, p, r in module.TOPOLOGY_RULES]
+    assert rules(docker_app) == rules(native_app)
+    assert docker_app.MINIMAL_TOPOLOGY == native_app.MINIMAL_TOPOLOGY
+    assert docker_app.PLACEMENT_PEERS_RE.pattern == native_app.PLACEMENT_PEERS_RE.pattern
+
+
+@pytest.mark.parametrize('sql', SAMPLES)
+def test_backends_infer_the_same_topology(native_app, docker_app, sql):
+    # Docker 后端只根据测试 SQL 推断，结果必须与本机后端对同一条 SQL 的推断一致
+    assert docker_app.infer_topology(sql) == native_app.infer_topology([sql])
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+"""
+分布式 worker agent：在另一台编译 / 测试机器上运行，向 app.py (coordinator) 注册后轮询领取探测任务。
+
+每个探测在本机完成 "编译 commit (如有) -> 启动集群 -> 执行 SQL / 检查脚本 -> 停止集群"，
+复用 app.py 中的探测逻辑，日志和结果通过 HTTP 回传给 coordinator。
+
+用法:
+  python agent.py --coordinator http://tester:5000 --capacity 2 --repo /root/git/tidb
+"""
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+
+class Agent:
+    def __init__(self, coordinator, name, capacity, repo):
+        self.coordinator = coordinator.rstrip('/')
+        self.name = name
+        self.capacity = capacity
+        self.repo = repo
+        self.agent_id = None
+        self.poll_interval = 2
+        self.running = {}  # job_id -> 线程
+        self.free_slots = list(range(capacity))
+        self.lock = threading.Lock()
+        self.git_lock = threading.Lock()
+
+    def post(self, path, payload, retries=3):
+        for attempt in range(retries):
+            try:
+                response = requests.post(f"{self.coordinator}{path}", json=payload, timeout=10)
+                if response.status_code == 404:
+                    return None
+                response.raise_for_status()
+                return response.json()
+            except requests.RequestException as e:
+                print(f"⚠️ 请求 {path} 失败 ({attempt + 1}/{retries}): {e}")
+                time.sleep(min(2 ** attempt, 10))
+        return None
+
+    def register(self):
+        while True:
+            data = self.post('/agents/register', {'name': self.name, 'capacity': self.capacity})
+            if data:
+                self.agent_id = data['agent_id']
+                self.poll_interval = data.get('poll_interval', self.poll_interval)
+                print(f"✅ 已注册到 {self.coordinator}，agent_id={self.agent_id}，并发容量 {self.capacity}。")
+                return
+            time.sleep(5)
+
+    def prepare_worktree(self, slot, commit):
+        """每个并发槽位一个独立的 worktree，避免并行编译时互相 checkout"""
+        path = os.path.join(tester.TIDB_WORKTREE_BASE, f'slot-{slot}')
+        # 同一仓库上的 git fetch / worktree add 会争用锁文件，串行执行
+        with self.git_lock:
+            # coordinator 上能看到的 commit 本地可能还没有，先 fetch 一次
+            if tester.subprocess.run(["git", "cat-file", "-e", f"{commit}^{{commit}}"], cwd=self.repo,
+                                     stdout=tester.subprocess.DEVNULL, stderr=tester.subprocess.DEVNULL).returncode:
+                tester.run_command(["git", "fetch", "origin"], work_dir=self.repo)
+            if not os.path.isdir(path):
+                os.makedirs(tester.TIDB_WORKTREE_BASE, exist_ok=True)
+                tester.run_command(["git", "worktree", "add", "-f", "--detach", path, commit], work_dir=self.repo)
+        return path
+
+    def fetch_fixtures(self, fixtures):
+        """下载本机还没有的 fixture 文件 (按内容哈希保存，可跨任务复用)"""
+        for fixture in fixtures:
+            path = tester.fixture_path(fixture['sha256'], fixture['format'])
+            if os.path.exists(path):
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            response = requests.get(f"{self.coordinator}/fixtures/{fixture['sha256']}.{fixture['format']}", timeout=600)
+            response.raise_for_status()
+            # 多个槽位可能同时下载同一个 fixture，每个线程使用独立的临时文件
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(response.content)
+            os.replace(tmp_path, path)
+
+    def run_job(self, job, slot):
+        job_id = job['job_id']
+        tester.tasks[job_id] = {'status': 'running', 'log': tester.TaskLog(job_id), 'results': [{}], 'processes': [],
+                                'type': 'agent', 'probe_options': job.get('probe_options', {}),
+                                'topology': job['topology']}
+        task = tester.tasks[job_id]
+        stop_streaming = threading.Event()
+        streamer = threading.Thread(target=self.stream_log, args=(job_id, stop_streaming), daemon=True)
+        streamer.start()
+        version, commit = job['version'], job.get('commit') or ''
+        try:
+            self.fetch_fixtures(job.get('probe_options', {}).get('fixtures') or [])
+            binary_path = None
+            if commit:
+                repo_path = self.prepare_worktree(slot, commit)
+                binary_path = tester.build_commit_or_skip(commit, job_id, version, repo_path)
+                if binary_path is None:
+                    task['results'][0] = {'version': f"{version}-{commit}", 'status': 'Skip',
+                                          'error': '编译失败，已跳过'}
+            if not commit or binary_path:
+                tester.test_single_version(version, job['sql'], job['expected_sql_result'],
+                                           job['other_check_script'], job_id, 0, cleanup_after=True,
+                                           commit=commit, binary_path=binary_path, cases=job.get('cases'))
+        except tester.TaskCancelled:
+            task['results'][0] = {'version': version, 'status': 'Cancelled'}
+        except Exception as e:
+            # agent 本机的问题 (fetch / worktree / fixture 下载失败等) 与被测版本无关，
+            # 报告为 Skip 让二分查找换一个相邻的点，而不是以 Error 终止整个任务
+            task['log'].append(f"❌ agent 执行探测时发生错误，本次探测记为 Skip: {e}\n{traceback.format_exc()}")
+            task['results'][0] = {'version': version, 'status': 'Skip', 'error': f"agent 执行探测失败: {e}"}
+        finally:
+            stop_streaming.set()
+            streamer.join()
+            # 回传失败时结果被丢弃：本探测随后不再出现在心跳的 running 中，coordinator 会把它重新排队
+            self.post(f'/agents/{self.agent_id}/jobs/{job_id}/result', {'result': task['results'][0]}, retries=5)
+            tester.tasks.pop(job_id, None)
+            with self.lock:
+                self.running.pop(job_id, None)
+                self.free_slots.append(slot)
+
+    def stream_log(self, job_id, stop):
+        sent = 0
+        while True:
+            stopped = stop.wait(1)
+            events, _ = tester.tasks[job_id]['log'].since(sent)
+            if events:
+                sent = events[-1]['seq'] + 1
+                self.post(f'/agents/{self.agent_id}/jobs/{job_id}/log', {'events': events}, retries=1)
+            if stopped:
+                return
+
+    def cancel(self, job_id):
+        if job_id not in tester.tasks:
+            return
+        print(f"🛑 coordinator 取消了探测 {job_id}。")
+        tester.cancel_event(job_id).set()
+        tester.stop_task_processes(job_id)
+
+    def serve(self):
+        self.register()
+        while True:
+            with self.lock:
+                free = len(self.free_slots)
+                running = list(self.running)
+            data = self.post(f'/agents/{self.agent_id}/poll', {'free_slots': free, 'running': running}, retries=1)
+            if data is None:
+                # coordinator 重启或认为本 agent 已超时，重新注册
+                print("⚠️ coordinator 不认识本 agent，重新注册...")
+                self.register()
+                continue
+            for job_id in data.get('cancel', []):
+                self.cancel(job_id)
+            for job in data.get('jobs', []):
+                with self.lock:
+                    slot = self.free_slots.pop(0)
+                    thread = threading.Thread(target=self.run_job, args=(job, slot), daemon=True)
+                    self.running[job['job_id']] = thread
+                print(f"📥 领取探测 {job['version']} {job.get('commit', '')[:7]} (槽位 {slot})。")
+                thread.start()
+            time.sleep(self.poll_interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='tiupAutoTest 分布式 worker agent')
+    parser.add_argument('--coordinator', required=True, help='coordinator 地址，如 http://tester:5000')
+    parser.add_argument('--name', default=socket.gethostname())
+    parser.add_argument('--capacity', type=int, default=1, help='本机同时执行的探测数')
+    parser.add_argument('--work-dir', default=os.path.dirname(os.path.abspath(__file__)),
+                        help='cache/、worktree 等文件所在目录')
+    parser.add_argument('--repo', default=None, help='本机 TiDB 仓库路径，默认使用 app.py 中的 TIDB_REPO_PATH')
+    args = parser.parse_args()
+
+    global tester
+    os.chdir(args.work_dir)
+    import app as tester
+    if args.repo:
+        tester.TIDB_REPO_PATH = args.repo
+    tester.TIDB_WORKTREE_BASE = os.path.join(os.path.abspath(args.work_dir), 'worktrees')
+    Agent(args.coordinator, args.name, max(1, args.capacity), tester.TIDB_REPO_PATH).serve()
+
+
+if __name__ == '__main__':
+    main()
@@ -4,32 +4,362 @@ import random
 import time
 import threading
 from uuid import uuid4
-from flask import Flask, render_template, request, jsonify, session, send_from_directory
+from flask import Flask, render_template, request, jsonify, session, send_from_directory, Response
 from packaging.version import Version
 import mysql.connector
+from prometheus_client import Counter, Gauge, Histogram, generate_latest, CONTENT_TYPE_LATEST
 import sys
 import stat
 import ast
 import shutil
-from functools import wraps
+import fnmatch
+import json
+import inspect
+import hashlib
+import math
+import signal
+import socket
+import re
+import csv
+import gzip
+import mmap
+import asyncio
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeout
+from itertools import zip_longest
+from functools import wraps, partial
+from contextlib import contextmanager
+
+
+# --- 监控指标 ---
+# 耗时以分钟计的阶段 (编译、集群启动) 使用更大的桶
+LONG_BUCKETS = (5, 15, 30, 60, 120, 180, 300, 600, 900, 1800, 3600)
+SHORT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900)
+
+COMPILE_SECONDS = Histogram('tidb_locator_compile_seconds', 'compile_at_commit 每次尝试的耗时',
+                            ['version', 'go_version'], buckets=LONG_BUCKETS)
+CLUSTER_READY_SECONDS = Histogram('tidb_locator_cluster_ready_seconds', '从启动 playground 到 TiDB 可连接的耗时',
+                                  ['version', 'topology'], buckets=LONG_BUCKETS)
+SQL_SECONDS = Histogram('tidb_locator_sql_seconds', '用户 SQL 的执行耗时',
+                        ['version', 'topology'], buckets=SHORT_BUCKETS)
+CHECK_SCRIPT_SECONDS = Histogram('tidb_locator_check_script_seconds', 'run_other_check 的执行耗时',
+                                 ['version', 'topology'], buckets=SHORT_BUCKETS)
+GIT_SECONDS = Histogram('tidb_locator_git_seconds', 'git 命令的执行耗时', ['operation'], buckets=SHORT_BUCKETS)
+FIXTURE_LOAD_BYTES = Counter('tidb_locator_fixture_load_bytes_total', '按导入方式统计的 fixture 导入字节数',
+                             ['method'])
+PROBE_TRIALS = Histogram('tidb_locator_probe_trials', '不稳定问题模式下每次探测的检查次数',
+                         buckets=(1, 2, 3, 5, 8, 13, 20, 30, 50))
+RETRIES_TOTAL = Counter('tidb_locator_retries_total', '按步骤和失败类型统计的重试次数', ['step', 'failure_class'])
+STARTUP_FAILURES_TOTAL = Counter('tidb_locator_startup_failures_total', '集群启动失败次数',
+                                 ['version', 'topology'])
+LIVE_CLUSTERS = Gauge('tidb_locator_live_clusters', '存活的 playground 集群数')
+QUEUED_PROBES = Gauge('tidb_locator_queued_probes', '已分配结果槽位但尚未出结果的探测数')
+RUNNING_TASKS = Gauge('tidb_locator_running_tasks', '运行中的任务数')
+
+
+def topology_label(counts):
+    return f"{counts['tidb']}db-{counts['tikv']}kv-{counts['pd']}pd-{counts['tiflash']}tiflash"
+
+
+# --- 任务阶段追踪 ---
+# 每个任务记录各阶段 (worktree、checkout、编译、集群启动、SQL、检查、清理) 的 span，
+# 可通过 /trace/<task_id> 以 Chrome trace-event 格式导出，在 Perfetto 中查看。
+# 探测协程共用一个事件循环线程，用 lane 把每个探测的 span 放到 trace 中单独的轨道上
+trace_lane = contextvars.ContextVar('trace_lane', default=None)
+log_phase = contextvars.ContextVar('log_phase', default=None)  # 最内层 trace_span 的名字，作为日志事件的阶段
+
+
+def begin_span(task_id, name, **attrs):
+    if not task_id or task_id not in tasks:
+        return None
+    thread = threading.current_thread()
+    lane = trace_lane.get()
+    return {'task_id': task_id, 'name': name, 'start': time.time(), 'end': None,
+            'tid': lane or thread.ident, 'thread': lane or thread.name, 'attrs': attrs}
+
+
+def end_span(span, **attrs):
+    """结束 span 并保存到任务上；重复调用或 span 为 None 时忽略"""
+    if not span or span['end'] is not None:
+        return
+    span['end'] = time.time()
+    span['attrs'].update(attrs)
+    tasks[span['task_id']].setdefault('trace', []).append(span)
 
 
-def retry(max_retries=3, delay=5):
+@contextmanager
+def trace_span(task_id, name, **attrs):
+    span = begin_span(task_id, name, **attrs)
+    phase_token = log_phase.set(name)
+    try:
+        yield span
+    except Exception as e:
+        end_span(span, error=str(e))
+        raise
+    finally:
+        log_phase.reset(phase_token)
+        end_span(span)
+
+
+def to_chrome_trace(task):
+    """把任务的 span 转换为 Chrome trace-event JSON"""
+    events, tids = [], {}
+    for span in sorted(task.get('trace', []), key=lambda s: s['start']):
+        if span['tid'] not in tids:
+            tids[span['tid']] = len(tids) + 1
+            events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tids[span['tid']],
+                           'args': {'name': span['thread']}})
+        events.append({
+            'name': span['name'], 'cat': 'probe', 'ph': 'X', 'pid': 1, 'tid': tids[span['tid']],
+            'ts': int(span['start'] * 1e6), 'dur': int((span['end'] - span['start']) * 1e6),
+            'args': {k: str(v) for k, v in span['attrs'].items()},
+        })
+    return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+
+# --- 任务日志 ---
+# 每条日志是一个结构化事件 {'seq', 'time', 'level', 'phase', 'probe', 'message'}：阶段取自当前的 trace_span，
+# probe 取自 trace lane，级别由消息开头的图标推断。内存中每个任务只保留最近 TASK_LOG_BUFFER 条，
+# 更早的事件按批追加到 logs/tasks/<task_id>.jsonl.gz；/status 按序号增量返回，/logs/<task_id> 返回完整日志。
+# 写文件由单独的 task_log_writer 线程完成：append 也在探测事件循环上调用，不能等待 gzip 和磁盘 I/O。
+TASK_LOG_BUFFER = 2000
+TASK_LOG_SPILL_BATCH = 200
+TASK_LOG_DIR = os.path.join('logs', 'tasks')
+BUILD_LOG_INTERVAL = 2  # 编译等命令的输出最多每隔这么多秒合并写入一条任务日志
+BUILD_LOG_MAX_LINES = 20  # 每条合并的输出最多保留的行数 (保留最后的行)
+LOG_LEVELS = ('debug', 'info', 'warning', 'error')
+LOG_LEVEL_MARKERS = (('❌', 'error'), ('⚠️', 'warning'), ('🛑', 'warning'), ('⏱️', 'warning'))
+task_log_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix='task-log-writer')  # 按提交顺序写入
+
+
+def log_level(message):
+    text = message.lstrip()
+    for marker, level in LOG_LEVEL_MARKERS:
+        if text.startswith(marker):
+            return level
+    return 'info'
+
+
+class TaskLog:
+    """
+    任务日志。append / extend 与 list 相同，写入的字符串记录为结构化事件；
+    len() 为写入过的总条数，迭代和下标只访问仍在内存中的消息。
+    """
+
+    def __init__(self, task_id):
+        self.spill_path = os.path.join(TASK_LOG_DIR, f"{task_id}.jsonl.gz")
+        self.events = deque()
+        self.pending_spill = []  # 已移出内存窗口、尚未交给写入线程的事件
+        self.writing = []  # 已交给写入线程、尚未写完的批次
+        self.spilled = 0
+        self.total = 0
+        self.lock = threading.Lock()
+        self.file_lock = threading.Lock()  # 写入线程写文件和 all_events 读文件互斥，不阻塞 append
+
+    def append(self, message, level=None, phase=None, probe=None, at=None):
+        message = str(message)
+        event = {'seq': None, 'time': at or time.time(), 'level': level or log_level(message),
+                 'phase': phase or log_phase.get(), 'probe': probe or trace_lane.get(), 'message': message}
+        with self.lock:
+            event['seq'] = self.total
+            self.total += 1
+            self.events.append(event)
+            while len(self.events) > TASK_LOG_BUFFER:
+                self.pending_spill.append(self.events.popleft())
+            if len(self.pending_spill) >= TASK_LOG_SPILL_BATCH:
+                batch, self.pending_spill = self.pending_spill, []
+                self.writing.append(batch)
+                task_log_writer.submit(self._spill, batch)
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def _spill(self, batch):
+        """在写入线程中执行，不持有 self.lock；gzip 追加写入新的 member，读取时按一个连续的流解压"""
+        with self.file_lock:
+            try:
+                os.makedirs(TASK_LOG_DIR, exist_ok=True)
+                with gzip.open(self.spill_path, 'at', encoding='utf-8') as f:
+                    f.writelines(json.dumps(e, ensure_ascii=False) + '\n' for e in batch)
+            except OSError as e:
+                # 写入失败 (如磁盘已满) 时事件留在内存中，下一批溢出时重试
+                print(f"⚠️ 写入任务日志 {self.spill_path} 失败: {e}")
+                with self.lock:
+                    self.writing = [b for b in self.writing if b is not batch]
+                    self.pending_spill = batch + self.pending_spill
+                return
+            with self.lock:
+                self.writing = [b for b in self.writing if b is not batch]
+                self.spilled += len(batch)
+
+    def _kept(self):
+        """调用方需持有 self.lock：还没有写入文件的全部事件，按序号排列"""
+        kept = [e for batch in self.writing for e in batch] + self.pending_spill + list(self.events)
+        return sorted(kept, key=lambda e: e['seq'])
+
+    def since(self, seq):
+        """返回内存中序号不小于 seq 的事件，以及 seq 之后是否有事件只能从溢出文件中读取"""
+        with self.lock:
+            kept = self._kept()
+        first = kept[0]['seq'] if kept else self.total
+        return [e for e in kept if e['seq'] >= seq], seq < first
+
+    def all_events(self):
+        """包括溢出文件在内的全部事件"""
+        with self.file_lock:
+            with self.lock:
+                kept = self._kept()
+                spilled = self.spilled
+            events = []
+            if spilled:
+                with gzip.open(self.spill_path, 'rt', encoding='utf-8') as f:
+                    events = [json.loads(line) for line in f]
+        return sorted(events + kept, key=lambda e: e['seq'])
+
+    def __len__(self):
+        return self.total
+
+    def __iter__(self):
+        with self.lock:
+            messages = [e['message'] for e in self.events]
+        return iter(messages)
+
+    def __getitem__(self, index):
+        with self.lock:
+            messages = [e['message'] for e in self.events]
+        return messages[index]
+
+
+def parse_log_filter(raw):
+    return [v.strip() for v in (raw or '').split(',') if v.strip()]
+
+
+def filter_log_events(events, levels=None, phases=None, probe=None):
+    """levels / phases 为空时不过滤；probe 按子串匹配"""
+    return [e for e in events if (not levels or e['level'] in levels) and (not phases or e['phase'] in phases)
+            and (not probe or probe in (e['probe'] or ''))]
+
+
+class ThrottledOutput:
+    """把命令输出合并后写入任务日志：最多每 BUILD_LOG_INTERVAL 秒一条，每条只保留最后几行"""
+
+    def __init__(self, task_id):
+        self.log = tasks[task_id]['log'] if task_id in tasks else None
+        self.lines = []
+        self.dropped = 0
+        self.flushed_at = time.time()
+
+    def write(self, line):
+        if self.log is None:
+            return
+        self.lines.append(line.rstrip('\n'))
+        if len(self.lines) > BUILD_LOG_MAX_LINES:
+            self.dropped += len(self.lines) - BUILD_LOG_MAX_LINES
+            del self.lines[:-BUILD_LOG_MAX_LINES]
+        if time.time() - self.flushed_at >= BUILD_LOG_INTERVAL:
+            self.flush()
+
+    def flush(self):
+        if self.log is not None and self.lines:
+            header = [f"... (省略 {self.dropped} 行输出)"] if self.dropped else []
+            self.log.append("\n".join(header + self.lines), level='debug')
+        self.lines, self.dropped, self.flushed_at = [], 0, time.time()
+
+
+# 失败分类：瞬时错误 (网络、OOM、锁竞争) 值得退避重试；确定性错误 (编译错误、缺少目标) 重试也不会成功
+TRANSIENT_FAILURE_PATTERNS = [
+    'dial tcp', 'i/o timeout', 'connection reset', 'connection refused', 'tls handshake timeout',
+    'temporary failure in name resolution', 'could not resolve host', 'unexpected eof', 'early eof',
+    'proxy.golang.org', 'sum.golang.org', 'unable to access', 'remote end hung up',
+    'signal: killed', 'cannot allocate memory', 'out of memory', 'killed',
+    'index.lock', 'unable to create', 'resource temporarily unavailable', 'text file busy',
+    'address already in use', '启动超时',
+]
+DETERMINISTIC_FAILURE_PATTERNS = [
+    'undefined:', 'cannot use', 'syntax error', 'declared and not used', 'imported and not used',
+    'redeclared in this block', 'not enough arguments', 'too many arguments', 'missing return',
+    'no rule to make target', 'no targets specified', 'go.mod requires go', 'build constraints exclude',
+    'is not in goroot', 'invalid reference', 'did not match any file', 'unknown revision',
+    'cannot find version', 'unknown version', 'not supported by current platform', '未找到',
+]
+
+
+def classify_failure(error):
+    """把失败 (异常或 None) 归类为 'transient' / 'deterministic' / 'unknown'"""
+    if error is None:
+        return 'unknown'
+    returncode = getattr(error, 'returncode', None)
+    text = f"{error}\n{getattr(error, 'output', '') or ''}".lower()
+    # 先看确定性错误：OOM 杀掉的编译也可能打印出编译错误之外的内容，但编译错误本身不会因重试而消失
+    if any(p in text for p in DETERMINISTIC_FAILURE_PATTERNS):
+        return 'deterministic'
+    if returncode in (-9, 137) or any(p in text for p in TRANSIENT_FAILURE_PATTERNS):
+        return 'transient'
+    return 'unknown'
+
+
+def compute_backoff(attempt, delay, max_delay=60, jitter=0.5):
+    """指数退避 + 随机抖动，避免多个任务同时重试"""
+    base = min(max_delay, delay * (2 ** (attempt - 1)))
+    return base * (1 + random.uniform(-jitter, jitter))
+
+
+def record_retry(task_id, step, failure_class):
+    """在任务结果中累计每个步骤、每类失败的重试次数"""
+    RETRIES_TOTAL.labels(step, failure_class).inc()
+    if not task_id or task_id not in tasks:
+        return
+    stats = tasks[task_id].setdefault('retry_stats', {}).setdefault(step, {})
+    stats[failure_class] = stats.get(failure_class, 0) + 1
+    tasks[task_id]['last_failure'] = {'step': step, 'class': failure_class}
+
+
+class TaskCancelled(Exception):
+    """任务被用户通过 /cancel 取消"""
+
+
+def cancel_event(task_id):
+    return tasks[task_id].setdefault('cancel_event', threading.Event())
+
+
+def is_cancelled(task_id):
+    return bool(task_id) and task_id in tasks and cancel_event(task_id).is_set()
+
+
+def check_cancelled(task_id):
+    """在各阶段边界调用：任务已取消时抛出 TaskCancelled"""
+    if is_cancelled(task_id):
+        raise TaskCancelled(f"任务 {task_id} 已取消")
+
+
+def sleep_or_cancel(task_id, seconds):
+    """可被取消打断的 sleep"""
+    if task_id and task_id in tasks:
+        if cancel_event(task_id).wait(seconds):
+            raise TaskCancelled(f"任务 {task_id} 已取消")
+    else:
+        time.sleep(seconds)
+
+
+def retry(max_retries=3, delay=5, max_delay=60, task_id_arg='task_id'):
     """
     一个装饰器，用于在函数失败时自动重试。
     失败的条件是：函数抛出任何异常，或者函数返回 None。
+    失败会先经过 classify_failure 分类：确定性错误立即放弃，其余按指数退避 (带抖动) 重试。
+    task_id 通过被装饰函数的 task_id_arg 参数显式获取，用于记录日志和重试统计。
     """
 
     def decorator(func):
+        signature = inspect.signature(func)
+
         @wraps(func)
         def wrapper(*args, **kwargs):
-            # 尝试从参数中智能地获取 task_id 用于日志记录
-            task_id = kwargs.get('task_id')
-            if not task_id:
-                for arg in args:
-                    if isinstance(arg, str) and len(arg) > 30:  # 根据 uuid 的特征猜测 task_id
-                        task_id = arg
-                        break
+            try:
+                task_id = signature.bind_partial(*args, **kwargs).arguments.get(task_id_arg)
+            except TypeError:
+                task_id = None
 
             last_exception = None
             for attempt in range(1, max_retries + 1):
@@ -39,24 +369,36 @@ def retry(max_retries=3, delay=5):
                     if result is not None:
                         return result
 
+                    last_exception = Exception("函数返回 None")
+                    failure_class = classify_failure(None)
                     log_msg = f"⚠️ 函数 {func.__name__} 第 {attempt}/{max_retries} 次尝试失败，结果为 None。"
-                    if attempt == max_retries:  # 最后一次尝试失败
-                        last_exception = Exception("函数返回 None")
-
+                except TaskCancelled:
+                    raise
                 except Exception as e:
+                    # 任务被取消导致的失败 (如 make 进程组被杀) 不应再重试
+                    check_cancelled(task_id)
                     last_exception = e
-                    log_msg = f"❌ 函数 {func.__name__} 第 {attempt}/{max_retries} 次尝试失败，发生异常: {e}"
+                    failure_class = classify_failure(e)
+                    log_msg = f"❌ 函数 {func.__name__} 第 {attempt}/{max_retries} 次尝试失败 ({failure_class})，发生异常: {e}"
 
                 # 记录日志
                 print(log_msg)
+                record_retry(task_id, func.__name__, failure_class)
                 if task_id and task_id in tasks:
                     tasks[task_id]['log'].append(log_msg)
 
+                if failure_class == 'deterministic':
+                    log_msg = f"⛔ 函数 {func.__name__} 遇到确定性错误，不再重试。"
+                    print(log_msg)
+                    if task_id and task_id in tasks:
+                        tasks[task_id]['log'].append(log_msg)
+                    break
+
                 if attempt < max_retries:
-                    time.sleep(delay)
+                    sleep_or_cancel(task_id, compute_backoff(attempt, delay, max_delay))
 
             # 所有重试均告失败
-            final_log_msg = f"❌ 函数 {func.__name__} 在 {max_retries} 次尝试后彻底失败。最后一次错误: {last_exception}"
+            final_log_msg = f"❌ 函数 {func.__name__} 在 {attempt} 次尝试后彻底失败。最后一次错误: {last_exception}"
             print(final_log_msg)
             if task_id and task_id in tasks:
                 tasks[task_id]['log'].append(final_log_msg)
@@ -98,6 +440,7 @@ TIDB_GO_VERSION_MAP = {
 }
 DEFAULT_GO_VERSION = "1.25.1"
 
+# 默认拓扑；每个任务 (矩阵模式下每个探测) 使用自己的组件数量，保存在 tasks[task_id]['topology']
 COMPONENT_COUNTS = {
     'tidb': 1,
     'tikv': 1,
@@ -105,6 +448,10 @@ COMPONENT_COUNTS = {
     'tiflash': 0
 }
 
+
+def task_topology(task_id):
+    return tasks[task_id].get('topology') or COMPONENT_COUNTS
+
 # --- 配置 ---
 app = Flask(__name__)
 app.secret_key = 'a_very_secret_key_for_tidb_tester_tiup'
@@ -117,14 +464,20 @@ TIDB_REPO_PATH = '/root/git/tidb'
 # 为并发任务创建隔离工作区的基准目录
 # **重要**: 确保此目录存在且 Flask 应用有权读写
 TIDB_WORKTREE_BASE = '/tmp/tidb_worktrees'
+PROCESS_OUTPUT_LINE_LIMIT = 16 * 1024 * 1024  # 命令输出单行的最大长度 (asyncio StreamReader 的 limit)
 
 
 # --- commit 二分查找函数 --
-def run_command(command, work_dir=".", shell=False, check=True, print_output=False, go_version=None):
+def run_command(command, work_dir=".", shell=False, check=True, print_output=False, go_version=None, task_id=None,
+                isolation=None):
     """
     一个通用的命令执行函数，实时打印输出。
     新增 go_version 参数以支持无状态的版本切换。
+    传入 task_id 时进程会登记到任务上，任务取消时整个进程组会被杀掉。
+    传入 isolation (assign_isolation 的返回值) 时命令在独占的 CPU / cgroup 中执行。
+    进程在探测事件循环上启动和等待 (_run_process)，调用线程只等待结果，因此不能在探测事件循环线程上调用。
     """
+    check_cancelled(task_id)
     print(f"🚀 在 '{work_dir}' 中执行: {' '.join(command) if isinstance(command, list) else command}")
 
     custom_env = os.environ.copy()
@@ -175,33 +528,20 @@ def run_command(command, work_dir=".", shell=False, check=True, print_output=Fal
             raise RuntimeError(f"为 Go {go_version} 设置环境失败") from e
 
     use_shell = isinstance(command, str) and shell
+    started = time.time()
     try:
-        process = subprocess.Popen(
-            command if use_shell else command_list,
-            cwd=work_dir,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.STDOUT,
-            stdin=subprocess.DEVNULL,
-            text=True,
-            shell=use_shell,
-            env=custom_env,  # 使用我们手动创建的环境
-            preexec_fn=os.setsid if sys.platform != "win32" else None
-        )
+        returncode, full_output = run_on_probe_loop(_run_process(
+            command if use_shell else isolated_command(isolation, command_list), work_dir,
+            custom_env,  # 使用我们手动创建的环境
+            use_shell, print_output, task_id)).result()
 
-        output_lines, full_output = [], ""
-        if print_output:
-            for line in iter(process.stdout.readline, ''):
-                sys.stdout.write(line)
-                output_lines.append(line)
-            full_output = "".join(output_lines)
+        if command_list[0] == 'git' and len(command_list) > 1:
+            GIT_SECONDS.labels(command_list[1]).observe(time.time() - started)
 
-        process.wait()
+        check_cancelled(task_id)
 
-        if not print_output:
-            full_output = process.stdout.read()
-
-        if check and process.returncode != 0:
-            raise subprocess.CalledProcessError(process.returncode, command, output=full_output)
+        if check and returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, output=full_output)
 
         return full_output
     except FileNotFoundError:
@@ -215,6 +555,37 @@ def run_command(command, work_dir=".", shell=False, check=True, print_output=Fal
         raise
 
 
+async def _run_process(command, work_dir, env, use_shell, print_output, task_id):
+    """
+    在探测事件循环上以新的进程组启动命令并读取合并后的 stdout / stderr，返回 (返回码, 输出)。
+    传入 task_id 时进程登记到任务的 commands 中，任务取消时由 stop_task_processes 杀掉整个进程组。
+    """
+    spawn_args = (command,) if use_shell else tuple(command)
+    spawn = asyncio.create_subprocess_shell if use_shell else asyncio.create_subprocess_exec
+    process = await spawn(*spawn_args, cwd=work_dir, env=env, stdout=asyncio.subprocess.PIPE,
+                          stderr=asyncio.subprocess.STDOUT, stdin=asyncio.subprocess.DEVNULL,
+                          start_new_session=True, limit=PROCESS_OUTPUT_LINE_LIMIT)
+    if task_id:
+        tasks[task_id].setdefault('commands', []).append(process)
+    output_lines = []
+    # 同时合并写入任务日志 (编译输出很多，按时间节流)
+    task_output = ThrottledOutput(task_id) if print_output else None
+    try:
+        while line := await process.stdout.readline():
+            line = line.decode('utf-8', errors='replace')
+            output_lines.append(line)
+            if task_output:
+                sys.stdout.write(line)
+                task_output.write(line)
+        await process.wait()
+    finally:
+        if task_output:
+            task_output.flush()
+        if task_id:
+            tasks[task_id]['commands'].remove(process)
+    return process.returncode, "".join(output_lines)
+
+
 def get_commit_list(start_tag, end_tag, task_id, repo_path):
     """获取两个 tag 之间的 commit SHA 列表，在指定的 repo_path 中操作"""
     tasks[task_id]['log'].append(f"\nℹ️ 准备在隔离环境 '{repo_path}' 中切换到与 tag '{end_tag}' 相关的 release 分支...")
@@ -222,11 +593,11 @@ def get_commit_list(start_tag, end_tag, task_id, repo_path):
         version_parts = end_tag.lstrip('v').split('.')
         branch_version = f"{version_parts[0]}.{version_parts[1]}"
         branch_name = f"release-{branch_version}"
-        run_command(["git", "checkout", "-f", branch_name], work_dir=repo_path)
+        run_command(["git", "checkout", "-f", branch_name], work_dir=repo_path, task_id=task_id)
         tasks[task_id]['log'].append(f"✅ 成功切换到分支: {branch_name}")
 
         tasks[task_id]['log'].append(f"🔄 正在更新仓库代码...")
-        run_command(["git", "pull"], work_dir=repo_path, print_output=True)
+        run_command(["git", "pull"], work_dir=repo_path, print_output=True, task_id=task_id)
         tasks[task_id]['log'].append(f"✅ 仓库代码已更新。")
     except IndexError:
         tasks[task_id]['log'].append(f"⚠️ 警告: 无法从 tag '{end_tag}' 推断出 release 分支名。")
@@ -245,41 +616,307 @@ def get_commit_list(start_tag, end_tag, task_id, repo_path):
         tasks[task_id]['log'].append(f"❌ 获取 commits 列表失败: {e}")
         return None
 
+
+# 只修改这些路径的 commit 不会影响 tidb-server 二进制，二分时视为与父 commit 等价
+IRRELEVANT_PATH_PATTERNS = [
+    '*.md', 'docs/*', '.github/*', 'OWNERS', 'OWNERS_ALIASES', 'LICENSE', '.gitignore', '.codecov.yml',
+    '*_test.go', '*/testdata/*', 'tests/*', 'cmd/*/tests/*', 'tools/check/*',
+    '*.bazel', '*.bzl', 'WORKSPACE', '.bazelrc', '.bazelversion',
+]
+# commit -> 修改的文件列表，在所有任务之间共享
+COMMIT_PATHS_CACHE = {}
+commit_paths_lock = threading.Lock()
+# 每次 git log 最多传入的 commit 数；大版本范围有上万个 commit，一次全部传入会超过 ARG_MAX
+GIT_LOG_BATCH = 1000
+
+
+def parse_path_filters(raw):
+    """把用户输入的路径过滤 (逗号或换行分隔的字符串，或列表) 解析为 glob 列表"""
+    if not raw:
+        return []
+    if isinstance(raw, str):
+        raw = raw.replace(',', '\n').splitlines()
+    return [p.strip() for p in raw if p and p.strip()]
+
+
+def _match_any(path, patterns):
+    # 目录形式的过滤 (如 "pkg/planner/") 同时匹配该目录下的所有文件
+    for pattern in patterns:
+        if fnmatch.fnmatch(path, pattern) or path.startswith(pattern.rstrip('*').rstrip('/') + '/'):
+            return True
+    return False
+
+
+def get_changed_paths(commits, repo_path):
+    """
+    批量获取 commits 修改的文件列表 (相对父 commit)，结果缓存在 COMMIT_PATHS_CACHE 中。
+    """
+    with commit_paths_lock:
+        missing = [c for c in commits if c not in COMMIT_PATHS_CACHE]
+    parsed, current = {}, None
+    # 每批一次 git log 取代每个 commit 一次 diff-tree；merge commit 只和第一父 commit 比较
+    for start in range(0, len(missing), GIT_LOG_BATCH):
+        output = run_command(["git", "log", "--no-walk=unsorted", "--format=@@%H", "--name-only", "--no-renames",
+                              "-m", "--first-parent"] + missing[start:start + GIT_LOG_BATCH], work_dir=repo_path)
+        for line in output.splitlines():
+            line = line.strip()
+            if line.startswith('@@'):
+                current = line[2:]
+                parsed.setdefault(current, [])
+            elif line and current:
+                parsed[current].append(line)
+    with commit_paths_lock:
+        COMMIT_PATHS_CACHE.update(parsed)
+        return {c: COMMIT_PATHS_CACHE.get(c) for c in commits}
+
+
+def is_commit_relevant(paths, include_paths=None, exclude_paths=None):
+    """判断一个 commit 修改的文件是否可能改变 tidb-server 的行为"""
+    if paths is None:
+        return True  # 无法获取修改列表时保守处理
+    candidates = [p for p in paths if not _match_any(p, IRRELEVANT_PATH_PATTERNS)]
+    if include_paths:
+        candidates = [p for p in candidates if _match_any(p, include_paths)]
+    if exclude_paths:
+        candidates = [p for p in candidates if not _match_any(p, exclude_paths)]
+    return bool(candidates)
+
+
+def prune_commits(commits, task_id, repo_path, path_filters=None):
+    """剔除不会影响编译产物的 commit (仅文档/测试/CI 等)，以及不符合用户路径过滤的 commit"""
+    path_filters = path_filters or {}
+    include_paths = path_filters.get('include', [])
+    exclude_paths = path_filters.get('exclude', [])
+    try:
+        changed = get_changed_paths(commits, repo_path)
+    except Exception as e:
+        tasks[task_id]['log'].append(f"⚠️ 获取 commit 修改文件列表失败，跳过剪枝: {e}")
+        return commits
+
+    relevant = [c for c in commits if is_commit_relevant(changed.get(c), include_paths, exclude_paths)]
+    pruned = len(commits) - len(relevant)
+    if pruned:
+        tasks[task_id]['log'].append(
+            f"✂️ 路径剪枝: {len(commits)} 个 commits 中有 {pruned} 个不会影响 tidb-server (或不匹配路径过滤)，"
+            f"剩余 {len(relevant)} 个待二分。")
+    return relevant
+
+def get_go_version(version):
+    """根据 TiDB 版本选择编译使用的 Go 版本"""
+    if version == 'master' or version == 'nightly':
+        return DEFAULT_GO_VERSION
+    version_key = ".".join(version.lstrip('v').split('.')[:2])
+    return TIDB_GO_VERSION_MAP.get(version_key, DEFAULT_GO_VERSION)
+
+
 @retry(max_retries=3)
 def compile_at_commit(commit_sha, task_id, version, repo_path):
     """在指定的隔离 repo_path 中 Checkout 到指定 commit 并进行编译"""
     tasks[task_id]['log'].append(f"\n🔧 在 '{repo_path}' 中切换到 commit: {commit_sha[:8]} 并开始编译...")
+    go_version = get_go_version(version)
+    started = time.time()
     try:
-        if version == 'master' or version == 'nightly':
-            go_version = DEFAULT_GO_VERSION
-        else:
-            version_key = ".".join(version.lstrip('v').split('.')[:2])
-            go_version = TIDB_GO_VERSION_MAP.get(version_key, DEFAULT_GO_VERSION)
-
         tasks[task_id]['log'].append(f"🔀 切换到 commit: {commit_sha[:8]}...")
-        run_command(["git", "checkout", "-f", commit_sha], work_dir=repo_path)
+        with trace_span(task_id, 'checkout', commit=commit_sha):
+            run_command(["git", "checkout", "-f", commit_sha], work_dir=repo_path, task_id=task_id)
         tasks[task_id]['log'].append(f"✅ Git checkout 成功。")
 
         tasks[task_id]['log'].append(f"⚙️ 正在为 TiDB 版本 '{version}' 设置 Go 版本为: {go_version} (临时)...")
 
-        # 验证 Go 版本是否切换成功（通过 run_command 的 go_version 参数）
-        run_command(["go", "version"], work_dir=repo_path, print_output=True, go_version=go_version)
-
-        # 编译 TiDB server，并传入 go_version
-        run_command(COMPILE_COMMAND.split(), work_dir=repo_path, print_output=True, go_version=go_version)
+        with trace_span(task_id, 'build', commit=commit_sha, go_version=go_version):
+            # 验证 Go 版本是否切换成功（通过 run_command 的 go_version 参数）
+            run_command(["go", "version"], work_dir=repo_path, print_output=True, go_version=go_version,
+                        task_id=task_id)
+
+            # 编译 TiDB server，并传入 go_version；开启隔离时编译独占一组 CPU，不影响同时运行的集群
+            isolation = None
+            if tasks[task_id].get('probe_options', {}).get('cpu_isolation'):
+                isolation = assign_isolation(f"build-{uuid4().hex[:12]}", BUILD_CPUS, BUILD_MEMORY_MB)
+                tasks[task_id].setdefault('build_isolation', {})[commit_sha] = isolation
+                tasks[task_id]['log'].append(f"🧷 编译 {commit_sha[:8]}: {describe_isolation(isolation)}。")
+            try:
+                run_command(COMPILE_COMMAND.split(), work_dir=repo_path, print_output=True, go_version=go_version,
+                            task_id=task_id, isolation=isolation)
+            finally:
+                release_isolation(isolation)
 
         binary_full_path = os.path.join(repo_path, TIDB_BINARY_PATH)
         if not os.path.exists(binary_full_path):
             raise FileNotFoundError(f"编译产物 {binary_full_path} 未找到！")
 
         tasks[task_id]['log'].append(f"✅ 编译成功: {binary_full_path}")
+        record_duration('compile', time.time() - started, version, go_version=go_version)
+        tasks[task_id].setdefault('build_seconds', {})[commit_sha] = round(time.time() - started, 3)
         return binary_full_path
+    except TaskCancelled:
+        raise
     except (subprocess.CalledProcessError, FileNotFoundError) as e:
         tasks[task_id]['log'].append(f"❌ 在 commit {commit_sha[:8]} 编译失败: {e}")
-        return None
+        # 抛出异常交给 retry 装饰器根据错误输出判断是否值得重试
+        raise
     except Exception as e:
         tasks[task_id]['log'].append(f"❌ 发生未知错误在编译时: {e}")
+        raise
+    finally:
+        COMPILE_SECONDS.labels(version, go_version).observe(time.time() - started)
+
+
+# --- 无法编译的 commit (skip) ---
+# commit -> {'go_version', 'reason', 'time'}，持久化到磁盘，后续任务不会再重复编译这些 commit。
+# 只记录确定性的编译错误；环境问题 (asdf、git、无法识别的网络错误) 归为 unknown，不写入缓存。
+# 记录超过 UNBUILDABLE_CACHE_TTL 后失效，设置 force_reprobe 的任务忽略缓存重新编译。
+UNBUILDABLE_CACHE_FILE = os.path.join('cache', 'unbuildable_commits.json')
+UNBUILDABLE_CACHE_TTL = 30 * 24 * 3600
+unbuildable_lock = threading.Lock()
+
+
+def _load_json_file(path, default):
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return default
+
+
+def _save_json_file(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # 每个线程使用独立的临时文件，避免并发写入时互相 replace 掉对方的文件
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        # 不使用 indent：带缩进时 json 会退回纯 Python 编码器，频繁写入时长时间占用 GIL
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+unbuildable_commits = _load_json_file(UNBUILDABLE_CACHE_FILE, {})
+
+
+def is_commit_unbuildable(commit_sha, go_version):
+    with unbuildable_lock:
+        entry = unbuildable_commits.get(commit_sha)
+    return (entry is not None and entry.get('go_version') == go_version
+            and time.time() - entry.get('time', 0) < UNBUILDABLE_CACHE_TTL)
+
+
+def mark_commit_unbuildable(commit_sha, go_version, reason):
+    with unbuildable_lock:
+        now = time.time()
+        for sha in [s for s, e in unbuildable_commits.items() if now - e.get('time', 0) >= UNBUILDABLE_CACHE_TTL]:
+            del unbuildable_commits[sha]
+        unbuildable_commits[commit_sha] = {'go_version': go_version, 'reason': reason, 'time': now}
+        _save_json_file(UNBUILDABLE_CACHE_FILE, unbuildable_commits)
+
+
+def build_commit_or_skip(commit_sha, task_id, version, repo_path):
+    """编译指定 commit；已知无法编译或本次编译失败的 commit 返回 None 并记入 skip 缓存"""
+    go_version = get_go_version(version)
+    force = tasks[task_id].get('probe_options', {}).get('force_reprobe')
+    if not force and is_commit_unbuildable(commit_sha, go_version):
+        tasks[task_id]['log'].append(f"⏭️ commit {commit_sha[:8]} 已知无法使用 Go {go_version} 编译，直接跳过。")
         return None
+    tasks[task_id].pop('last_failure', None)
+    binary_path = compile_at_commit(commit_sha, task_id, version, repo_path)
+    if binary_path is None:
+        failure_class = tasks[task_id].get('last_failure', {}).get('class')
+        # 只有确定性错误 (编译错误等) 重试也不会成功；瞬时和无法归类的错误换个时间可能就能编译成功，不写入缓存
+        if failure_class == 'deterministic':
+            mark_commit_unbuildable(commit_sha, go_version, f'编译失败 ({failure_class})')
+        tasks[task_id]['log'].append(f"⏭️ commit {commit_sha[:8]} 无法编译 ({failure_class})，标记为 skip。")
+    return binary_path
+
+
+def effective_status(task_id, status):
+    """
+    把探测结果映射为二分使用的结论：SQL 超时默认视为问题复现 (Failure)，否则视为无法判断 (Skip)；
+    不稳定问题模式下达到重复上限仍无结论 (Inconclusive) 的探测视为 Skip。
+    """
+    if status == 'Timeout':
+        return 'Failure' if tasks[task_id].get('probe_options', {}).get('timeout_is_bad', True) else 'Skip'
+    if status == 'Inconclusive':
+        return 'Skip'
+    return status
+
+
+def _nearest_unskipped(mid, low, high, skipped):
+    """从 mid 开始向两侧交替寻找最近的未被 skip 的位置，找不到返回 None"""
+    for distance in range(0, high - low + 1):
+        for idx in (mid + distance, mid - distance):
+            if low <= idx <= high and idx not in skipped:
+                return idx
+    return None
+
+
+def _bisect_points(low, high, ways, skipped):
+    """在 [low, high] 内均匀选取最多 ways 个未被 skip 的位置；ways 为 1 时就是普通二分的中点"""
+    points = []
+    for j in range(1, ways + 1):
+        idx = _nearest_unskipped(low + j * (high - low) // (ways + 1), low, high, skipped | set(points))
+        if idx is not None and idx not in points:
+            points.append(idx)
+    return sorted(points)
+
+
+def bisect_commits(commits, probe, task_id, ways=None, probe_seconds=None):
+    """
+    git bisect 风格的 commit 二分查找。
+    probe(commit_sha) 返回 'Success' / 'Failure' / 'Skip'，其他返回值视为环境错误。
+    ways() 返回每轮并行探测的 commit 数 (k 路查找，用于把探测分发给多个 agent)，默认为 1。
+    probe_seconds 为单次探测 (含编译) 的预计耗时，每轮开始前据此更新任务的 ETA。
+    返回 (first_bad_commit, culprit_commits)：当 skip 导致无法确定唯一 commit 时，
+    culprit_commits 列出所有可能引入问题的 commit；出错时返回 (None, None)。
+    """
+    low, high, first_bad = 0, len(commits) - 1, None
+    skipped = set()
+    while low <= high:
+        check_cancelled(task_id)
+        k = ways() if ways else 1
+        points = _bisect_points(low, high, k, skipped)
+        if probe_seconds:
+            # 同一轮的探测并行执行，一轮的耗时按单次探测估计
+            rounds = bisect_rounds(high - low + 1, k)
+            update_eta(task_id, 'commit', rounds * k, rounds * probe_seconds)
+        if not points:
+            tasks[task_id]['log'].append(f"⚠️ 剩余的 {high - low + 1} 个 commit 均无法编译，无法继续缩小范围。")
+            break
+        if len(points) > 1:
+            tasks[task_id]['log'].append(f"\n🔀 本轮并行测试 {len(points)} 个 commit。")
+        for idx in points:
+            tasks[task_id]['log'].append(f"\n--- 正在测试第 {idx + 1}/{len(commits)} 个 commit: {commits[idx][:12]} ---")
+
+        if len(points) == 1:
+            statuses = [probe(commits[points[0]])]
+        else:
+            with ThreadPoolExecutor(max_workers=len(points)) as pool:
+                statuses = list(pool.map(lambda i: probe(commits[i]), points))
+        check_cancelled(task_id)
+
+        # 按位置从小到大处理：最靠前的 Failure 决定新的上界，它之前的 Success 决定新的下界
+        for idx, raw_status in zip(points, statuses):
+            status = effective_status(task_id, raw_status)
+            if status == 'Skip':
+                skipped.add(idx)
+            elif status == 'Failure':
+                first_bad = idx
+                high = idx - 1
+                break
+            elif status == 'Success':
+                low = idx + 1
+            else:
+                tasks[task_id]['log'].append(f"commit {commits[idx][:7]} 测试时发生环境错误，中止。")
+                tasks[task_id]['status'] = 'error'
+                return None, None
+
+    if first_bad is None:
+        return None, []
+    # low 之后、first_bad 之前的 commit 都被 skip 了，它们同样可能是引入问题的 commit
+    culprits = [commits[i] for i in range(low, first_bad + 1) if i in skipped or i == first_bad]
+    return commits[first_bad], culprits
+
+
+def format_culprit_range(culprits):
+    lines = [f"由于部分 commit 无法编译或无法得出结论，问题由以下 {len(culprits)} 个 commit 之一引入:"]
+    lines += [f"  {c}" for c in culprits]
+    return "\n".join(lines)
 
 
 # --- 辅助函数 ---
@@ -310,47 +947,181 @@ def get_tidb_versions():
         return ["v8.1.0", "v8.0.0", "v7.5.1", "v7.1.3", "v6.5.9", "v6.1.7", "v5.4.3", "v4.0.16"]
 
 
-def run_sql_on_tidb(sql, port):
-    """在指定的 TiDB 实例上执行 SQL"""
+# SQL 执行时间限制 (秒)，可被请求中的 statement_timeout / probe_timeout 覆盖
+STATEMENT_TIMEOUT = 120
+PROBE_TIMEOUT = 900
+MAX_EXECUTION_TIME_ERRNO = 3024  # "maximum statement execution time exceeded"
+
+
+class ProbeTimeout(Exception):
+    """SQL 执行超过了单条语句或整个探测的时间限制"""
+
+
+class QueryWatchdog:
+    """客户端 watchdog：语句超时后通过另一条连接发送 KILL QUERY，防止探测线程被挂起的查询永久阻塞"""
+
+    def __init__(self, port, connection_id, timeout):
+        self.port = port
+        self.connection_id = connection_id
+        self.fired = False
+        self.timer = threading.Timer(timeout, self._kill) if timeout else None
+
+    def _kill(self):
+        self.fired = True
+        try:
+            conn = mysql.connector.connect(host='127.0.0.1', port=self.port, user='root', password='',
+                                           connection_timeout=5)
+            # KILL TIDB QUERY 在所有 TiDB 版本上都只作用于当前 tidb-server
+            conn.cursor().execute(f"KILL TIDB QUERY {self.connection_id}")
+            conn.close()
+        except mysql.connector.Error as e:
+            print(f"⚠️ 发送 KILL QUERY {self.connection_id} 失败: {e}")
+
+    def __enter__(self):
+        if self.timer:
+            self.timer.daemon = True
+            self.timer.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self.timer:
+            self.timer.cancel()
+        return False
+
+
+class SuiteConnectionPool:
+    """用例集的连接池：连接按需建立，用完归还复用；close() 关闭池中的全部连接"""
+
+    def __init__(self, port):
+        self.port = port
+        self.idle = []
+        self.closed = False
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            conn = self.idle.pop() if self.idle else None
+        if conn is None:
+            return mysql.connector.connect(host='127.0.0.1', port=self.port, user='root', password='',
+                                           database='test', autocommit=True, connection_timeout=20)
+        if not conn.is_connected():
+            conn.reconnect()
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            if not self.closed:
+                self.idle.append(conn)
+                return
+        # 用例集已结束 (例如任务取消后仍在执行的查询)，直接关闭
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            try:
+                conn.close()
+            except mysql.connector.Error:
+                pass
+
+
+def run_sql_on_tidb(sql, port, statement_timeout=None, probe_timeout=None, database='test', pool=None):
+    """
+    在指定的 TiDB 实例上执行 SQL；sql 可以是按分号分隔的字符串，也可以是已拆分好的语句列表。
+    statement_timeout 限制单条语句 (服务端 max_execution_time + 客户端 KILL QUERY)，
+    probe_timeout 限制全部语句的总时间；超时抛出 ProbeTimeout。
+    pool 不为空时从连接池取连接 (用例集模式)，用完归还。
+    """
     result_str = ""
+    deadline = time.time() + probe_timeout if probe_timeout else None
+    conn = None
+    watchdog = None
     try:
-        conn = mysql.connector.connect(
-            host='127.0.0.1',
-            port=port,
-            user='root',
-            password='',
-            database='test',
-            autocommit=True,
-            connection_timeout=20
-        )
+        if pool:
+            conn = pool.acquire()
+            conn.database = database
+        else:
+            conn = mysql.connector.connect(
+                host='127.0.0.1',
+                port=port,
+                user='root',
+                password='',
+                database=database,
+                autocommit=True,
+                connection_timeout=20
+            )
         cursor = conn.cursor()
-        for stmt in sql.split(';'):
+        if statement_timeout:
+            try:
+                cursor.execute(f"SET SESSION max_execution_time = {int(statement_timeout * 1000)}")
+            except mysql.connector.Error:
+                pass  # 老版本不支持时只依赖客户端 watchdog
+        for stmt in (sql if isinstance(sql, list) else sql.split(';')):
             if stmt.strip():
-                cursor.execute(stmt)
-                if cursor.with_rows:
-                    rows = cursor.fetchall()
-                    result_str += str(rows) + "\n"
+                timeout = statement_timeout
+                if deadline:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise ProbeTimeout(f"探测总时间超过 {probe_timeout} 秒")
+                    timeout = min(timeout, remaining) if timeout else remaining
+                with QueryWatchdog(port, conn.connection_id, timeout) as watchdog:
+                    cursor.execute(stmt)
+                    if cursor.with_rows:
+                        rows = cursor.fetchall()
+                        result_str += str(rows) + "\n"
+                if watchdog.fired:
+                    raise ProbeTimeout(f"语句执行超时 ({timeout:.0f} 秒): {stmt.strip()[:200]}")
         conn.commit()
         cursor.close()
-        conn.close()
         return result_str, True
     except mysql.connector.Error as err:
+        if (watchdog and watchdog.fired) or getattr(err, 'errno', None) == MAX_EXECUTION_TIME_ERRNO:
+            raise ProbeTimeout(f"语句执行超时: {err}") from err
         print(f"SQL 执行失败: {err}")
         return str(err), False
+    finally:
+        if conn:
+            try:
+                if pool:
+                    pool.release(conn)
+                else:
+                    conn.close()
+            except mysql.connector.Error:
+                pass
+
+
+def sql_result_matches(expected_sql_result, actual_sql_result, success):
+    """忽略空白后实际结果包含预期结果即通过；预期结果为空时 SQL 执行成功即通过"""
+    if expected_sql_result.strip():
+        return ''.join(expected_sql_result.split()) in ''.join(actual_sql_result.split())
+    return success
+
+
+def tidb_log_file(port):
+    """通过 SHOW CONFIG 获取 TiDB 日志文件路径，其上两级即 playground 数据目录；失败时返回 None"""
+    result, success = run_sql_on_tidb("show config where type='tidb' and name='log.file.filename';", port)
+    if not success or not result:
+        return None
+    return ast.literal_eval(result)[0][3]
+
 
+CHECK_SCRIPT_TIMEOUT = 120  # 检查脚本的最长执行时间 (秒)
 
-def run_other_check(script_content, port, task_id):
-    """执行其他检查脚本"""
+
+async def run_other_check(script_content, port, task_id, database='test'):
+    """
+    执行其他检查脚本；脚本通过 TIDB_PORT / TIDB_DATABASE 环境变量得知要检查的集群和数据库。
+    脚本作为 asyncio 子进程在探测事件循环上等待，超时或协程被取消时杀掉脚本的整个进程组。
+    """
     tasks[task_id]['log'].append("--- 开始其他检查 ---")
-    log_dir_query = "show config where type='tidb' and name='log.file.filename';"
     try:
-        result, success = run_sql_on_tidb(log_dir_query, port)
-        if not success or not result:
+        log_file_path = await run_query(tidb_log_file, port)
+        if not log_file_path:
             msg = "获取 TiDB 日志目录失败。"
             tasks[task_id]['log'].append(f"❌ {msg}")
             return "Failure", msg
-        data_list = ast.literal_eval(result)
-        log_file_path = data_list[0][3]
         base_dir = os.path.dirname(os.path.dirname(log_file_path))
         tasks[task_id]['log'].append(f"✅ 成功获取到tidb日志目录: {log_file_path}")
         tasks[task_id]['log'].append(f"✅ 脚本将会在此基础目录执行: {base_dir}")
@@ -359,7 +1130,8 @@ def run_other_check(script_content, port, task_id):
         tasks[task_id]['log'].append(f"❌ {msg}")
         return "Failure", msg
 
-    script_path = os.path.join(base_dir, f"check_script_{task_id[:8]}.sh")
+    # 用例集并发执行时多个用例共用同一个集群目录，脚本文件名带上数据库名避免互相覆盖
+    script_path = os.path.join(base_dir, f"check_script_{task_id[:8]}_{database}.sh")
     try:
         with open(script_path, 'w') as f:
             f.write("#!/bin/bash\n")
@@ -368,10 +1140,23 @@ def run_other_check(script_content, port, task_id):
         os.chmod(script_path, st.st_mode | stat.S_IEXEC)
         tasks[task_id]['log'].append(f"✅ 检查脚本已保存到: {script_path}")
         tasks[task_id]['log'].append(f"🚀 执行检查脚本...")
-        process = subprocess.run(
-            ['/bin/bash', script_path], capture_output=True, text=True, timeout=120, cwd=base_dir
+        process = await asyncio.create_subprocess_exec(
+            '/bin/bash', script_path, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,
+            stdin=asyncio.subprocess.DEVNULL, cwd=base_dir, start_new_session=True,
+            env=dict(os.environ, TIDB_PORT=str(port), TIDB_DATABASE=database)
         )
-        script_output = process.stdout.strip() + "\n" + process.stderr.strip()
+        try:
+            stdout, stderr = await asyncio.wait_for(process.communicate(), CHECK_SCRIPT_TIMEOUT)
+        except BaseException as e:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+            except (ProcessLookupError, PermissionError):
+                pass
+            if isinstance(e, asyncio.TimeoutError):
+                raise Exception(f"检查脚本执行超时 ({CHECK_SCRIPT_TIMEOUT} 秒)") from e
+            raise
+        script_output = (stdout.decode('utf-8', errors='replace').strip() + "\n" +
+                         stderr.decode('utf-8', errors='replace').strip())
         tasks[task_id]['log'].append(f"脚本输出:\n{script_output}")
         if process.returncode == 0:
             tasks[task_id]['log'].append("✅ 其他检查通过 (脚本返回值为 0)。")
@@ -387,44 +1172,1615 @@ def run_other_check(script_content, port, task_id):
         if os.path.exists(script_path):
             os.remove(script_path)
 
+# --- 日志检查 ---
+# 内置的日志断言：对各组件日志执行用户给出的正则，forbidden 表示不允许出现，required 表示必须出现。
+# 日志通过 mmap 扫描，每个集群记录每个文件已扫描到的字节位置，同一集群上的重复检查只读取新增内容。
+# forbidden 规则只看新增内容 (每次检查各自判定)；required 规则按整个文件判定，集群表中记录之前已找到的匹配行。
+LOG_CHECK_MODES = ('forbidden', 'required')
+LOG_CHECK_COMPONENTS = ('tidb', 'tikv', 'pd', 'tiflash')
+LOG_CHECK_MAX_MATCHES = 20  # 每条规则最多返回的匹配行数
+LOG_CHECK_LINE_RE = re.compile(r'^\s*(forbidden|required)(?:@([\w,]+))?\s*:\s*(.+?)\s*$')
+
+
+def parse_log_checks(value):
+    """
+    解析日志检查规则。可以是 [{pattern, mode, components}] 列表，也可以是每行一条的文本：
+    "forbidden: panic"、"required@tikv,pd: welcome"，不写模式时默认为 forbidden。
+    """
+    if isinstance(value, str):
+        rules = []
+        for line in value.splitlines():
+            if not line.strip() or line.strip().startswith('#'):
+                continue
+            match = LOG_CHECK_LINE_RE.match(line)
+            if match:
+                components = match.group(2).split(',') if match.group(2) else None
+                rules.append({'mode': match.group(1), 'components': components, 'pattern': match.group(3)})
+            else:
+                rules.append({'mode': 'forbidden', 'components': None, 'pattern': line.strip()})
+        value = rules
+    checks = []
+    for rule in value or []:
+        mode = rule.get('mode') or 'forbidden'
+        components = rule.get('components') or list(LOG_CHECK_COMPONENTS)
+        if mode not in LOG_CHECK_MODES:
+            raise ValueError(f"未知的日志检查模式: {mode} (可选 {', '.join(LOG_CHECK_MODES)})")
+        unknown = [c for c in components if c not in LOG_CHECK_COMPONENTS]
+        if unknown:
+            raise ValueError(f"未知的组件: {', '.join(unknown)}")
+        try:
+            re.compile(rule['pattern'])
+        except (re.error, KeyError, TypeError) as e:
+            raise ValueError(f"无效的日志检查正则 {rule.get('pattern')!r}: {e}")
+        checks.append({'mode': mode, 'components': sorted(components), 'pattern': rule['pattern']})
+    return checks
+
+
+def component_log_files(base_dir, components):
+    """playground 数据目录下各组件实例的日志文件，如 tidb-0/tidb.log、tikv-1/tikv.log"""
+    files = []
+    for entry in sorted(os.listdir(base_dir)):
+        component = entry.split('-')[0]
+        if component not in components or not os.path.isdir(os.path.join(base_dir, entry)):
+            continue
+        for name in sorted(os.listdir(os.path.join(base_dir, entry))):
+            if name.endswith('.log'):
+                files.append(os.path.join(base_dir, entry, name))
+    return files
+
+
+def _scan_new_bytes(path, regexes, offsets):
+    """
+    用 mmap 扫描 path 中 offsets 记录位置之后的完整行，返回 {规则序号: [匹配行]}。
+    文件被轮转或截断 (inode 变化、长度变小) 时从头扫描；末尾不完整的行留到下次。
+    """
+    matches = {}
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        inode, start = offsets.get(path, (None, 0))
+        if inode != st.st_ino or st.st_size < start:
+            start = 0
+        if st.st_size == start:
+            return matches
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = mm.rfind(b'\n', start, st.st_size) + 1
+            if end <= start:
+                return matches
+            for i, regex in enumerate(regexes):
+                if regex is None:
+                    continue
+                for m in regex.finditer(mm, start, end):
+                    line_start = mm.rfind(b'\n', start, m.start()) + 1 or start
+                    line_end = mm.find(b'\n', m.end() - 1 if m.end() > m.start() else m.end(), end)
+                    matches.setdefault(i, []).append(mm[line_start:line_end].decode('utf-8', errors='replace'))
+                    if len(matches[i]) >= LOG_CHECK_MAX_MATCHES:
+                        break
+        offsets[path] = (st.st_ino, end)
+    return matches
+
+
+def check_cluster_logs(pid, port, checks, task_id):
+    """对集群执行日志检查；数据目录和扫描位置记录在集群表中，同一集群上的后续检查只扫描新增日志"""
+    with clusters_lock:
+        cluster = clusters.get(pid, {})
+        base_dir = cluster.get('log_base_dir') or cluster.get('data_dir')
+    if not base_dir:
+        log_file_path = tidb_log_file(port)
+        if not log_file_path:
+            tasks[task_id]['log'].append("❌ 获取 TiDB 日志目录失败，无法执行日志检查。")
+            return "Failure", []
+        base_dir = os.path.dirname(os.path.dirname(log_file_path))
+    with clusters_lock:
+        cluster['log_base_dir'] = base_dir
+        offsets = cluster.setdefault('log_offsets', {})
+        required_seen = cluster.setdefault('log_required_matches', {})
+    return run_log_checks(checks, base_dir, offsets, task_id, required_seen)
+
+
+def run_log_checks(checks, base_dir, offsets, task_id, required_seen=None):
+    """
+    执行日志检查，返回 (状态, 每条规则的结果)；offsets 由调用方按集群保存。
+    required_seen 为 {规则: 之前扫描到的匹配行}，required 规则合并之前的匹配，已经出现过的行不会因为没有新增而失败。
+    """
+    required_seen = {} if required_seen is None else required_seen
+    started = time.time()
+    results = [{'mode': c['mode'], 'pattern': c['pattern'], 'components': c['components'], 'matches': []}
+               for c in checks]
+    for path in component_log_files(base_dir, LOG_CHECK_COMPONENTS):
+        component = os.path.basename(os.path.dirname(path)).split('-')[0]
+        # 同一个文件上的所有规则共用一次 mmap 扫描，按组件过滤不适用的规则
+        regexes = [re.compile(c['pattern'].encode('utf-8')) if component in c['components'] else None
+                   for c in checks]
+        try:
+            found = _scan_new_bytes(path, regexes, offsets)
+        except (OSError, ValueError) as e:
+            tasks[task_id]['log'].append(f"⚠️ 读取日志 {path} 失败: {e}")
+            continue
+        relative = os.path.relpath(path, base_dir)
+        for i, lines in found.items():
+            room = LOG_CHECK_MAX_MATCHES - len(results[i]['matches'])
+            results[i]['matches'] += [{'file': relative, 'line': line[:2000]} for line in lines[:room]]
+    for check, result in zip(checks, results):
+        if check['mode'] == 'required':
+            key = (check['pattern'], tuple(check['components']))
+            if not result['matches']:
+                result['matches'] = list(required_seen.get(key, []))
+            required_seen[key] = result['matches']
+    status = "Success"
+    for result in results:
+        result['passed'] = bool(result['matches']) == (result['mode'] == 'required')
+        if not result['passed']:
+            status = "Failure"
+            tasks[task_id]['log'].append(
+                f"❌ 日志检查失败 ({result['mode']}: {result['pattern']})" +
+                "".join(f"\n  {m['file']}: {m['line'][:300]}" for m in result['matches'][:5]))
+    tasks[task_id]['log'].append(f"{'✅' if status == 'Success' else '❌'} 日志检查完成: {len(checks)} 条规则，"
+                                 f"耗时 {(time.time() - started) * 1000:.0f} 毫秒。")
+    return status, results
+
+
+# --- 测试数据 (fixtures) ---
+# 随任务上传的 CSV / SQL dump 文件，按内容哈希保存在磁盘上，在 setup SQL 之后、数据快照之前导入。
+# CSV 按版本选择最快的导入方式：大文件在支持 IMPORT INTO 的版本上使用 IMPORT INTO，否则 LOAD DATA LOCAL INFILE，
+# 都不可用时退回批量 INSERT；SQL dump 中连续的单行 INSERT 合并为多行 INSERT 执行。
+FIXTURE_DIR = os.path.join('cache', 'fixtures')
+FIXTURE_BATCH_BYTES = 1024 * 1024  # 合并后单条 INSERT 的最大长度
+FIXTURE_BATCH_ROWS = 1000  # CSV 退回批量 INSERT 时每批的行数
+IMPORT_INTO_MIN_VERSION = Version('7.5.0')
+IMPORT_INTO_MIN_BYTES = 256 * 1024 * 1024  # IMPORT INTO 有数秒的作业开销，只用于大文件
+INSERT_VALUES_RE = re.compile(r'^\s*insert\s+into\s+(.+?)\s+values\s*(\(.*\))\s*$', re.IGNORECASE | re.DOTALL)
+TIDB_RELEASE_VERSION_RE = re.compile(r'Release Version:\s*v?(\d+\.\d+\.\d+)')
+
+
+def save_fixtures(items):
+    """保存请求中的 fixtures ([{name, content, table?}])，返回不含内容的元数据列表"""
+    fixtures = []
+    os.makedirs(FIXTURE_DIR, exist_ok=True)
+    for item in items or []:
+        name = os.path.basename(item.get('name') or '')
+        stem, ext = os.path.splitext(name)
+        fmt = ext.lower().lstrip('.')
+        if fmt not in ('csv', 'sql'):
+            raise ValueError(f"不支持的 fixture 文件类型: {name} (仅支持 .csv 和 .sql)")
+        data = (item.get('content') or '').encode('utf-8')
+        sha256 = hashlib.sha256(data).hexdigest()
+        path = fixture_path(sha256, fmt)
+        if not os.path.exists(path):
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        fixtures.append({'name': name, 'format': fmt, 'table': item.get('table') or stem, 'sha256': sha256,
+                         'bytes': len(data)})
+    return fixtures
+
+
+def fixture_path(sha256, fmt):
+    return os.path.abspath(os.path.join(FIXTURE_DIR, f"{sha256}.{fmt}"))
+
+
+def split_sql_statements(text):
+    """按分号拆分 SQL，忽略引号和注释中的分号"""
+    statements, current, quote, i = [], [], None, 0
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            current.append(ch)
+            if ch == '\\' and i + 1 < len(text):
+                current.append(text[i + 1])
+                i += 1
+            elif ch == quote:
+                quote = None
+        elif ch in ("'", '"', '`'):
+            quote = ch
+            current.append(ch)
+        elif text.startswith(('-- ', '--\t', '--\n'), i) or ch == '#':
+            end = text.find('\n', i)
+            i = len(text) if end < 0 else end
+            continue
+        elif text.startswith('/*', i) and not text.startswith(('/*!', '/*+'), i):
+            end = text.find('*/', i + 2)
+            i = len(text) if end < 0 else end + 2
+            continue
+        elif ch == ';':
+            statements.append(''.join(current).strip())
+            current = []
+        else:
+            current.append(ch)
+        i += 1
+    statements.append(''.join(current).strip())
+    return [s for s in statements if s]
+
+
+def is_values_list(text):
+    """text 是否只由逗号分隔的括号值列表组成；后面带 ON DUPLICATE KEY UPDATE、AS 别名等子句时返回 False"""
+    depth, quote, expect_group, i = 0, None, True, 0
+    while i < len(text):
+        ch = text[i]
+        if quote:
+            if ch == '\\':
+                i += 1
+            elif ch == quote:
+                quote = None
+        elif ch in ("'", '"', '`'):
+            quote = ch
+        elif ch == '(':
+            if depth == 0 and not expect_group:
+                return False
+            depth += 1
+            expect_group = False
+        elif ch == ')':
+            depth -= 1
+            if depth < 0:
+                return False
+        elif depth == 0 and ch == ',':
+            if expect_group:
+                return False
+            expect_group = True
+        elif depth == 0 and not ch.isspace():
+            return False
+        i += 1
+    return depth == 0 and quote is None and not expect_group
+
+
+def batch_insert_statements(statements):
+    """把连续的、插入同一张表 (同一列列表) 的 INSERT 合并为多行 INSERT，单条不超过 FIXTURE_BATCH_BYTES"""
+    batched, prefix, values, size = [], None, [], 0
+    for stmt in statements:
+        match = INSERT_VALUES_RE.match(stmt)
+        if match and not is_values_list(match.group(2)):
+            match = None  # 带额外子句的 INSERT 原样执行
+        if match and match.group(1) == prefix and size + len(match.group(2)) < FIXTURE_BATCH_BYTES:
+            values.append(match.group(2))
+            size += len(match.group(2)) + 1
+            continue
+        if values:
+            batched.append(f"INSERT INTO {prefix} VALUES {','.join(values)}")
+        prefix, values, size = None, [], 0
+        if match:
+            prefix, values, size = match.group(1), [match.group(2)], len(match.group(2))
+        else:
+            batched.append(stmt)
+    if values:
+        batched.append(f"INSERT INTO {prefix} VALUES {','.join(values)}")
+    return batched
+
+
+def execute_batched_sql(text, port):
+    """执行 setup SQL / SQL dump：合并 INSERT 减少网络往返，返回 (执行的语句数, 输出, 是否成功)"""
+    statements = batch_insert_statements(split_sql_statements(text))
+    output, success = run_sql_on_tidb(statements, port)
+    return len(statements), output, success
+
+
+def _server_version(cursor):
+    cursor.execute("SELECT tidb_version()")
+    match = TIDB_RELEASE_VERSION_RE.search(str(cursor.fetchone()[0]))
+    return Version(match.group(1)) if match else None
+
+
+def _csv_columns(path):
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        header = next(csv.reader(f), [])
+    return ', '.join(f"`{c.strip()}`" for c in header)
+
+
+def _insert_csv_rows(cursor, table, columns, path):
+    """CSV 的兜底导入方式：executemany 会被驱动改写为多行 INSERT"""
+    rows = 0
+    with open(path, 'r', encoding='utf-8', newline='') as f:
+        reader = csv.reader(f)
+        next(reader, None)
+        stmt = f"INSERT INTO `{table}` ({columns}) VALUES ({', '.join(['%s'] * len(columns.split(',')))})"
+        while True:
+            batch = [[None if v == '\\N' else v for v in row]
+                     for _, row in zip(range(FIXTURE_BATCH_ROWS), reader)]
+            if not batch:
+                return rows
+            cursor.executemany(stmt, batch)
+            rows += len(batch)
+
+
+def _load_csv(cursor, fixture, server_version, task_id):
+    """按版本选择最快的方式导入 CSV (首行为列名)，返回 (方法, 行数)"""
+    path, table = fixture_path(fixture['sha256'], 'csv'), fixture['table']
+    columns = _csv_columns(path)
+    if server_version and server_version >= IMPORT_INTO_MIN_VERSION and fixture['bytes'] >= IMPORT_INTO_MIN_BYTES:
+        try:
+            cursor.execute(f"IMPORT INTO `{table}` ({columns}) FROM '{path}' WITH skip_rows=1")
+            rows = cursor.fetchall()
+            # 结果集中 Imported_Rows 列的位置随版本变化，按列名查找
+            names = [d[0].lower() for d in cursor.description]
+            return 'IMPORT INTO', int(rows[0][names.index('imported_rows')]) if 'imported_rows' in names else None
+        except mysql.connector.Error as e:
+            tasks[task_id]['log'].append(f"⚠️ IMPORT INTO {table} 失败 ({e})，改用 LOAD DATA。")
+    try:
+        cursor.execute(f"LOAD DATA LOCAL INFILE '{path}' INTO TABLE `{table}` FIELDS TERMINATED BY ',' "
+                       f"OPTIONALLY ENCLOSED BY '\"' LINES TERMINATED BY '\\n' IGNORE 1 LINES ({columns})")
+        return 'LOAD DATA', cursor.rowcount
+    except mysql.connector.Error as e:
+        tasks[task_id]['log'].append(f"⚠️ LOAD DATA {table} 失败 ({e})，改用批量 INSERT。")
+    return 'INSERT', _insert_csv_rows(cursor, table, columns, path)
+
+
+def load_fixtures(fixtures, port, task_id):
+    """导入任务的全部 fixtures，记录每个文件的导入方式和吞吐；导入失败时抛出异常"""
+    stats = []
+    conn = mysql.connector.connect(host='127.0.0.1', port=port, user='root', password='', database='test',
+                                   autocommit=True, connection_timeout=20, allow_local_infile=True)
+    try:
+        cursor = conn.cursor()
+        server_version = _server_version(cursor)
+        for fixture in fixtures:
+            check_cancelled(task_id)
+            started = time.time()
+            with trace_span(task_id, 'fixture_load', fixture=fixture['name']) as span:
+                if fixture['format'] == 'csv':
+                    method, rows = _load_csv(cursor, fixture, server_version, task_id)
+                else:
+                    with open(fixture_path(fixture['sha256'], 'sql'), 'r', encoding='utf-8') as f:
+                        rows, output, success = execute_batched_sql(f.read(), port)
+                    if not success:
+                        raise Exception(f"导入 {fixture['name']} 失败: {output}")
+                    method = 'batched SQL'
+                if span:
+                    span['attrs']['method'] = method
+            seconds = max(time.time() - started, 1e-6)
+            FIXTURE_LOAD_BYTES.labels(method).inc(fixture['bytes'])
+            stats.append({'name': fixture['name'], 'method': method, 'rows': rows, 'bytes': fixture['bytes'],
+                          'seconds': round(seconds, 3), 'mb_per_second': round(fixture['bytes'] / 1e6 / seconds, 2)})
+            unit = '条语句' if fixture['format'] == 'sql' else '行'
+            tasks[task_id]['log'].append(
+                f"📥 已导入 {fixture['name']} ({method}): {rows} {unit}，{fixture['bytes'] / 1e6:.1f} MB，"
+                f"{seconds:.1f} 秒 ({fixture['bytes'] / 1e6 / seconds:.1f} MB/s)")
+        cursor.close()
+    finally:
+        conn.close()
+    return stats
+
+
+# --- 探测结果缓存 ---
+# 相同 (版本/commit, SQL, 预期结果, 检查脚本, 拓扑) 的探测结果是确定的，跨任务复用，避免重复编译和启动集群
+VERDICT_CACHE_FILE = os.path.join('cache', 'verdicts.json')
+VERDICT_CACHE_TTL = 7 * 24 * 3600  # 默认缓存有效期 (秒)
+# 只属于产生结果的那次运行的字段 (集群端口、资源分配、耗时)，不写入缓存，命中时也不会展示已不存在的集群
+VERDICT_RUN_FIELDS = ('sql_port', 'dashboard_port', 'isolation', 'build_isolation', 'data_dir_medium', 'durations',
+                      'agent')
+verdict_lock = threading.Lock()
+verdict_cache = _load_json_file(VERDICT_CACHE_FILE, {})
+
+
+def verdict_key(version, commit, sql, expected_sql, other_check, topology, extra_key=''):
+    fields = [version, commit or '', sql or '', expected_sql, other_check or '', topology]
+    # 没有准备数据、日志检查等额外输入时保持原来的 key，已有的缓存继续有效
+    if extra_key:
+        fields.append(extra_key)
+    payload = json.dumps(fields, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def probe_setup_key(task_id):
+    """标识任务的准备数据 (setup SQL 和 fixtures)，用于结果缓存和数据快照的 key"""
+    options = tasks[task_id].get('probe_options', {})
+    key = options.get('setup_sql') or ''
+    for fixture in options.get('fixtures') or []:
+        key += f"\n-- fixture {fixture['table']} {fixture['format']} {fixture['sha256']}"
+    return key
+
+
+def probe_extra_key(task_id):
+    """除 SQL、预期结果和检查脚本之外影响探测结论的输入：准备数据、日志检查规则和不稳定问题模式的参数"""
+    key = probe_setup_key(task_id)
+    options = tasks[task_id].get('probe_options', {})
+    if options.get('log_checks'):
+        key += "\n-- log checks " + json.dumps(options['log_checks'], sort_keys=True, ensure_ascii=False)
+    if options.get('flaky'):
+        key += "\n-- flaky " + json.dumps(options['flaky'], sort_keys=True)
+    return key
+
+
+def get_cached_verdict(task_id, key):
+    """返回未过期的缓存结果；任务设置了 force_reprobe 时总是返回 None"""
+    options = tasks[task_id].get('probe_options', {})
+    if options.get('force_reprobe'):
+        return None
+    max_age = options.get('verdict_max_age') or VERDICT_CACHE_TTL
+    with verdict_lock:
+        entry = verdict_cache.get(key)
+    if not entry or time.time() - entry['time'] > max_age:
+        return None
+    result = {k: v for k, v in entry['result'].items() if k not in VERDICT_RUN_FIELDS}
+    return dict(result, cached=True, cached_at=entry['time'])
+
+
+def store_verdict(key, result_data):
+    # 只缓存明确的结论；环境错误 (启动失败、异常等) 下次应重新探测
+    if result_data.get('status') not in ('Success', 'Failure') or 'error' in result_data:
+        return
+    now = time.time()
+    with verdict_lock:
+        verdict_cache[key] = {'time': now,
+                              'result': {k: v for k, v in result_data.items() if k not in VERDICT_RUN_FIELDS}}
+        for k in [k for k, v in verdict_cache.items() if now - v['time'] > VERDICT_CACHE_TTL]:
+            del verdict_cache[k]
+        _save_json_file(VERDICT_CACHE_FILE, verdict_cache)
+
+
+def fill_from_verdict_cache(task_id, index, version, commit, sql, expected_sql, other_check, topology=None):
+    """命中缓存时直接写入结果并返回 True，调用方无需再编译或启动集群"""
+    cached = get_cached_verdict(task_id, verdict_key(version, commit, sql, expected_sql, other_check,
+                                                     topology or task_topology(task_id), probe_extra_key(task_id)))
+    if not cached:
+        return False
+    label = f"版本 {version}" + (f" (commit {commit[:7]})" if commit else "")
+    tasks[task_id]['log'].append(f"♻️ {label}: 命中探测结果缓存 ({cached['status']})，跳过集群启动。")
+    tasks[task_id]['results'][index] = cached
+    return True
+
+
+# --- 耗时模型 ---
+# 按 (阶段, 版本, 拓扑, Go 版本) 保存最近的耗时样本并持久化，阶段为 compile / boot / sql / check。
+# 集群启动的等待上限取同类启动耗时的 p99 × 1.5：卡住的启动尽早失败，慢拓扑也不会被过早判为超时；
+# 二分查找和版本扫描按剩余探测数与单次探测的中位耗时估计完成时间 (ETA)。
+# 估计 ETA 时，精确的 key 样本不足时依次放宽到同拓扑、同阶段的全部样本；启动等待上限只用同版本同拓扑的样本，
+# 没有下载过的版本第一次启动包含下载时间，借用其他版本的热启动耗时会被过早判为超时。
+DURATION_MODEL_FILE = os.path.join('cache', 'durations.json')
+DURATION_MAX_SAMPLES = 50  # 每个 key 保留的最近样本数
+DURATION_MIN_SAMPLES = 5  # 样本数少于该值时不用于推断
+DURATION_SAVE_INTERVAL = 30  # 两次持久化之间的最短间隔 (秒)
+DEFAULT_PHASE_SECONDS = {'compile': 600, 'boot': 60, 'sql': 5, 'check': 5}  # 没有样本时估计 ETA 使用
+STARTUP_DEADLINE_QUANTILE = 0.99
+STARTUP_DEADLINE_FACTOR = 1.5
+STARTUP_DEADLINE_MIN = 30
+STARTUP_DEADLINE_MAX = 1800
+duration_samples = _load_json_file(DURATION_MODEL_FILE, {})  # "阶段|版本|拓扑|Go 版本" -> [秒]
+duration_lock = threading.Lock()
+duration_saved_at = 0
+
+
+def record_duration(phase, seconds, version='', topology='', go_version=''):
+    global duration_saved_at
+    with duration_lock:
+        samples = duration_samples.setdefault(f"{phase}|{version}|{topology}|{go_version}", [])
+        samples.append(round(seconds, 3))
+        del samples[:-DURATION_MAX_SAMPLES]
+        if time.time() - duration_saved_at < DURATION_SAVE_INTERVAL:
+            return
+        duration_saved_at = time.time()
+        data = {key: list(values) for key, values in duration_samples.items()}
+    _save_json_file(DURATION_MODEL_FILE, data)
+
+
+def record_probe_durations(durations, version, topology, go_version=''):
+    """记录一次探测的各阶段耗时 (agent 回传的结果也带有 durations)"""
+    for phase, seconds in (durations or {}).items():
+        if phase in DEFAULT_PHASE_SECONDS:
+            record_duration(phase, seconds, version, '' if phase == 'compile' else topology,
+                            go_version if phase == 'compile' else '')
+
+
+def quantile(values, q):
+    ordered = sorted(values)
+    position = q * (len(ordered) - 1)
+    lower = int(position)
+    upper = min(lower + 1, len(ordered) - 1)
+    return ordered[lower] + (ordered[upper] - ordered[lower]) * (position - lower)
+
+
+def expected_duration(phase, q, version='', topology='', go_version='', fallback=True):
+    """返回阶段耗时的 q 分位数；fallback 为 False 时只用精确 key 的样本。样本都不足时返回 None"""
+    with duration_lock:
+        items = [(key.split('|'), values) for key, values in duration_samples.items()]
+    levels = ((version, topology, go_version), ('', topology, ''), ('', '', ''))
+    for wanted in levels if fallback else levels[:1]:
+        values = [v for (p, *fields), samples in items if p == phase
+                  and all(not w or w == f for w, f in zip(wanted, fields)) for v in samples]
+        if len(values) >= DURATION_MIN_SAMPLES:
+            return quantile(values, q)
+    return None
+
+
+def startup_deadline(version, topology):
+    """集群启动的等待上限 (秒) 和推断所用的 p99；该版本和拓扑没有足够样本时使用固定的默认值"""
+    p99 = expected_duration('boot', STARTUP_DEADLINE_QUANTILE, version, topology, fallback=False)
+    if p99 is None:
+        return CLUSTER_READY_POLL_INTERVAL * CLUSTER_READY_MAX_POLLS, None
+    return min(STARTUP_DEADLINE_MAX, max(STARTUP_DEADLINE_MIN, p99 * STARTUP_DEADLINE_FACTOR)), p99
+
+
+def expected_probe_seconds(version, topology, build=False, check=False):
+    """一次探测的预计耗时：各阶段中位数之和，编译和检查脚本只在需要时计入"""
+    phases = ['boot', 'sql'] + (['compile'] if build else []) + (['check'] if check else [])
+    total = 0
+    for phase in phases:
+        if phase == 'compile':
+            median = expected_duration(phase, 0.5, version, go_version=get_go_version(version))
+        else:
+            median = expected_duration(phase, 0.5, version, topology)
+        total += DEFAULT_PHASE_SECONDS[phase] if median is None else median
+    return total
+
+
+def bisect_rounds(candidates, ways=1):
+    """k 路二分在 candidates 个候选中定位 (包括 "没有问题" 这一结论) 所需的轮数"""
+    rounds, reach = 0, 1
+    while reach < candidates + 1:
+        reach *= ways + 1
+        rounds += 1
+    return rounds
+
+
+def update_eta(task_id, phase, remaining_probes, seconds):
+    tasks[task_id]['eta'] = {'phase': phase, 'remaining_probes': remaining_probes, 'seconds': round(seconds),
+                             'estimated_at': time.time()}
+
+
+def eta_view(task):
+    """/status 中的 ETA：扣除估计之后已经过去的时间"""
+    eta = task.get('eta')
+    if not eta or task.get('status') != 'running':
+        return None
+    remaining = max(0, eta['seconds'] - (time.time() - eta['estimated_at']))
+    return {'phase': eta['phase'], 'remaining_probes': eta['remaining_probes'],
+            'remaining_seconds': round(remaining), 'finish_at': time.time() + remaining}
+
+
+# --- 集群管理 ---
+# 每个 tiup playground 运行在独立的进程组中，按进程树整体回收；
+# 任务结束 (或丢失) 且租约过期的集群由后台线程定期回收。
+CLUSTER_LEASE_TTL = 3600  # 任务结束后集群最多保留的时间 (秒)，供用户连接排查
+CLUSTER_REAPER_INTERVAL = 60
+CLUSTER_READY_POLL_INTERVAL = 5  # 等待 TiDB 就绪时的轮询间隔 (秒)
+CLUSTER_READY_MAX_POLLS = 36  # 最多轮询次数，默认约 180 秒
+CLUSTER_REGISTRY_FILE = os.path.join('cache', 'clusters.json')
+CLUSTER_PROCESS_MARKERS = (b'playground', b'tidb-server', b'tikv-server', b'pd-server', b'tiflash')
+clusters = {}  # pid -> 集群信息
+clusters_lock = threading.Lock()
+reaper_lock = threading.Lock()
+reaper_thread = None
+registry_write_lock = threading.Lock()
+registry_dirty = threading.Event()
+reserved_port_offsets = {}  # port offset -> 预留时间，覆盖选定端口到集群登记之间的窗口
+PORT_OFFSET_RESERVATION = 600
+
+
+def _read_proc_stat(pid):
+    """读取 /proc/<pid>/stat 中进程名之后的字段"""
+    with open(f'/proc/{pid}/stat') as f:
+        return f.read().rsplit(')', 1)[1].split()
+
+
+def process_tree(pid):
+    """返回 pid 及其所有子孙进程 (仅 Linux 能获取子孙进程)"""
+    if not os.path.isdir('/proc'):
+        return [pid]
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            ppid = int(_read_proc_stat(entry)[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    tree, stack = [pid], [pid]
+    while stack:
+        for child in children.get(stack.pop(), []):
+            tree.append(child)
+            stack.append(child)
+    return tree
+
+
+def process_group_members(pgid):
+    """返回进程组 pgid 中仍然存在的进程 (tiup 退出后 tidb/tikv/pd 仍留在它的进程组中)"""
+    members = []
+    for entry in os.listdir('/proc') if os.path.isdir('/proc') else []:
+        if not entry.isdigit():
+            continue
+        try:
+            if int(_read_proc_stat(entry)[2]) == pgid:
+                members.append(int(entry))
+        except (OSError, IndexError, ValueError):
+            continue
+    return members
+
+
+def _wait_group_exit(pgid, timeout):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            os.killpg(pgid, 0)
+        except (ProcessLookupError, PermissionError):
+            return True
+        if time.time() >= deadline:
+            return False
+        time.sleep(0.2)
+
+
+def process_tree_usage(pid):
+    """统计进程树的常驻内存 (字节) 和累计 CPU 时间 (秒)"""
+    rss, cpu = 0, 0.0
+    page_size = os.sysconf('SC_PAGE_SIZE')
+    ticks = os.sysconf('SC_CLK_TCK')
+    for p in process_tree(pid):
+        try:
+            fields = _read_proc_stat(p)
+        except (OSError, IndexError):
+            continue
+        cpu += (int(fields[11]) + int(fields[12])) / ticks
+        rss += int(fields[21]) * page_size
+    return rss, cpu
+
+
+def _save_cluster_registry():
+    """把集群表写入磁盘；并发调用时合并为一个写入线程，由它写入最新状态"""
+    registry_dirty.set()
+    while registry_write_lock.acquire(blocking=False):
+        try:
+            while registry_dirty.is_set():
+                registry_dirty.clear()
+                with clusters_lock:
+                    data = {str(pid): {k: v for k, v in c.items()
+                                       if k not in ('process', 'log_offsets', 'log_required_matches')}
+                            for pid, c in clusters.items()}
+                _save_json_file(CLUSTER_REGISTRY_FILE, data)
+        finally:
+            registry_write_lock.release()
+        # 释放锁之前其他线程可能刚刚标记过，再检查一次避免丢失更新
+        if not registry_dirty.is_set():
+            return
+
+
+def _port_is_free(port):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        # 与 TiDB (Go) 监听时一样设置 SO_REUSEADDR，刚停止的集群遗留的 TIME_WAIT 连接不算占用
+        s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            s.bind(('127.0.0.1', port))
+            return True
+        except OSError:
+            return False
+
+
+def allocate_port_offset(preferred=None):
+    """选择一个未被其他集群使用的 port offset，避免并发探测连到别的任务的集群上；preferred 空闲时优先使用"""
+    now = time.time()
+    with clusters_lock:
+        for offset, reserved_at in list(reserved_port_offsets.items()):
+            if now - reserved_at > PORT_OFFSET_RESERVATION:
+                del reserved_port_offsets[offset]
+        used = {c['port_offset'] for c in clusters.values()} | set(reserved_port_offsets)
+        offset = preferred or random.randint(10000, 30000)
+        for _ in range(100):
+            if offset not in used and _port_is_free(4000 + offset):
+                break
+            offset = random.randint(10000, 30000)
+        reserved_port_offsets[offset] = now
+    return offset
+
+
+async def start_cluster(cmd, task_id, version, port_offset, log_file, log_filename, data_dir=None,
+                        resources=None):
+    """
+    在独立进程组中启动 tiup playground 并登记到集群表；data_dir 为 --tag 指定的数据目录，停止集群时删除。
+    resources 为准入时登记的内存和内存数据目录 (admit_cluster)，停止集群时一并释放。
+    进程是探测事件循环上的 asyncio 子进程，退出后 returncode 由事件循环更新。
+    """
+    process = await asyncio.create_subprocess_exec(*cmd, stdout=log_file, stderr=log_file,
+                                                   stdin=asyncio.subprocess.DEVNULL, start_new_session=True)
+    with clusters_lock:
+        clusters[process.pid] = {
+            'process': process, 'pid': process.pid, 'task_id': task_id, 'version': version,
+            'port_offset': port_offset, 'log_file': log_filename, 'started': time.time(),
+            'lease_until': time.time() + CLUSTER_LEASE_TTL, 'data_dir': data_dir, 'resources': resources,
+        }
+    await run_blocking(_save_cluster_registry)
+    ensure_cluster_reaper()
+    return process
+
+
+def _kill_tree(pid, pgid, timeout, wait):
+    """先向进程组发 SIGTERM，超时后 SIGKILL，最后清理逃出进程组的子孙进程"""
+    descendants = process_tree(pid)
+    try:
+        os.killpg(pgid, signal.SIGTERM)
+    except (ProcessLookupError, PermissionError):
+        pass
+    if not wait(timeout):
+        try:
+            os.killpg(pgid, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+        wait(10)
+    for p in descendants[1:]:
+        try:
+            os.kill(p, signal.SIGKILL)
+        except (ProcessLookupError, PermissionError):
+            pass
+
+
+def stop_cluster(process, timeout=30, keep_data=False):
+    """
+    停止一个 playground 及其全部子进程 (tidb/tikv/pd/tiflash)；keep_data 为 True 时保留 --tag 数据目录。
+    tiup 自己已经退出时它的子进程可能还在，所以总是向登记的进程组发信号，直到进程组为空。
+    """
+    if process is None:
+        return
+
+    def wait(t):
+        # process 是探测事件循环上的 asyncio 子进程，不能在这里 wait()，只能轮询事件循环更新的 returncode
+        deadline = time.time() + t
+        while process.returncode is None:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.2)
+        return _wait_group_exit(process.pid, max(0, deadline - time.time()))
+
+    _kill_tree(process.pid, process.pid, timeout, wait)
+    with clusters_lock:
+        removed = clusters.pop(process.pid, None)
+        if removed and not keep_data:
+            # 集群已拆除，端口可立即复用 (恢复数据快照需要同一个 port offset)
+            reserved_port_offsets.pop(removed['port_offset'], None)
+    if removed:
+        if not keep_data:
+            if removed.get('data_dir'):
+                shutil.rmtree(removed['data_dir'], ignore_errors=True)
+            release_cluster_resources(removed.get('resources'))
+        _save_cluster_registry()
+
+
+def reap_clusters():
+    """回收所属任务已丢失、或任务已结束且租约过期的集群，返回被回收的 pid 列表"""
+    now = time.time()
+    to_reap = []
+    with clusters_lock:
+        for pid, c in list(clusters.items()):
+            if c['process'].returncode is not None:
+                # tiup 已经退出，但它的子进程可能还留在进程组中，同样交给 stop_cluster 回收
+                to_reap.append(c['process'])
+                continue
+            task = tasks.get(c['task_id'])
+            if task and task.get('status') == 'running':
+                c['lease_until'] = now + CLUSTER_LEASE_TTL
+            elif not task or now > c['lease_until']:
+                to_reap.append(c['process'])
+    for process in to_reap:
+        print(f"🧹 回收集群 (PID: {process.pid})")
+        stop_cluster(process)  # 会更新磁盘上的登记表；没有回收任何集群时不写入
+    return [p.pid for p in to_reap]
+
+
+def reap_clusters_from_previous_run():
+    """服务异常退出后遗留的 playground 进程不在内存表中，根据磁盘上的登记表回收"""
+    for pid_str, c in _load_json_file(CLUSTER_REGISTRY_FILE, {}).items():
+        pid = int(pid_str)
+        with clusters_lock:
+            if pid in clusters:
+                continue
+        # tiup 本身可能已经退出，只要进程组里还有集群组件就整组回收 (pid 被复用时不会误杀无关进程)
+        cmdlines = []
+        for member in process_group_members(pid):
+            try:
+                with open(f'/proc/{member}/cmdline', 'rb') as f:
+                    cmdlines.append(f.read())
+            except OSError:
+                continue
+        if not any(marker in cmdline for cmdline in cmdlines for marker in CLUSTER_PROCESS_MARKERS):
+            continue
+        print(f"🧹 回收上次运行遗留的集群 (PID: {pid}, 版本: {c.get('version')})")
+        _kill_tree(pid, pid, 30, partial(_wait_group_exit, pid))
+        if c.get('data_dir'):
+            shutil.rmtree(c['data_dir'], ignore_errors=True)
+        release_cluster_resources(c.get('resources'))
+
+
+def ensure_cluster_reaper():
+    global reaper_thread
+    with reaper_lock:
+        if reaper_thread and reaper_thread.is_alive():
+            return
+
+        def loop():
+            reap_clusters_from_previous_run()
+            while True:
+                time.sleep(CLUSTER_REAPER_INTERVAL)
+                try:
+                    reap_clusters()
+                except Exception as e:
+                    print(f"⚠️ 回收集群时出错: {e}")
+
+        reaper_thread = threading.Thread(target=loop, daemon=True)
+        reaper_thread.start()
+
+
+def _count_queued_probes():
+    return sum(1 for t in list(tasks.values()) if t.get('status') == 'running'
+               for res in t.get('results', []) if not res)
+
+
+LIVE_CLUSTERS.set_function(lambda: sum(1 for c in list(clusters.values()) if c['process'].returncode is None))
+QUEUED_PROBES.set_function(_count_queued_probes)
+RUNNING_TASKS.set_function(lambda: sum(1 for t in list(tasks.values()) if t.get('status') == 'running'))
+
+
+def cluster_stats():
+    """当前存活集群的数量和资源占用"""
+    with clusters_lock:
+        live = [c for c in clusters.values() if c['process'].returncode is None]
+    items = []
+    for c in live:
+        rss, cpu = process_tree_usage(c['pid'])
+        items.append({'pid': c['pid'], 'task_id': c['task_id'], 'version': c['version'],
+                      'port_offset': c['port_offset'], 'uptime': round(time.time() - c['started']),
+                      'rss_mb': round(rss / 1024 / 1024, 1), 'cpu_seconds': round(cpu, 1),
+                      'reserved_mb': (c.get('resources') or {}).get('memory_mb'),
+                      'data_dir_medium': 'tmpfs' if (c.get('resources') or {}).get('ram_dir') else 'disk',
+                      'cpus': ((c.get('resources') or {}).get('isolation') or {}).get('cpus')})
+    with memory_lock:
+        reserved = sum(memory_reservations.values())
+    return {
+        'live_clusters': len(items),
+        'total_rss_mb': round(sum(i['rss_mb'] for i in items), 1),
+        'total_cpu_seconds': round(sum(i['cpu_seconds'] for i in items), 1),
+        'reserved_memory_mb': reserved,
+        'memory_budget_mb': memory_budget_mb(),
+        'clusters': items,
+    }
+
+
+def read_log_tail(log_path, max_bytes=8192):
+    """读取日志文件末尾的内容，用于判断启动失败原因"""
+    try:
+        with open(log_path, 'rb') as f:
+            f.seek(0, os.SEEK_END)
+            f.seek(max(0, f.tell() - max_bytes))
+            return f.read().decode('utf-8', errors='replace')
+    except OSError:
+        return ''
+
+
+# --- 数据快照 ---
+# 需要大量准备数据的复现拆分为 setup SQL 和检查 SQL。某个版本 (存储格式) 第一次执行 setup 成功后，
+# 停止集群并保存数据目录快照；之后的探测从快照恢复数据目录，不再重新执行 setup。
+# 快照按 commit 区分 (不同 commit 的 TiDB 可能写入不同的元数据)。PD/TiKV 在数据目录中记录了带端口的成员地址，
+# 因此快照只能恢复到保存时的 port offset 上；该 offset 被占用时重新执行 setup。
+TIUP_HOME = os.environ.get('TIUP_HOME') or os.path.join(os.path.expanduser('~'), '.tiup')
+TIUP_DATA_DIR = os.path.join(TIUP_HOME, 'data')
+# 与 playground 数据目录放在同一文件系统上，SST 文件才能使用硬链接
+SNAPSHOT_DIR = os.path.join(TIUP_HOME, 'probe_snapshots')
+SNAPSHOT_MAX_COUNT = 10
+# 写入后不再修改的文件 (RocksDB SST) 使用硬链接，其他文件 (WAL、raft log、MANIFEST 等) 会被追加写，必须复制
+SNAPSHOT_IMMUTABLE_SUFFIXES = ('.sst',)
+# 快照目录中记录保存时 port offset 的文件，恢复时不复制到数据目录
+SNAPSHOT_META = 'probe_snapshot.json'
+snapshot_lock = threading.Lock()
+
+
+def snapshot_key(version, setup_key, topology, commit=None):
+    parts = [version, setup_key, topology] + ([commit] if commit else [])
+    payload = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()[:16]
+
+
+def _link_or_copy(src, dst):
+    if src.endswith(SNAPSHOT_IMMUTABLE_SUFFIXES):
+        try:
+            os.link(src, dst)
+            return dst
+        except OSError:
+            pass  # 跨文件系统等情况退回复制
+    return shutil.copy2(src, dst)
+
+
+def snapshot_port_offset(key):
+    """返回快照保存时集群使用的 port offset；没有快照或快照缺少记录时返回 None"""
+    try:
+        with open(os.path.join(SNAPSHOT_DIR, key, SNAPSHOT_META), encoding='utf-8') as f:
+            return json.load(f)['port_offset']
+    except (OSError, ValueError, KeyError):
+        return None
+
+
+def restore_snapshot(key, data_dir, task_id, port_offset):
+    """把快照恢复到 data_dir，返回是否恢复成功；没有快照、port offset 不一致或恢复失败时 data_dir 为空"""
+    path = os.path.join(SNAPSHOT_DIR, key)
+    shutil.rmtree(data_dir, ignore_errors=True)
+    if not os.path.isdir(path):
+        return False
+    saved_offset = snapshot_port_offset(key)
+    if saved_offset != port_offset:
+        tasks[task_id]['log'].append(f"⚠️ 数据快照 {key} 保存于 port offset {saved_offset}，"
+                                     f"与本次集群 ({port_offset}) 不一致，将重新准备数据。")
+        return False
+    started = time.time()
+    try:
+        os.utime(path)  # 按最近使用时间淘汰
+        with trace_span(task_id, 'snapshot_restore', snapshot=key):
+            shutil.copytree(path, data_dir, copy_function=_link_or_copy,
+                            ignore=shutil.ignore_patterns(SNAPSHOT_META))
+    except OSError as e:
+        # 恢复过程中快照被淘汰等情况，退回执行 setup SQL
+        tasks[task_id]['log'].append(f"⚠️ 从数据快照 {key} 恢复失败: {e}，将重新准备数据。")
+        shutil.rmtree(data_dir, ignore_errors=True)
+        return False
+    tasks[task_id]['log'].append(f"📦 已从数据快照 {key} 恢复数据目录 ({time.time() - started:.1f} 秒)，跳过准备数据。")
+    return True
+
+
+def save_snapshot(key, data_dir, task_id, port_offset):
+    """保存已停止集群的数据目录及其 port offset；并发保存同一快照时保留先完成的"""
+    path = os.path.join(SNAPSHOT_DIR, key)
+    tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+        with trace_span(task_id, 'snapshot_save', snapshot=key):
+            shutil.copytree(data_dir, tmp_path, copy_function=_link_or_copy)
+            with open(os.path.join(tmp_path, SNAPSHOT_META), 'w', encoding='utf-8') as f:
+                json.dump({'port_offset': port_offset}, f)
+    except OSError as e:
+        # 快照只是加速手段，保存失败 (如磁盘空间不足) 不影响本次探测
+        tasks[task_id]['log'].append(f"⚠️ 保存数据快照 {key} 失败: {e}")
+        shutil.rmtree(tmp_path, ignore_errors=True)
+        return
+    with snapshot_lock:
+        if os.path.isdir(path):
+            if snapshot_port_offset(key) is not None:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                return
+            # 旧版本保存的快照没有记录 port offset，无法安全恢复，替换掉
+            shutil.rmtree(path, ignore_errors=True)
+        os.replace(tmp_path, path)
+        snapshots = sorted((e for e in os.scandir(SNAPSHOT_DIR) if e.is_dir() and not e.name.endswith('.tmp')),
+                           key=lambda e: e.stat().st_mtime)
+        for entry in snapshots[:-SNAPSHOT_MAX_COUNT]:
+            shutil.rmtree(entry.path, ignore_errors=True)
+    tasks[task_id]['log'].append(f"📦 已保存数据快照 {key}，后续探测将直接恢复。")
+
+
+# --- 内存准入与内存数据目录 ---
+# 探测集群用完即弃，数据目录可以放在大小受限的 tmpfs 上，避免大量集群同时启动时 fsync 打满磁盘。
+# 每个集群按拓扑估算进程内存和数据目录大小，启动前在内存预算内登记 (准入)，预算不足时等待其他集群停止；
+# 开启内存数据目录但内存放不下数据时退回磁盘。
+RAM_DATA_DIRS = os.environ.get('RAM_DATA_DIRS', '0') not in ('', '0', 'false')  # 请求未指定 ram_data_dir 时的默认值
+RAM_DATA_ROOT = os.environ.get('RAM_DATA_ROOT', '/dev/shm/tidb-probes')
+COMPONENT_MEMORY_MB = {'tidb': 512, 'tikv': 1024, 'pd': 256, 'tiflash': 1024}  # 每个组件进程的常驻内存估算
+COMPONENT_DATA_MB = {'tidb': 32, 'tikv': 256, 'pd': 64, 'tiflash': 256}  # 每个组件的数据目录 (含 WAL、日志) 估算
+FIXTURE_DATA_AMPLIFICATION = 2  # fixtures 导入后每个 TiKV 上的数据量约为原始文件的倍数
+RAM_DATA_SIZE_FACTOR = 2  # tmpfs 大小上限为数据目录估算值的倍数，超出后写入报 ENOSPC
+RAM_DATA_HEADROOM_MB = 1024  # 使用内存数据目录后 MemAvailable 至少保留的余量
+MEMORY_BUDGET_FRACTION = 0.8  # 未设置 MEMORY_BUDGET_MB 时，集群内存预算为 MemTotal 的比例
+MEMORY_BUDGET_MB = int(os.environ.get('MEMORY_BUDGET_MB') or 0)
+ADMISSION_POLL_INTERVAL = 1
+memory_reservations = {}  # reservation id -> 登记的内存 (MB)
+memory_lock = threading.Lock()
+
+
+def _meminfo_mb(field):
+    """读取 /proc/meminfo 中的字段 (MB)，非 Linux 返回 None"""
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith(f'{field}:'):
+                    return int(line.split()[1]) // 1024
+    except OSError:
+        pass
+    return None
+
+
+def memory_budget_mb():
+    if MEMORY_BUDGET_MB:
+        return MEMORY_BUDGET_MB
+    total = _meminfo_mb('MemTotal')
+    return int(total * MEMORY_BUDGET_FRACTION) if total else None
+
+
+def estimate_cluster_memory(topology, task_id):
+    """按拓扑和 fixtures 估算一个集群的 (进程内存, 数据目录大小)，单位 MB"""
+    process_mb = sum(COMPONENT_MEMORY_MB[c] * n for c, n in topology.items())
+    data_mb = sum(COMPONENT_DATA_MB[c] * n for c, n in topology.items())
+    fixture_bytes = sum(f['bytes'] for f in tasks[task_id]['probe_options'].get('fixtures') or [])
+    data_mb += FIXTURE_DATA_AMPLIFICATION * fixture_bytes * topology['tikv'] // (1024 * 1024)
+    return process_mb, data_mb
+
+
+def reserve_memory(need_mb):
+    """在预算内登记内存，返回 reservation id；预算不足返回 None。没有其他登记时总是放行，避免大集群永远无法启动"""
+    budget = memory_budget_mb()
+    with memory_lock:
+        if budget and memory_reservations and sum(memory_reservations.values()) + need_mb > budget:
+            return None
+        reservation = uuid4().hex
+        memory_reservations[reservation] = need_mb
+    return reservation
+
+
+def _mount_point(path):
+    """返回 path 所在的挂载点及文件系统类型"""
+    best, fstype = '/', None
+    try:
+        with open('/proc/mounts') as f:
+            for line in f:
+                fields = line.split()
+                mount = fields[1].replace('\\040', ' ')
+                if (path == mount or path.startswith(mount.rstrip('/') + '/')) and len(mount) >= len(best):
+                    best, fstype = mount, fields[2]
+    except OSError:
+        pass
+    return best, fstype
+
+
+def create_ram_data_dir(name, size_mb):
+    """
+    在 RAM_DATA_ROOT 下创建内存数据目录并返回路径，无法创建时返回 None。
+    有权限时挂载一个大小为 size_mb 的 tmpfs；否则 RAM_DATA_ROOT 本身在 tmpfs 上 (如 /dev/shm) 时直接使用子目录。
+    """
+    path = os.path.join(RAM_DATA_ROOT, name)
+    try:
+        os.makedirs(path, exist_ok=True)
+    except OSError:
+        return None
+    mounted = subprocess.run(['mount', '-t', 'tmpfs', '-o', f'size={size_mb}m,mode=0700', 'tmpfs', path],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0 \
+        if shutil.which('mount') and os.geteuid() == 0 else False
+    if not mounted and _mount_point(path)[1] != 'tmpfs':
+        shutil.rmtree(path, ignore_errors=True)
+        return None
+    os.makedirs(os.path.join(path, 'data'), exist_ok=True)
+    return path
+
+
+def remove_ram_data_dir(path):
+    if _mount_point(path)[0] == path:
+        subprocess.run(['umount', '-l', path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    shutil.rmtree(path, ignore_errors=True)
+
+
+def link_ram_data_dir(resources, data_dir):
+    """让 playground 的 --tag 数据目录 TIUP_DATA_DIR/<tag> 指向内存数据目录"""
+    os.makedirs(os.path.join(resources['ram_dir'], 'data'), exist_ok=True)
+    os.makedirs(TIUP_DATA_DIR, exist_ok=True)
+    if os.path.islink(data_dir):
+        os.unlink(data_dir)
+    shutil.rmtree(data_dir, ignore_errors=True)
+    os.symlink(os.path.join(resources['ram_dir'], 'data'), data_dir)
+    resources['link'] = data_dir
+
+
+def release_cluster_resources(resources):
+    """释放集群的内存登记和内存数据目录 (可重复调用)"""
+    if not resources:
+        return
+    with memory_lock:
+        memory_reservations.pop(resources['reservation'], None)
+    release_isolation(resources.get('isolation'))
+    if resources.get('link') and os.path.islink(resources['link']):
+        os.unlink(resources['link'])
+    if resources.get('ram_dir'):
+        remove_ram_data_dir(resources['ram_dir'])
+
+
+def _tree_size_mb(path):
+    """目录下文件实际占用的空间 (MB)"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total // (1024 * 1024)
+
+
+def finish_cluster_resources(resources):
+    """
+    探测结束时调用：集群已停止或没能启动时释放全部资源。集群保留给用户排查时仍在运行，
+    独占 CPU、cgroup 和内存数据目录都保留到集群停止 (stop_cluster / 回收) 时再释放；
+    登记的内存降为空闲集群实际占用的内存 (进程常驻内存加内存数据目录)，估算偏大的部分不再阻塞其他集群的准入。
+    """
+    with clusters_lock:
+        cluster = next((c for c in clusters.values()
+                        if (c.get('resources') or {}).get('reservation') == resources['reservation']), None)
+    if cluster is None:
+        release_cluster_resources(resources)
+        return
+    rss, _ = process_tree_usage(cluster['pid'])
+    used_mb = rss // (1024 * 1024) + (_tree_size_mb(resources['ram_dir']) if resources.get('ram_dir') else 0)
+    with memory_lock:
+        if resources['reservation'] in memory_reservations:
+            memory_reservations[resources['reservation']] = min(memory_reservations[resources['reservation']],
+                                                                used_mb)
+
+
+async def admit_cluster(task_id, topology, log_message):
+    """
+    集群启动前的内存准入，返回资源登记 {'reservation', 'memory_mb', 'ram_dir'}。
+    开启 ram_data_dir 且内存充足时 ram_dir 为 tmpfs 目录，--tag 数据目录通过符号链接指向它 (link_ram_data_dir)；
+    否则 ram_dir 为 None，数据目录留在磁盘上。预算不足时等待其他集群停止。
+    """
+    process_mb, data_mb = estimate_cluster_memory(topology, task_id)
+    use_ram = tasks[task_id]['probe_options'].get('ram_data_dir')
+    waiting = False
+    while True:
+        check_cancelled(task_id)
+        available = _meminfo_mb('MemAvailable')
+        if use_ram and available is not None and available - process_mb - data_mb >= RAM_DATA_HEADROOM_MB:
+            reservation = reserve_memory(process_mb + data_mb)
+            if reservation:
+                ram_dir = await run_blocking(create_ram_data_dir, f"probe-{reservation[:12]}",
+                                             data_mb * RAM_DATA_SIZE_FACTOR)
+                if ram_dir:
+                    tasks[task_id]['log'].append(f"💾 {log_message}: 数据目录放在内存中 ({ram_dir}，上限 "
+                                                 f"{data_mb * RAM_DATA_SIZE_FACTOR} MB)。")
+                    return {'reservation': reservation, 'memory_mb': process_mb + data_mb, 'ram_dir': ram_dir}
+                release_cluster_resources({'reservation': reservation})
+                tasks[task_id]['log'].append(f"⚠️ {log_message}: 无法在 {RAM_DATA_ROOT} 创建 tmpfs 数据目录，"
+                                             f"退回磁盘。")
+                use_ram = False
+        reservation = reserve_memory(process_mb)
+        if reservation:
+            if use_ram:
+                tasks[task_id]['log'].append(f"⚠️ {log_message}: 可用内存或集群内存预算不足以再容纳约 {data_mb} MB "
+                                             f"的数据目录，数据目录退回磁盘。")
+            return {'reservation': reservation, 'memory_mb': process_mb, 'ram_dir': None}
+        if not waiting:
+            waiting = True
+            with memory_lock:
+                reserved = sum(memory_reservations.values())
+            tasks[task_id]['log'].append(f"⏳ {log_message}: 集群内存预算不足 (已登记 {reserved} MB，预算 "
+                                         f"{memory_budget_mb()} MB，需要 {process_mb} MB)，等待其他集群停止...")
+        await async_sleep_or_cancel(task_id, ADMISSION_POLL_INTERVAL)
+
+
+# --- CPU 与 cgroup 隔离 ---
+# 并发的集群和编译争抢同一批 CPU 时，启动耗时波动很大，探测中测到的耗时也无法比较。开启隔离 (cpu_isolation) 后，
+# 每个集群 (和每次编译) 按拓扑独占一组 CPU，并尽量放在同一个 NUMA 节点内。有 cgroup v2 时放进独立的 cgroup，
+# 设置 cpuset 和 memory.max；没有 cgroup v2 或没有权限时退回 taskset 绑核。空闲 CPU 不够时不绑核，与其他集群共享。
+CPU_ISOLATION = os.environ.get('CPU_ISOLATION', '0') not in ('', '0', 'false')  # 请求未指定 cpu_isolation 时的默认值
+CGROUP_ROOT = os.environ.get('PROBE_CGROUP_ROOT', '/sys/fs/cgroup/tidb-probes')
+NUMA_NODE_DIR = '/sys/devices/system/node'
+COMPONENT_CPUS = {'tidb': 2, 'tikv': 2, 'pd': 1, 'tiflash': 2}  # 每个组件独占的 CPU 数
+BUILD_CPUS = 4
+BUILD_MEMORY_MB = 8192
+CGROUP_MEMORY_FACTOR = 1.5  # memory.max 为估算内存的倍数，估算偏小时不至于被 OOM kill
+cpu_assignments = {}  # owner -> 独占的 CPU 列表
+cpu_lock = threading.Lock()
+cgroup_ready = None  # None 表示还没有检查过
+
+
+def parse_cpu_list(text):
+    """解析 '0-3,8-11' 格式的 CPU / NUMA 节点列表"""
+    items = []
+    for part in text.strip().split(','):
+        if part:
+            low, _, high = part.partition('-')
+            items.extend(range(int(low), int(high or low) + 1))
+    return items
+
+
+def format_cpu_list(items):
+    """parse_cpu_list 的逆操作，连续的编号合并为区间"""
+    ranges = []
+    for item in sorted(items):
+        if ranges and item == ranges[-1][1] + 1:
+            ranges[-1][1] = item
+        else:
+            ranges.append([item, item])
+    return ','.join(str(low) if low == high else f"{low}-{high}" for low, high in ranges)
+
+
+def numa_nodes():
+    """返回 {NUMA 节点: 本进程可用的 CPU 列表}；没有 NUMA 信息时视为一个节点"""
+    allowed = os.sched_getaffinity(0)
+    nodes = {}
+    try:
+        for entry in os.listdir(NUMA_NODE_DIR):
+            if entry.startswith('node') and entry[4:].isdigit():
+                with open(os.path.join(NUMA_NODE_DIR, entry, 'cpulist')) as f:
+                    cpus = [c for c in parse_cpu_list(f.read()) if c in allowed]
+                if cpus:
+                    nodes[int(entry[4:])] = cpus
+    except (OSError, ValueError):
+        nodes = {}
+    return nodes or {0: sorted(allowed)}
+
+
+def allocate_cpus(owner, count):
+    """
+    为 owner 分配 count 个独占 CPU，返回 (CPU 列表, NUMA 节点列表)；空闲 CPU 不足时返回 (None, None)。
+    优先放进一个放得下的 NUMA 节点 (选空闲 CPU 最少的，减少碎片)，否则从空闲最多的节点开始跨节点分配。
+    """
+    nodes = numa_nodes()
+    count = min(count, sum(len(cpus) for cpus in nodes.values()))  # 整机 CPU 比需求少时独占整机
+    with cpu_lock:
+        used = {c for cpus in cpu_assignments.values() for c in cpus}
+        free = {node: [c for c in cpus if c not in used] for node, cpus in nodes.items()}
+        fitting = [node for node, cpus in free.items() if len(cpus) >= count]
+        if fitting:
+            node = min(fitting, key=lambda n: (len(free[n]), n))
+            chosen, chosen_nodes = free[node][:count], [node]
+        elif sum(len(cpus) for cpus in free.values()) >= count:
+            chosen, chosen_nodes = [], []
+            for node in sorted(free, key=lambda n: (-len(free[n]), n)):
+                take = free[node][:count - len(chosen)]
+                if take:
+                    chosen += take
+                    chosen_nodes.append(node)
+        else:
+            return None, None
+        cpu_assignments[owner] = chosen
+    return chosen, chosen_nodes
+
+
+def _write_cgroup_file(path, name, value):
+    with open(os.path.join(path, name), 'w') as f:
+        f.write(str(value))
+
+
+def cgroup_v2_ready():
+    """第一次调用时在 CGROUP_ROOT 的父 cgroup 中开启 cpuset 和 memory 控制器并创建 CGROUP_ROOT，返回是否可用"""
+    global cgroup_ready
+    with cpu_lock:
+        if cgroup_ready is None:
+            parent = os.path.dirname(CGROUP_ROOT)
+            try:
+                with open(os.path.join(parent, 'cgroup.controllers')) as f:
+                    controllers = set(f.read().split())
+                if not {'cpuset', 'memory'} <= controllers:
+                    raise OSError(f"{parent} 没有 cpuset / memory 控制器")
+                _write_cgroup_file(parent, 'cgroup.subtree_control', '+cpuset +memory')
+                os.makedirs(CGROUP_ROOT, exist_ok=True)
+                _write_cgroup_file(CGROUP_ROOT, 'cgroup.subtree_control', '+cpuset +memory')
+                cgroup_ready = True
+            except OSError as e:
+                print(f"⚠️ 无法使用 cgroup v2 ({CGROUP_ROOT}): {e}，退回 taskset 绑核。")
+                cgroup_ready = False
+        return cgroup_ready
+
+
+def assign_isolation(owner, cpu_count, memory_mb):
+    """
+    为一个集群或一次编译分配独占 CPU 和内存上限，返回写入探测结果的隔离记录
+    {'owner', 'cpus', 'numa_nodes', 'memory_max_mb', 'cgroup'}。空闲 CPU 不足时 cpus 为 None；
+    没有 cgroup v2 时 cgroup 和 memory_max_mb 为 None。
+    """
+    cpus, nodes = allocate_cpus(owner, cpu_count)
+    isolation = {'owner': owner, 'cpus': format_cpu_list(cpus) if cpus else None, 'numa_nodes': nodes,
+                 'memory_max_mb': int(memory_mb * CGROUP_MEMORY_FACTOR), 'cgroup': None}
+    if cgroup_v2_ready():
+        path = os.path.join(CGROUP_ROOT, owner)
+        try:
+            os.makedirs(path, exist_ok=True)
+            if cpus:
+                _write_cgroup_file(path, 'cpuset.cpus', isolation['cpus'])
+                _write_cgroup_file(path, 'cpuset.mems', format_cpu_list(nodes))
+            _write_cgroup_file(path, 'memory.max', isolation['memory_max_mb'] * 1024 * 1024)
+            isolation['cgroup'] = path
+        except OSError as e:
+            print(f"⚠️ 创建 cgroup {path} 失败: {e}，退回 taskset 绑核。")
+            _remove_cgroup(path)
+    if not isolation['cgroup']:
+        isolation['memory_max_mb'] = None  # 只有 cgroup 能限制内存
+    return isolation
+
+
+def isolated_command(isolation, cmd):
+    """按隔离记录包装启动命令：先把 shell 自己移入 cgroup 再 exec，之后启动的所有子进程都留在 cgroup 中"""
+    if not isolation:
+        return cmd
+    if isolation['cgroup']:
+        return ['sh', '-c', 'echo $$ > "$0" && exec "$@"', os.path.join(isolation['cgroup'], 'cgroup.procs')] + cmd
+    if isolation['cpus'] and shutil.which('taskset'):
+        return ['taskset', '-c', isolation['cpus']] + cmd
+    return cmd
+
+
+def _remove_cgroup(path):
+    # 进程刚被杀掉时 cgroup 可能还没有清空，稍等后重试
+    for _ in range(20):
+        try:
+            os.rmdir(path)
+            return
+        except FileNotFoundError:
+            return
+        except OSError:
+            time.sleep(0.1)
+
+
+def release_isolation(isolation):
+    """归还独占 CPU 并删除 cgroup (可重复调用)"""
+    if not isolation:
+        return
+    with cpu_lock:
+        cpu_assignments.pop(isolation['owner'], None)
+    if isolation['cgroup']:
+        _remove_cgroup(isolation['cgroup'])
+
+
+def describe_isolation(isolation):
+    if isolation['cpus']:
+        text = f"独占 CPU {isolation['cpus']} (NUMA 节点 {format_cpu_list(isolation['numa_nodes'])})"
+    else:
+        text = "空闲 CPU 不足，不绑核"
+    if isolation['cgroup']:
+        return f"{text}，cgroup {isolation['cgroup']}，内存上限 {isolation['memory_max_mb']} MB"
+    return text + ("，taskset 绑核" if isolation['cpus'] else "")
+
+
+# --- 探测事件循环 ---
+# 所有探测都作为协程运行在同一个事件循环线程上：启动集群、等待就绪、退避都不占用线程；
+# playground、编译命令 (run_command) 和检查脚本都是事件循环上的 asyncio 子进程，等待它们也不占用线程。
+# 只有阻塞调用放到有界线程池中执行：集群清理、缓存落盘在 probe_executor 中，
+# 用户 SQL、setup / fixture 导入和日志检查可能运行很久，放在单独的 query_executor 中，
+# 慢查询占满线程时不会拖住集群的启动和回收；并发执行的 SQL 因此最多 PROBE_QUERY_WORKERS 条。
+# 线程池中的线程按需创建，空闲的探测服务不会常驻上百个线程
+PROBE_BLOCKING_WORKERS = 64
+PROBE_QUERY_WORKERS = 64
+probe_loop = None
+probe_loop_lock = threading.Lock()
+probe_executor = ThreadPoolExecutor(max_workers=PROBE_BLOCKING_WORKERS, thread_name_prefix='probe-blocking')
+query_executor = ThreadPoolExecutor(max_workers=PROBE_QUERY_WORKERS, thread_name_prefix='probe-query')
+
+
+def ensure_probe_loop():
+    global probe_loop
+    with probe_loop_lock:
+        if probe_loop is None:
+            probe_loop = asyncio.new_event_loop()
+            threading.Thread(target=probe_loop.run_forever, name='probe-loop', daemon=True).start()
+    return probe_loop
+
+
+def run_on_probe_loop(coro):
+    """从 Flask 路由或二分查找线程提交协程，返回 concurrent.futures.Future"""
+    return asyncio.run_coroutine_threadsafe(coro, ensure_probe_loop())
+
+
+async def run_blocking(func, *args):
+    """在线程池中执行阻塞调用，保留当前协程的 trace lane"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(probe_executor, partial(context.run, func, *args))
+
+
+async def run_query(func, *args):
+    """与 run_blocking 相同，但在 query_executor 中执行：用于 SQL、检查脚本等耗时不可控的调用"""
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(query_executor, partial(context.run, func, *args))
+
+
+async def async_sleep_or_cancel(task_id, seconds, step=0.5):
+    """可被取消打断的 asyncio.sleep"""
+    deadline = time.time() + seconds
+    while True:
+        check_cancelled(task_id)
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return
+        await asyncio.sleep(min(step, remaining))
+
+
+async def tidb_accepts_connections(port, timeout=5):
+    """TiDB 就绪后才会监听并发送握手包；只读取握手包头，不占用 MySQL 客户端连接"""
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    try:
+        header = await asyncio.wait_for(reader.readexactly(5), timeout)
+        return header[4] == 0x0a  # 握手包的 protocol version
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError):
+        return False
+    finally:
+        writer.close()
+
+
+# --- 分布式 worker agent ---
+# agent (agent.py) 注册并发容量后通过 HTTP 轮询领取探测任务 (编译 commit、启动集群、执行 SQL / 检查脚本)，
+# 并把日志和结果回传。有 agent 在线时探测全部派发给 agent 执行，commit 二分按 agent 总容量做 k 路并行。
+AGENT_TIMEOUT = 60  # 超过该时间未轮询的 agent 视为离线，它正在执行的探测重新排队
+AGENT_POLL_INTERVAL = 2
+MAX_BISECT_WAYS = 8
+agents = {}  # agent_id -> agent 信息
+agent_jobs = {}  # job_id -> 等待结果的探测
+agent_job_queue = deque()
+agents_lock = threading.Lock()
+results_lock = threading.Lock()
+
+
+class AgentsUnavailable(Exception):
+    """所有 agent 都已离线，排队中的探测无人领取，由调用方改在本机执行"""
+
+
+def new_result_slot(task_id):
+    """为一次探测分配结果槽位，k 路并行探测时多个线程会同时分配"""
+    with results_lock:
+        tasks[task_id]['results'].append({})
+        return len(tasks[task_id]['results']) - 1
+
+
+def _expire_agents(now):
+    """调用方需持有 agents_lock：移除超时的 agent，把它正在执行的探测放回队首"""
+    for agent_id, agent in list(agents.items()):
+        if now - agent['last_seen'] <= AGENT_TIMEOUT:
+            continue
+        del agents[agent_id]
+        for job_id in agent['jobs']:
+            job = agent_jobs.get(job_id)
+            if job and not job['future'].done():
+                job['agent_id'] = None
+                agent_job_queue.appendleft(job_id)
+                tasks[job['task_id']]['log'].append(f"⚠️ agent {agent['name']} 已离线，探测 {job['label']} 重新排队。")
+    if not agents and agent_jobs:
+        # 队列已经没有消费者：结束所有等待中的探测，调用方捕获 AgentsUnavailable 后在本机执行
+        for job in list(agent_jobs.values()):
+            if not job['future'].done():
+                job['future'].set_exception(AgentsUnavailable(f"探测 {job['label']} 没有在线的 agent 可以执行"))
+        agent_jobs.clear()
+        agent_job_queue.clear()
+
+
+def agent_capacity():
+    """在线 agent 的总并发容量；为 0 时探测在本机执行"""
+    with agents_lock:
+        _expire_agents(time.time())
+        return sum(a['capacity'] for a in agents.values())
+
+
+def bisect_ways():
+    return max(1, min(MAX_BISECT_WAYS, agent_capacity()))
+
+
+def submit_remote_probe(task_id, index, version, commit, sql, expected_sql_result, other_check_script, cases=None,
+                        topology=None):
+    """
+    把一次探测 (commit 不为空时包含编译) 放入 agent 队列。
+    返回的 Future 在结果写入 results[index] 后完成，结果即 test_single_version 写入的 result_data。
+    """
+    job_id = str(uuid4())
+    label = version + (f"-{commit[:7]}" if commit else "")
+    job = {'job_id': job_id, 'task_id': task_id, 'index': index, 'label': label, 'agent_id': None,
+           'future': Future(), 'queued': time.time(),
+           'payload': {'job_id': job_id, 'version': version, 'commit': commit, 'sql': sql,
+                       'expected_sql_result': expected_sql_result, 'other_check_script': other_check_script,
+                       'topology': dict(topology or task_topology(task_id)), 'cases': cases,
+                       'probe_options': tasks[task_id].get('probe_options', {})}}
+    with agents_lock:
+        if is_cancelled(task_id):
+            # cancel_remote_jobs 可能已经执行过，不再入队
+            job['future'].set_result({'version': label, 'status': 'Cancelled'})
+            return job['future']
+        _expire_agents(time.time())
+        if not agents:
+            job['future'].set_exception(AgentsUnavailable(f"探测 {label} 没有在线的 agent 可以执行"))
+            return job['future']
+        agent_jobs[job_id] = job
+        agent_job_queue.append(job_id)
+    tasks[task_id]['log'].append(f"📤 探测 {label} 已加入 agent 队列。")
+    return job['future']
+
+
+def wait_remote_probe(future):
+    """等待 agent 的结果；等待期间定期检查 agent 是否超时，全部离线时抛出 AgentsUnavailable"""
+    while True:
+        try:
+            return future.result(timeout=AGENT_POLL_INTERVAL)
+        except FutureTimeout:
+            agent_capacity()
+
+
+async def wait_remote_probe_async(future):
+    wrapped = asyncio.wrap_future(future)
+    while True:
+        done, _ = await asyncio.wait({wrapped}, timeout=AGENT_POLL_INTERVAL)
+        if done:
+            return wrapped.result()
+        await run_blocking(agent_capacity)
+
+
+def _finish_remote_job(job, result):
+    """调用方需持有 agents_lock"""
+    agent_jobs.pop(job['job_id'], None)
+    agent = agents.get(job['agent_id'])
+    if agent:
+        agent['jobs'].discard(job['job_id'])
+    tasks[job['task_id']]['results'][job['index']] = result
+    if not job['future'].done():
+        job['future'].set_result(result)
+
+
+def cancel_remote_jobs(task_id):
+    """任务取消时结束它在 agent 队列中的探测，并在下次轮询时通知正在执行的 agent"""
+    with agents_lock:
+        for job in [j for j in agent_jobs.values() if j['task_id'] == task_id]:
+            agent = agents.get(job['agent_id'])
+            if agent:
+                agent['cancel'].add(job['job_id'])
+            _finish_remote_job(job, {'version': job['label'], 'status': 'Cancelled'})
+
+
+def probe_on_agent(task_id, index, version, commit, sql, expected_sql_result, other_check_script):
+    """同步等待 agent 完成探测，供二分查找线程调用；返回结果状态，所有 agent 都离线时返回 None，由调用方在本机执行"""
+    try:
+        result = wait_remote_probe(submit_remote_probe(task_id, index, version, commit, sql, expected_sql_result,
+                                                       other_check_script))
+    except AgentsUnavailable as e:
+        tasks[task_id]['log'].append(f"⚠️ {e}，改在本机执行。")
+        return None
+    store_verdict(verdict_key(version, commit, sql, expected_sql_result, other_check_script,
+                              task_topology(task_id), probe_extra_key(task_id)), result)
+    return result.get('status')
+
+
 def test_single_version(version, sql, expected_sql_result, other_check_script, task_id, index, cleanup_after=False,
-                        commit='', binary_path=None):
-    port_offset = random.randint(10000, 30000)
+                        commit='', binary_path=None, cases=None, topology=None):
+    """同步入口：在探测事件循环上执行一次探测并等待结束，供二分查找线程调用"""
+    run_on_probe_loop(probe_version(version, sql, expected_sql_result, other_check_script, task_id, index,
+                                    cleanup_after, commit, binary_path, cases, topology)).result()
+
+
+async def probe_version(version, sql, expected_sql_result, other_check_script, task_id, index, cleanup_after=False,
+                        commit='', binary_path=None, cases=None, topology=None):
+    topology = topology or task_topology(task_id)
+    trace_lane.set(f"probe {version}" + (f" {commit[:7]}" if commit else "")
+                   + (f" {topology_label(topology)}" if topology != task_topology(task_id) else ""))
+    with trace_span(task_id, 'probe', version=version, commit=commit, topology=topology_label(topology)) as span:
+        await _probe_version(version, sql, expected_sql_result, other_check_script, task_id, index, cleanup_after,
+                             commit, binary_path, cases, topology)
+        if span:
+            span['attrs']['status'] = tasks[task_id]['results'][index].get('status')
+
+
+async def launch_cluster(task_id, index, version, commit, binary_path, port_offset, log_filename, log_message,
+                         topology, tag=None, resources=None, durations=None):
+    """
+    启动 playground 并等待 TiDB 就绪，失败时按错误类型重试。
+    tag 不为空时使用 --tag 指定的数据目录 (可由快照恢复或指向内存数据目录)，重试时保留该目录。
+    resources 为准入时登记的资源，登记到集群表，随集群停止释放。
+    topology 为组件数量 {'tidb', 'tikv', 'pd', 'tiflash'}。
+    等待上限由耗时模型中同类集群的启动耗时推断，第 n 次尝试放宽到 n 倍；就绪耗时记入耗时模型和 durations['boot']。
+    返回集群进程；启动失败或任务取消时写入 results[index] 并返回 None。
+    启动超时说明不了是否复现问题 (可能只是下载或机器慢)，结果记为 Skip；其他启动失败记为 Failure。
+    """
+    label = f"{version}-{commit}" if commit else version
+    topology_name = topology_label(topology)
     sql_port = 4000 + port_offset
-    dashboard_port = 2379 + port_offset
-    log_dir = "logs"
-    os.makedirs(log_dir, exist_ok=True)
-    log_filename = f"{log_dir}/task_{task_id[:8]}_{version}_{commit[:7] if commit else ''}.log"
-
-    log_message = f"版本 {version}" + (f" (commit {commit[:7]})" if commit else "")
-    tasks[task_id]['log'].append(f"{log_message}: 准备启动集群 (SQL Port: {sql_port})...")
-    result_data = {'version': f"{version}-{commit}" if commit else version}
     process = None
     log_file = None
-    startup_success = False
     MAX_STARTUP_RETRIES = 3
+    deadline, p99 = startup_deadline(version, topology_name)
+    tasks[task_id]['log'].append(
+        f"⏲️ {log_message}: 启动等待上限 {deadline:.0f} 秒"
+        + (f" (历史启动耗时 p99 {p99:.1f} 秒 × {STARTUP_DEADLINE_FACTOR})。" if p99 is not None else " (样本不足，使用默认值)。"))
 
     for attempt in range(1, MAX_STARTUP_RETRIES + 1):
         log_file = None
+        timed_out = False
+        attempt_span = begin_span(task_id, 'cluster_start', attempt=attempt, sql_port=sql_port,
+                                  topology=topology_name)
+        ready_span = None
         try:
-            # 清理上一次失败的进程
-            if process and process.poll() is None:
-                process.terminate()
-                process.wait(timeout=10)
+            # 清理上一次失败的进程；保留 --tag 数据目录和准入登记的资源，重试时继续使用
+            if process:
+                await run_blocking(stop_cluster, process, 10, True)
 
             log_file = open(log_filename, 'w', encoding='utf-8')
             # 如果提供了 binary_path (来自编译)，则使用 --db.binpath 启动
             if commit and binary_path:
                 cmd = ['tiup', 'playground', f'--db.binpath={binary_path}', version, f'--port-offset={port_offset}',
-                   '--without-monitor', '--kv', str(COMPONENT_COUNTS['tikv']), '--tiflash',
-                   str(COMPONENT_COUNTS['tiflash']),
-                   '--pd', str(COMPONENT_COUNTS['pd']), '--db', str(COMPONENT_COUNTS['tidb'])]
+                   '--without-monitor', '--kv', str(topology['tikv']), '--tiflash',
+                   str(topology['tiflash']),
+                   '--pd', str(topology['pd']), '--db', str(topology['tidb'])]
             else:
                 cmd = ['tiup', 'playground', version, f'--port-offset={port_offset}', '--without-monitor',
-                   '--kv', str(COMPONENT_COUNTS['tikv']), '--tiflash', str(COMPONENT_COUNTS['tiflash']),
-                   '--pd', str(COMPONENT_COUNTS['pd']), '--db', str(COMPONENT_COUNTS['tidb'])]
-
-            process = subprocess.Popen(cmd, stdout=log_file, stderr=log_file, text=True, encoding='utf-8')
+                   '--kv', str(topology['tikv']), '--tiflash', str(topology['tiflash']),
+                   '--pd', str(topology['pd']), '--db', str(topology['tidb'])]
+            if tag:
+                cmd.append(f'--tag={tag}')
+            cmd = isolated_command((resources or {}).get('isolation'), cmd)
+
+            process = await start_cluster(cmd, task_id, version, port_offset, log_file, log_filename,
+                                          os.path.join(TIUP_DATA_DIR, tag) if tag else None, resources)
+            started = time.time()
             if attempt == 1:
                 tasks[task_id]['processes'].append(
                     {'version': version, 'process': process, 'offset': port_offset, 'log_file': log_filename})
@@ -433,90 +2789,500 @@ def test_single_version(version, sql, expected_sql_result, other_check_script, t
             f"{log_message}: 集群启动尝试 {attempt}/{MAX_STARTUP_RETRIES} (PID: {process.pid}, SQL Port: {sql_port})...")
 
             ready = False
-            for _ in range(36):  # Wait up to 180 seconds
-                time.sleep(5)
-                try:
-                    conn = mysql.connector.connect(host='127.0.0.1', port=sql_port, user='root', password='',
-                                               connection_timeout=5)
-                    conn.close()
+            ready_span = begin_span(task_id, 'readiness_wait', pid=process.pid, deadline=deadline * attempt)
+            while time.time() - started < deadline * attempt:
+                await async_sleep_or_cancel(task_id, CLUSTER_READY_POLL_INTERVAL)
+                if await tidb_accepts_connections(sql_port):
                     ready = True
+                    elapsed = time.time() - started
+                    CLUSTER_READY_SECONDS.labels(version, topology_name).observe(elapsed)
+                    await run_blocking(record_duration, 'boot', elapsed, version, topology_name)
+                    if durations is not None:
+                        durations['boot'] = round(elapsed, 3)
                     tasks[task_id]['log'].append(f"✅ {log_message}: TiDB 服务在端口 {sql_port} 上已就绪。")
                     break
-                except mysql.connector.Error:
-                    if process.poll() is not None:
-                        raise Exception(f"TiUP 进程意外退出。请检查日志: {log_filename}")
+                if process.returncode is not None:
+                    raise Exception(f"TiUP 进程意外退出。请检查日志: {log_filename}")
+            end_span(ready_span, ready=ready)
             if not ready:
-                raise Exception("TiDB 服务启动超时")
-            startup_success = True
-            break  # 成功，跳出重试循环
+                timed_out = True
+                raise Exception(f"TiDB 服务启动超时 ({deadline * attempt:.0f} 秒)")
+            return process
+        except TaskCancelled:
+            tasks[task_id]['log'].append(f"🛑 {log_message}: 任务已取消，停止集群启动。")
+            tasks[task_id]['results'][index] = {'version': label, 'status': 'Cancelled'}
+            await run_blocking(stop_cluster, process)
+            return None
         except Exception as e:
-            error_msg = f"❌ 集群启动尝试 {attempt}/{MAX_STARTUP_RETRIES} 失败: {e}"
-            tasks[task_id]['log'].append(error_msg)
             if log_file: log_file.close()
-            if attempt < MAX_STARTUP_RETRIES:
-                time.sleep(5)
+            end_span(ready_span, error=str(e))
+            end_span(attempt_span, error=str(e))
+            # 结合 tiup 日志末尾判断失败类型：版本不存在等确定性错误无需再重试
+            failure_class = classify_failure(Exception(f"{e}\n{read_log_tail(log_filename)}"))
+            record_retry(task_id, 'cluster_startup', failure_class)
+            STARTUP_FAILURES_TOTAL.labels(version, topology_name).inc()
+            error_msg = f"❌ 集群启动尝试 {attempt}/{MAX_STARTUP_RETRIES} 失败 ({failure_class}): {e}"
+            tasks[task_id]['log'].append(error_msg)
+            if attempt < MAX_STARTUP_RETRIES and failure_class != 'deterministic' and not is_cancelled(task_id):
+                await asyncio.sleep(compute_backoff(attempt, 5))
             else:  # 所有重试失败
-                result_data = {'version': version, 'status': 'Failure',
-                               'error': f"集群启动在 {MAX_STARTUP_RETRIES} 次尝试后失败: {e}"}
-                tasks[task_id]['results'][index] = result_data
-                if process: process.terminate()
-                return  # 退出函数
+                tasks[task_id]['results'][index] = {'version': version, 'status': 'Skip' if timed_out else 'Failure',
+                                                    'error': f"集群启动在 {attempt} 次尝试后失败: {e}"}
+                await run_blocking(stop_cluster, process)
+                return None
         finally:
             if log_file: log_file.close()
+            end_span(ready_span)
+            end_span(attempt_span)
 
-        tasks[task_id]['processes'].append(
-            {'version': version, 'process': process, 'offset': port_offset, 'log_file': log_filename})
-        tasks[task_id]['log'].append(f"{log_message}: 集群进程已启动 (PID: {process.pid})，等待服务就绪...")
+        if process:
+            tasks[task_id]['processes'].append(
+                {'version': version, 'process': process, 'offset': port_offset, 'log_file': log_filename})
+            tasks[task_id]['log'].append(f"{log_message}: 集群进程已启动 (PID: {process.pid})，等待服务就绪...")
 
+
+async def _probe_version(version, sql, expected_sql_result, other_check_script, task_id, index, cleanup_after,
+                         commit, binary_path, cases, topology):
+    """cases 不为空时为用例集模式：在同一个集群上并发执行全部用例，结果不进入探测结果缓存"""
+    if is_cancelled(task_id):
+        tasks[task_id]['results'][index] = {'version': f"{version}-{commit}" if commit else version,
+                                            'status': 'Cancelled'}
+        return
+    if cases is None and fill_from_verdict_cache(task_id, index, version, commit, sql, expected_sql_result,
+                                                 other_check_script, topology):
+        return
+    cache_key = None if cases is not None else verdict_key(version, commit, sql, expected_sql_result,
+                                                           other_check_script, topology, probe_extra_key(task_id))
+    topology_name = topology_label(topology)
+    if not binary_path and agent_capacity():
+        try:
+            result_data = await wait_remote_probe_async(submit_remote_probe(task_id, index, version, commit, sql,
+                                                                            expected_sql_result, other_check_script,
+                                                                            cases, topology))
+        except AgentsUnavailable as e:
+            tasks[task_id]['log'].append(f"⚠️ {e}，改在本机执行。")
+        else:
+            if cache_key:
+                await run_blocking(store_verdict, cache_key, result_data)
+            return
+
+    log_message = f"版本 {version}" + (f" (commit {commit[:7]})" if commit else "")
     try:
+        with trace_span(task_id, 'admission', topology=topology_name):
+            resources = await admit_cluster(task_id, topology, log_message)
+    except TaskCancelled:
+        tasks[task_id]['results'][index] = {'version': f"{version}-{commit}" if commit else version,
+                                            'status': 'Cancelled'}
+        return
+    if tasks[task_id]['probe_options'].get('cpu_isolation'):
+        resources['isolation'] = await run_blocking(
+            assign_isolation, f"probe-{resources['reservation'][:12]}",
+            sum(COMPONENT_CPUS[c] * n for c, n in topology.items()), resources['memory_mb'])
+        tasks[task_id]['log'].append(f"🧷 {log_message}: {describe_isolation(resources['isolation'])}。")
+    setup_key = probe_setup_key(task_id)
+    snapshot = snapshot_key(version, setup_key, topology, commit) if setup_key else None
+    # 已有快照时尽量使用保存快照时的 port offset，PD/TiKV 的成员地址才能对上
+    preferred_offset = await run_blocking(snapshot_port_offset, snapshot) if snapshot else None
+    port_offset = await run_blocking(allocate_port_offset, preferred_offset)
+    sql_port = 4000 + port_offset
+    dashboard_port = 2379 + port_offset
+    log_dir = "logs"
+    os.makedirs(log_dir, exist_ok=True)
+    log_filename = f"{log_dir}/task_{task_id[:8]}_{version}_{commit[:7] if commit else ''}_{topology_name}.log"
+
+    tasks[task_id]['log'].append(f"{log_message}: 准备启动集群 (SQL Port: {sql_port})...")
+    tag, restored = None, False
+    if setup_key or resources['ram_dir']:
+        tag = f"probe-{task_id[:8]}-{port_offset}"
+        data_dir = os.path.join(TIUP_DATA_DIR, tag)
+    if snapshot:
+        restored = await run_blocking(restore_snapshot, snapshot,
+                                      os.path.join(resources['ram_dir'], 'data') if resources['ram_dir']
+                                      else data_dir, task_id, port_offset)
+    if resources['ram_dir']:
+        await run_blocking(link_ram_data_dir, resources, data_dir)
+    result_data = {'version': f"{version}-{commit}" if commit else version}
+    if tasks[task_id]['probe_options'].get('ram_data_dir'):
+        result_data['data_dir_medium'] = 'tmpfs' if resources['ram_dir'] else 'disk'
+    if resources.get('isolation'):
+        result_data['isolation'] = resources['isolation']
+    if commit and commit in tasks[task_id].get('build_isolation', {}):
+        result_data['build_isolation'] = tasks[task_id]['build_isolation'][commit]
+    durations = {}
+    if commit and commit in tasks[task_id].get('build_seconds', {}):
+        durations['compile'] = tasks[task_id]['build_seconds'][commit]
+    process = await launch_cluster(task_id, index, version, commit, binary_path, port_offset, log_filename,
+                                   log_message, topology, tag, resources, durations)
+    if process is None:
+        await run_blocking(finish_cluster_resources, resources)
+        return
+
+    try:
+        check_cancelled(task_id)
         if commit:
-            v_result, success = run_sql_on_tidb('select tidb_version();', sql_port)
+            with trace_span(task_id, 'version_check', commit=commit):
+                v_result, success = await run_query(run_sql_on_tidb, 'select tidb_version();', sql_port)
             if not success or commit not in ''.join(v_result.split()):
                 raise Exception(f"TiDB binary 版本不正确! 期望包含 {commit[:10]}, 实际为 {v_result}")
             tasks[task_id]['log'].append("✅ TiDB binary 版本检查通过。")
 
-        # --- 执行检查 ---
-        sql_check_passed, other_check_passed = None, None
-        final_status = "Success"
-
-        if expected_sql_result is not None:
-            actual_sql_result, success = run_sql_on_tidb(sql, sql_port)
-            result_data.update({'expected_sql': expected_sql_result, 'actual_sql': actual_sql_result})
-            if expected_sql_result.strip():
-                if ''.join(expected_sql_result.split()) in ''.join(actual_sql_result.split()):
-                    sql_check_passed = True
-                else:
-                    sql_check_passed = False
-            else:
-                # if expected is empty，then sql executed success means check pass.
-                if success:
-                    print("expected sql is empty, and sql executed success")
-                    sql_check_passed = True
-                else:
-                    sql_check_passed = False
-
-        if other_check_script.strip():
-            other_status, other_output = run_other_check(other_check_script, sql_port, task_id)
-            result_data.update({'other_check_status': other_status, 'other_check_output': other_output})
-            other_check_passed = (other_status == "Success")
+        if setup_key and not restored:
+            check_cancelled(task_id)
+            options = tasks[task_id]['probe_options']
+            if options.get('setup_sql'):
+                # setup 通常是大量建表 / 导数语句，不受检查 SQL 的超时限制
+                with trace_span(task_id, 'setup_sql'):
+                    _, setup_output, success = await run_query(execute_batched_sql, options['setup_sql'],
+                                                               sql_port)
+                if not success:
+                    raise Exception(f"setup SQL 执行失败: {setup_output}")
+            if options.get('fixtures'):
+                result_data['fixture_load'] = await run_query(load_fixtures, options['fixtures'], sql_port,
+                                                              task_id)
+            tasks[task_id]['log'].append(f"✅ {log_message}: 准备数据完成，停止集群并保存数据快照...")
+            # 停止集群后数据目录处于一致状态，快照后在同一数据目录上重新启动
+            await run_blocking(stop_cluster, process, 30, True)
+            await run_blocking(save_snapshot, snapshot, data_dir, task_id, port_offset)
+            process = await launch_cluster(task_id, index, version, commit, binary_path, port_offset, log_filename,
+                                           log_message, topology, tag, resources, durations)
+            if process is None:
+                await run_blocking(finish_cluster_resources, resources)
+                return
 
-        if sql_check_passed is False or other_check_passed is False:
-            final_status = "Failure"
+        # --- 执行检查 ---
+        # 不稳定问题模式下在同一个集群上重复检查，直到序贯概率比检验得出结论或达到重复上限。
+        # 默认每次检查都在 test 库中执行，与 setup / fixture 建的表在同一个库；开启 flaky_isolate_db 时
+        # 每次检查在新建的数据库 flaky_trial_<n> 中执行，上一次检查留下的表和数据不会影响下一次
+        flaky = tasks[task_id]['probe_options'].get('flaky')
+        sprt = SequentialProbabilityRatioTest(**flaky) if flaky and cases is None else None
+        evidence = None
+        while True:
+            sql_check_passed, other_check_passed = None, None
+            final_status = "Success"
+            database = 'test'
+            if sprt and tasks[task_id]['probe_options'].get('flaky_isolate_db'):
+                database = f"flaky_trial_{sprt.trials}"
+                _, success = await run_query(run_sql_on_tidb, [f"DROP DATABASE IF EXISTS `{database}`",
+                                                               f"CREATE DATABASE `{database}`"], sql_port)
+                if not success:
+                    raise Exception(f"创建检查数据库 {database} 失败")
+
+            if expected_sql_result is not None:
+                check_cancelled(task_id)
+                options = tasks[task_id].get('probe_options', {})
+                sql_started = time.time()
+                with SQL_SECONDS.labels(version, topology_name).time(), trace_span(task_id, 'sql'):
+                    actual_sql_result, success = await run_query(
+                        run_sql_on_tidb, sql, sql_port, options.get('statement_timeout') or STATEMENT_TIMEOUT,
+                        options.get('probe_timeout') or PROBE_TIMEOUT, database)
+                durations['sql'] = round(time.time() - sql_started, 3)
+                await run_blocking(record_duration, 'sql', durations['sql'], version, topology_name)
+                result_data.update({'expected_sql': expected_sql_result, 'actual_sql': actual_sql_result})
+                sql_check_passed = sql_result_matches(expected_sql_result, actual_sql_result, success)
+
+            if cases:
+                check_cancelled(task_id)
+                with trace_span(task_id, 'suite', cases=len(cases)):
+                    case_results = await run_suite_cases(cases, sql_port, task_id, version, topology_name)
+                result_data['cases'] = case_results
+                sql_check_passed = all(c['status'] == 'Success' for c in case_results.values())
+
+            if other_check_script.strip():
+                check_cancelled(task_id)
+                check_started = time.time()
+                with CHECK_SCRIPT_SECONDS.labels(version, topology_name).time(), \
+                        trace_span(task_id, 'check_script'):
+                    other_status, other_output = await run_other_check(other_check_script, sql_port, task_id,
+                                                                       database)
+                durations['check'] = round(time.time() - check_started, 3)
+                await run_blocking(record_duration, 'check', durations['check'], version, topology_name)
+                result_data.update({'other_check_status': other_status, 'other_check_output': other_output})
+                other_check_passed = (other_status == "Success")
+
+            log_check_passed = None
+            log_checks = tasks[task_id]['probe_options'].get('log_checks')
+            if log_checks:
+                check_cancelled(task_id)
+                with trace_span(task_id, 'log_check'):
+                    log_status, log_results = await run_query(check_cluster_logs, process.pid, sql_port,
+                                                              log_checks, task_id)
+                result_data.update({'log_check_status': log_status, 'log_check_results': log_results})
+                log_check_passed = (log_status == "Success")
+
+            if sql_check_passed is False or other_check_passed is False or log_check_passed is False:
+                final_status = "Failure"
+
+            if sprt is None:
+                break
+            reproduced = final_status == "Failure"
+            decision = sprt.add(reproduced)
+            if reproduced and evidence is None:
+                evidence = dict(result_data)  # 保留第一次复现时的输出
+            tasks[task_id]['log'].append(f"🔁 {log_message}: 第 {sprt.trials} 次检查"
+                                         f"{'复现' if reproduced else '未复现'} (LLR={sprt.llr:.2f})。")
+            if decision:
+                break
+            check_cancelled(task_id)
+
+        if sprt:
+            PROBE_TRIALS.observe(sprt.trials)
+            final_status = sprt.status()
+            if final_status == "Failure" and evidence:
+                result_data.update(evidence)
+            result_data['sprt'] = sprt.summary()
+            icon = {'Failure': '❌', 'Success': '✅'}.get(final_status, '❔')
+            tasks[task_id]['log'].append(f"{icon} {log_message}: {sprt.trials} 次检查中复现 {sprt.failures} 次，"
+                                         f"结论 {final_status}。")
 
         result_data.update({'status': final_status, 'sql_port': sql_port, 'dashboard_port': dashboard_port})
+    except TaskCancelled:
+        tasks[task_id]['log'].append(f"🛑 {log_message}: 任务已取消。")
+        result_data = {'version': result_data['version'], 'status': 'Cancelled'}
+    except ProbeTimeout as e:
+        tasks[task_id]['log'].append(f"⏱️ {log_message}: {e}")
+        result_data = {'version': result_data['version'], 'status': 'Timeout', 'error': str(e),
+                       'sql_port': sql_port, 'dashboard_port': dashboard_port}
     except Exception as e:
         error_msg = f"测试 {log_message} 时发生错误: {e}"
         tasks[task_id]['log'].append(f"❌ {error_msg}")
         result_data = {'version': version, 'status': 'Failure', 'error': str(e)}
     finally:
-        if cleanup_after and process:
+        if is_cancelled(task_id):
+            await run_blocking(stop_cluster, process)
+        elif cleanup_after and process:
             tasks[task_id]['log'].append(f"{log_message}: 测试完成，清理集群 (PID: {process.pid})...")
-            process.terminate()
-            process.wait()
-
+            with trace_span(task_id, 'teardown', pid=process.pid):
+                await run_blocking(stop_cluster, process)
+        await run_blocking(finish_cluster_resources, resources)
+
+    if durations:
+        result_data['durations'] = durations
+    if cache_key:
+        await run_blocking(store_verdict, cache_key, result_data)
     tasks[task_id]['results'][index] = result_data
 
 
+# --- 不稳定问题的序贯检验 (SPRT) ---
+# 偶发问题单次检查的结论不可信：在同一个集群上重复检查，把每次是否复现计入对数似然比 (LLR)。
+# H1 (有问题) 下每次检查复现的概率为 repro_rate，H0 (没有问题) 下为 false_alarm_rate。
+# LLR 超过 ln((1-β)/α) 判为 Failure，低于 ln(β/(1-α)) 判为 Success，达到重复上限仍未越界则为 Inconclusive。
+FLAKY_REPRO_RATE = 0.3
+FLAKY_CONFIDENCE = 0.95
+FLAKY_MAX_REPEATS = 20
+
+
+class SequentialProbabilityRatioTest:
+    def __init__(self, repro_rate=FLAKY_REPRO_RATE, false_alarm_rate=0.0, confidence=FLAKY_CONFIDENCE,
+                 max_repeats=FLAKY_MAX_REPEATS):
+        alpha = beta = 1 - confidence
+        self.upper = math.log((1 - beta) / alpha)
+        self.lower = math.log(beta / (1 - alpha))
+        # 误报率为 0 时一次复现即可下结论；复现率为 1 时一次未复现即可下结论
+        self.reproduced_llr = math.log(repro_rate / false_alarm_rate) if false_alarm_rate else math.inf
+        self.passed_llr = math.log((1 - repro_rate) / (1 - false_alarm_rate)) if repro_rate < 1 else -math.inf
+        self.max_repeats = max_repeats
+        self.trials = 0
+        self.failures = 0
+        self.llr = 0.0
+
+    def add(self, reproduced):
+        """记录一次检查结果，得出结论时返回 'bad' / 'good' / 'inconclusive'，否则返回 None"""
+        self.trials += 1
+        self.failures += int(reproduced)
+        self.llr += self.reproduced_llr if reproduced else self.passed_llr
+        return self.decision()
+
+    def decision(self):
+        if self.llr >= self.upper:
+            return 'bad'
+        if self.llr <= self.lower:
+            return 'good'
+        if self.trials >= self.max_repeats:
+            return 'inconclusive'
+        return None
+
+    def status(self):
+        return {'bad': 'Failure', 'good': 'Success'}.get(self.decision(), 'Inconclusive')
+
+    def summary(self):
+        return {'trials': self.trials, 'failures': self.failures, 'decision': self.decision(),
+                # JSON 不支持 inf，用字符串表示
+                'llr': round(self.llr, 3) if math.isfinite(self.llr) else str(self.llr),
+                'bounds': [round(self.lower, 3), round(self.upper, 3)]}
+
+
+def parse_flaky_options(data):
+    """解析不稳定问题模式的参数，未开启时返回 None；参数不合法时抛出 ValueError"""
+    if data.get('flaky') in (None, False, 'false', '0', 0, ''):
+        return None
+    try:
+        options = {
+            'repro_rate': float(data.get('flaky_repro_rate') or FLAKY_REPRO_RATE),
+            'false_alarm_rate': float(data.get('flaky_false_alarm_rate') or 0),
+            'confidence': float(data.get('flaky_confidence') or FLAKY_CONFIDENCE),
+            'max_repeats': int(data.get('flaky_max_repeats') or FLAKY_MAX_REPEATS),
+        }
+    except (TypeError, ValueError):
+        raise ValueError("flaky_* 参数必须是数字")
+    if not 0 <= options['false_alarm_rate'] < options['repro_rate'] <= 1:
+        raise ValueError("需满足 0 <= flaky_false_alarm_rate < flaky_repro_rate <= 1")
+    if not 0.5 < options['confidence'] < 1:
+        raise ValueError("flaky_confidence 必须在 (0.5, 1) 之间")
+    if options['max_repeats'] < 1:
+        raise ValueError("flaky_max_repeats 至少为 1")
+    return options
+
+
+# --- 用例集 ---
+# 一个版本只启动一次集群，用例通过连接池并发执行，每个用例使用独立的数据库互不干扰
+SUITE_CONCURRENCY = 8
+SUITE_MAX_CASES = 2000
+
+
+def parse_suite_cases(raw):
+    """解析用例列表 [{name, sql, expected_sql_result?, other_check_script?}]，格式错误时抛出 ValueError"""
+    if not isinstance(raw, list) or not raw:
+        raise ValueError("cases 必须是非空的用例列表")
+    if len(raw) > SUITE_MAX_CASES:
+        raise ValueError(f"用例数超过上限 {SUITE_MAX_CASES}")
+    cases, names = [], set()
+    for i, case in enumerate(raw):
+        if not isinstance(case, dict) or not str(case.get('sql') or '').strip():
+            raise ValueError(f"第 {i + 1} 个用例缺少 sql")
+        name = str(case.get('name') or f"case-{i + 1}").strip()
+        if name in names:
+            raise ValueError(f"用例名称重复: {name}")
+        names.add(name)
+        cases.append({'name': name, 'sql': case['sql'],
+                      'expected_sql_result': str(case.get('expected_sql_result') or '').strip(),
+                      'other_check_script': str(case.get('other_check_script') or '').strip()})
+    return cases
+
+
+async def run_suite_case(case, database, pool, port, task_id):
+    """在独立数据库中执行单个用例，返回用例结果"""
+    options = tasks[task_id].get('probe_options', {})
+    result = {'database': database}
+    try:
+        _, success = await run_query(partial(
+            run_sql_on_tidb, [f"DROP DATABASE IF EXISTS `{database}`", f"CREATE DATABASE `{database}`"], port,
+            pool=pool))
+        if not success:
+            raise Exception(f"创建用例数据库 {database} 失败")
+        actual, success = await run_query(partial(
+            run_sql_on_tidb, case['sql'], port, options.get('statement_timeout') or STATEMENT_TIMEOUT,
+            options.get('probe_timeout') or PROBE_TIMEOUT, database=database, pool=pool))
+        result.update({'expected_sql': case['expected_sql_result'], 'actual_sql': actual})
+        passed = sql_result_matches(case['expected_sql_result'], actual, success)
+        if case['other_check_script']:
+            other_status, other_output = await run_other_check(case['other_check_script'], port, task_id, database)
+            result.update({'other_check_status': other_status, 'other_check_output': other_output})
+            passed = passed and other_status == "Success"
+        result['status'] = "Success" if passed else "Failure"
+    except ProbeTimeout as e:
+        result.update({'status': 'Timeout', 'error': str(e)})
+    except Exception as e:
+        result.update({'status': 'Failure', 'error': str(e)})
+    return result
+
+
+async def run_suite_cases(cases, port, task_id, version, topology_name):
+    """在已启动的集群上并发执行用例集，返回 {用例名: 结果}"""
+    concurrency = min(tasks[task_id]['probe_options'].get('suite_concurrency') or SUITE_CONCURRENCY, len(cases))
+    pool = SuiteConnectionPool(port)
+    semaphore = asyncio.Semaphore(concurrency)
+    results = {}
+
+    async def run_case(i, case):
+        async with semaphore:
+            check_cancelled(task_id)
+            trace_lane.set(f"case {version} {case['name']}")
+            with SQL_SECONDS.labels(version, topology_name).time(), trace_span(task_id, 'case', case=case['name']):
+                results[case['name']] = await run_suite_case(case, f"suite_case_{i}", pool, port, task_id)
+
+    tasks[task_id]['log'].append(f"🧪 版本 {version}: 开始执行 {len(cases)} 个用例 (并发 {concurrency})...")
+    try:
+        await asyncio.gather(*(run_case(i, case) for i, case in enumerate(cases)))
+    finally:
+        await run_blocking(pool.close)
+    failed = [name for name, r in results.items() if r['status'] != 'Success']
+    tasks[task_id]['log'].append(f"{'❌' if failed else '✅'} 版本 {version}: 用例 {len(cases) - len(failed)}/"
+                                 f"{len(cases)} 通过" + (f"，失败: {', '.join(failed[:20])}" if failed else "。"))
+    return {case['name']: results[case['name']] for case in cases if case['name'] in results}
+
+
+# --- 拓扑推断 ---
+# 开启 auto_topology 时，根据探测 SQL、setup SQL、用例、检查脚本和日志检查推断能复现问题的最小拓扑：
+# TiFlash 启动最慢、最占内存，只有用到 TiFlash 时才启动；放置规则、多副本、store 相关的问题才需要多个 TiKV。
+# Docker 后端 (仓库根目录的 app.py) 复制了 TOPOLOGY_RULES 和副本数推断，修改时两边同步。
+MINIMAL_TOPOLOGY = {'tidb': 1, 'tikv': 1, 'pd': 1, 'tiflash': 0}
+# (组件, 最少数量, 正则, 原因)
+TOPOLOGY_RULES = [
+    ('tiflash', 1, re.compile(r'tiflash', re.IGNORECASE), '用到了 TiFlash (副本、引擎或 hint)'),
+    ('tiflash', 1, re.compile(r'(?<![a-z])mpp(?![a-z])', re.IGNORECASE), '用到了 MPP 执行'),
+    ('tikv', 3, re.compile(r'placement\s+policy|primary_region|survival_preferences|constraints\s*=',
+                           re.IGNORECASE), '用到了放置规则，默认 3 副本分布在不同 store 上'),
+    ('tikv', 3, re.compile(r'tikv_store_status|tikv_region_peers|scatter|transfer.?leader|store_id|max.replicas',
+                           re.IGNORECASE), '依赖多个 TiKV store 或多副本'),
+    ('tikv', 3, re.compile(r'(?:kill|stop|pause)\S*\s+.{0,40}tikv', re.IGNORECASE),
+     '检查脚本会停止 TiKV 节点，需要多副本继续服务'),
+    ('pd', 3, re.compile(r'(?:transfer|resign).{0,20}pd.{0,10}leader|pd.{0,10}leader.{0,20}(?:transfer|resign)',
+                         re.IGNORECASE), '需要切换 PD leader'),
+    ('tidb', 2, re.compile(r'ddl.?owner|resign.?owner', re.IGNORECASE), '需要在多个 TiDB 之间切换 DDL owner'),
+]
+PLACEMENT_PEERS_RE = re.compile(r'\b(followers|learners)\s*=\s*(\d+)', re.IGNORECASE)
+
+
+def infer_topology(texts, log_checks=None):
+    """根据 SQL / 脚本文本和日志检查推断最小拓扑，返回 (拓扑, 原因列表)"""
+    text = '\n'.join(t for t in texts if t)
+    topology = dict(MINIMAL_TOPOLOGY)
+    reasons = []
+
+    def need(component, count, reason):
+        if topology[component] < count:
+            topology[component] = count
+        reasons.append(f"{component} ≥ {count}: {reason}")
+
+    for component, count, pattern, reason in TOPOLOGY_RULES:
+        match = pattern.search(text)
+        if match:
+            need(component, count, f"{reason} ({match.group(0).strip()[:40]})")
+    # 显式指定副本数时，每个 follower / learner 需要一个独立的 store
+    peers = {'followers': 0, 'learners': 0}
+    for kind, count in PLACEMENT_PEERS_RE.findall(text):
+        peers[kind.lower()] = max(peers[kind.lower()], int(count))
+    if peers['followers'] or peers['learners']:
+        need('tikv', 1 + peers['followers'] + peers['learners'],
+             f"放置规则要求 {peers['followers']} 个 follower、{peers['learners']} 个 learner")
+    for check in log_checks or []:
+        # 只检查部分组件的规则才说明用户关心这些组件 (不限组件的规则默认包含全部组件)
+        if 'tiflash' in check['components'] and len(check['components']) < len(LOG_CHECK_COMPONENTS):
+            need('tiflash', 1, f"日志检查需要 TiFlash 日志 ({check['pattern'][:40]})")
+    if not reasons:
+        reasons.append('没有发现需要 TiFlash、多个 TiKV 或其他额外组件的特性，使用最小拓扑')
+    return topology, reasons
+
+
+def infer_request_topology(data):
+    """请求开启 auto_topology 时推断拓扑，返回 {'topology', 'reasons'}；未开启时返回 None"""
+    if data.get('auto_topology') in (None, False, 'false', '0', 0):
+        return None
+    cases = data.get('cases') if isinstance(data.get('cases'), list) else []
+    texts = [data.get('sql'), data.get('setup_sql'), data.get('other_check_script')]
+    texts += [case.get('sql') for case in cases if isinstance(case, dict)]
+    texts += [case.get('other_check_script') for case in cases if isinstance(case, dict)]
+    topology, reasons = infer_topology(texts, parse_log_checks(data.get('log_checks')))
+    return {'topology': topology, 'reasons': reasons}
+
+
+def log_topology_inference(task_id, inference):
+    if inference:
+        tasks[task_id]['topology_inference'] = inference
+        tasks[task_id]['log'].append(f"🧭 自动选择拓扑 {topology_label(inference['topology'])}: "
+                                     + '；'.join(inference['reasons']))
+
+
 # --- 路由 ---
 @app.route('/locales/<path:filename>')
 def serve_locales(filename):
@@ -534,46 +3300,166 @@ def locate_page():
     return render_template('locate.html')
 
 
+def parse_probe_options(data):
+    """解析请求中与探测行为相关的选项"""
+    return {
+        'force_reprobe': bool(data.get('force_reprobe')),
+        'verdict_max_age': int(data.get('verdict_max_age') or 0) or None,
+        'statement_timeout': float(data.get('statement_timeout') or 0) or None,
+        'probe_timeout': float(data.get('probe_timeout') or 0) or None,
+        'timeout_is_bad': data.get('timeout_is_bad', True) not in (False, 'false', '0', 0),
+        # 只需执行一次的建表 / 导数 SQL 和 fixtures，导入后的数据目录会被快照复用
+        'setup_sql': (data.get('setup_sql') or '').strip(),
+        'fixtures': save_fixtures(data.get('fixtures')),
+        'log_checks': parse_log_checks(data.get('log_checks')),
+        # 偶发问题：每次探测重复检查，按序贯概率比检验给出结论
+        'flaky': parse_flaky_options(data),
+        # 偶发问题模式下每次检查使用独立的数据库 (setup / fixture 的表需写成 test.<表名>)
+        'flaky_isolate_db': bool(data.get('flaky_isolate_db')),
+        # 集群数据目录放在 tmpfs 上，内存不足时退回磁盘
+        'ram_data_dir': data.get('ram_data_dir', RAM_DATA_DIRS) not in (False, 'false', '0', 0),
+        # 每个集群 / 编译独占一组 CPU，有 cgroup v2 时同时限制内存
+        'cpu_isolation': data.get('cpu_isolation', CPU_ISOLATION) not in (False, 'false', '0', 0),
+    }
+
+
+def parse_topology(data, base=None):
+    """解析组件数量，未指定的组件沿用 base (默认 COMPONENT_COUNTS)"""
+    base = base or COMPONENT_COUNTS
+    try:
+        topology = {component: int(base[component] if data.get(component) in (None, '') else data[component])
+                    for component in COMPONENT_COUNTS}
+    except (TypeError, ValueError):
+        raise ValueError(f"组件数量必须是整数: {data}")
+    if min(topology['tidb'], topology['tikv'], topology['pd']) < 1 or topology['tiflash'] < 0:
+        raise ValueError(f"TiDB / TiKV / PD 至少为 1，TiFlash 不能为负数: {data}")
+    return topology
+
+
+def parse_topologies(data, inference=None):
+    """
+    解析任务的拓扑列表。请求中带 topologies 时为矩阵模式 (版本 × 拓扑)，列表中每项只需写出与页面上
+    组件数量不同的组件；重复的拓扑只保留一个，相同 (版本, 拓扑) 的单元格共用一个集群。
+    inference 为自动推断的拓扑 (infer_request_topology)，非矩阵模式时代替页面上的组件数量。
+    """
+    if inference and not data.get('topologies'):
+        return [inference['topology']]
+    base = parse_topology(data)
+    raw = data.get('topologies')
+    if not raw:
+        return [base]
+    if not isinstance(raw, list) or not all(isinstance(item, dict) for item in raw):
+        raise ValueError("topologies 必须是组件数量的列表，如 [{\"tikv\": 1}, {\"tikv\": 3, \"tiflash\": 1}]")
+    topologies = {}
+    for item in raw:
+        topology = parse_topology(item, base)
+        topologies.setdefault(topology_label(topology), topology)
+    return list(topologies.values())
+
+
+def cell_label(version, topology, topologies):
+    """矩阵中单元格的列名：只有一个拓扑时就是版本号"""
+    return version if len(topologies) == 1 else f"{version} {topology_label(topology)}"
+
+
+async def probe_cells(task_id, cells, probe):
+    """并发探测 (版本, 拓扑) 单元格，probe(index, version, topology) 返回协程"""
+    outcomes = await asyncio.gather(*(probe(i, version, topology) for i, (version, topology) in enumerate(cells)),
+                                    return_exceptions=True)
+    topologies = tasks[task_id]['topologies']
+    for i, ((version, topology), outcome) in enumerate(zip(cells, outcomes)):
+        if isinstance(outcome, BaseException):
+            tasks[task_id]['log'].append(f"❌ {cell_label(version, topology, topologies)} 探测异常退出: {outcome}")
+        if len(topologies) > 1:
+            tasks[task_id]['results'][i]['topology'] = topology_label(topology)
+
+
 @app.route('/start_test', methods=['POST'])
 def start_test():
-    global COMPONENT_COUNTS
     data = request.json
     selected_versions = data.get('versions', [])
     sql = data.get('sql')
     expected_sql = data.get('expected_sql_result', '').strip()
     other_script = data.get('other_check_script', '').strip()
 
-    COMPONENT_COUNTS = {
-        'tidb': int(data.get('tidb') or COMPONENT_COUNTS['tidb']),
-        'tikv': int(data.get('tikv') or COMPONENT_COUNTS['tikv']),
-        'pd': int(data.get('pd') or COMPONENT_COUNTS['pd']),
-        'tiflash': int(data.get('tiflash') or COMPONENT_COUNTS['tiflash'])
-    }
+    try:
+        inference = infer_request_topology(data)
+        topologies = parse_topologies(data, inference)
+        probe_options = parse_probe_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
+    cells = [(version, topology) for topology in topologies for version in selected_versions]
     task_id = str(uuid4())
-    tasks[task_id] = {'status': 'running', 'log': [], 'results': [{} for _ in selected_versions], 'processes': [],
-                      'type': 'test'}
+    tasks[task_id] = {'status': 'running', 'log': TaskLog(task_id), 'results': [{} for _ in cells], 'processes': [],
+                      'type': 'test', 'probe_options': probe_options, 'topology': topologies[0],
+                      'topologies': topologies}
     session.setdefault('task_ids', []).append(task_id)
     session.modified = True
+    if not data.get('topologies'):
+        log_topology_inference(task_id, inference)
+
+    async def run_probes():
+        await probe_cells(task_id, cells, lambda i, version, topology: probe_version(
+            version, sql, expected_sql, other_script, task_id, i, False, '', topology=topology))
+        if len(topologies) > 1:
+            # 拓扑 × 版本 矩阵
+            matrix = {topology_label(t): {} for t in topologies}
+            for (version, topology), result in zip(cells, tasks[task_id]['results']):
+                matrix[topology_label(topology)][version] = result.get('status')
+            tasks[task_id]['matrix'] = matrix
+        if not is_cancelled(task_id):
+            tasks[task_id]['status'] = 'complete'
+
+    run_on_probe_loop(run_probes())
 
-    threads = []
-    for i, version in enumerate(selected_versions):
-        thread = threading.Thread(target=test_single_version,
-                                  args=(version, sql, expected_sql, other_script, task_id, i, False, ''))
-        threads.append(thread)
-        thread.start()
+    return jsonify({'task_id': task_id})
 
-    def wait_for_completion():
-        for t in threads:
-            t.join()
-        tasks[task_id]['status'] = 'complete'
 
-    threading.Thread(target=wait_for_completion).start()
+@app.route('/start_suite', methods=['POST'])
+def start_suite():
+    """用例集模式：每个 (版本, 拓扑) 启动一个集群，执行全部用例，结果为 用例 × 版本 矩阵"""
+    data = request.json
+    selected_versions = data.get('versions', [])
+    suite_check = data.get('other_check_script', '').strip()
 
-    return jsonify({'task_id': task_id})
+    try:
+        inference = infer_request_topology(data)
+        topologies = parse_topologies(data, inference)
+        cases = parse_suite_cases(data.get('cases'))
+        probe_options = parse_probe_options(data)
+        probe_options['suite_concurrency'] = int(data.get('suite_concurrency') or SUITE_CONCURRENCY)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    cells = [(version, topology) for topology in topologies for version in selected_versions]
+    task_id = str(uuid4())
+    tasks[task_id] = {'status': 'running', 'log': TaskLog(task_id), 'results': [{} for _ in cells], 'processes': [],
+                      'type': 'suite', 'probe_options': probe_options, 'matrix': {}, 'topology': topologies[0],
+                      'topologies': topologies}
+    session.setdefault('task_ids', []).append(task_id)
+    session.modified = True
+    if not data.get('topologies'):
+        log_topology_inference(task_id, inference)
 
+    async def run_suite():
+        await probe_cells(task_id, cells, lambda i, version, topology: probe_version(
+            version, '', None, suite_check, task_id, i, False, '', cases=cases, topology=topology))
+        # 启动失败等没有用例结果的单元格，所有用例都记为该单元格的状态
+        tasks[task_id]['matrix'] = {
+            case['name']: {cell_label(version, topology, topologies):
+                           result.get('cases', {}).get(case['name'], {}).get('status', result.get('status'))
+                           for (version, topology), result in zip(cells, tasks[task_id]['results'])}
+            for case in cases}
+        if not is_cancelled(task_id):
+            tasks[task_id]['status'] = 'complete'
 
-def run_binary_search_with_version(start_v_str, end_v_str, sql, expected_sql, other_check, task_id):
+    run_on_probe_loop(run_suite())
+
+    return jsonify({'task_id': task_id, 'cases': len(cases)})
+
+
+def run_binary_search_with_version(start_v_str, end_v_str, sql, expected_sql, other_check, task_id, path_filters=None):
     """二分查找逻辑，现在包含隔离环境的创建和清理"""
     task_repo_path = os.path.join(TIDB_WORKTREE_BASE, task_id)
 
@@ -585,78 +3471,102 @@ def run_binary_search_with_version(start_v_str, end_v_str, sql, expected_sql, ot
         version_parts = end_v_str.lstrip('v').split('.')
         branch_version = f"{version_parts[0]}.{version_parts[1]}"
         branch_name = f"release-{branch_version}"
-        run_command(["git", "worktree", "add", "-f", task_repo_path, branch_name], work_dir=TIDB_REPO_PATH)
+        with trace_span(task_id, 'worktree_setup', branch=branch_name):
+            run_command(["git", "worktree", "add", "-f", task_repo_path, branch_name], work_dir=TIDB_REPO_PATH)
         tasks[task_id]['log'].append(f"✅ Git worktree 创建成功，基于分支 {branch_name}。")
 
         # --- 内部函数现在使用 repo_path ---
-        def commit_binary_search_logic(start_version, end_version, repo_path):
-            commits = get_commit_list(start_version, end_version, task_id, repo_path)
-            if not commits: return None
-            low, high, first_bad_commit = 0, len(commits) - 1, None
-            while low <= high:
-                mid = (low + high) // 2
-                commit_sha = commits[mid]
-                tasks[task_id]['log'].append(
-                    f"\n--- 正在测试第 {mid + 1}/{len(commits)} 个 commit: {commit_sha[:12]} ---")
-
-                binary_path = compile_at_commit(commit_sha, task_id, end_version, repo_path)
+        local_build_lock = threading.Lock()
+
+        def probe_commit(commit_sha, version, repo_path):
+            result_index = new_result_slot(task_id)
+            if fill_from_verdict_cache(task_id, result_index, version, commit_sha, sql, expected_sql, other_check):
+                return tasks[task_id]['results'][result_index].get('status')
+            if agent_capacity():
+                status = probe_on_agent(task_id, result_index, version, commit_sha, sql, expected_sql, other_check)
+                if status is not None:
+                    return status
+            # 本机只有一个 worktree，编译和探测必须串行
+            with local_build_lock:
+                binary_path = build_commit_or_skip(commit_sha, task_id, version, repo_path)
                 if binary_path is None:
-                    high = mid - 1
-                    continue
-
-                result_index = len(tasks[task_id]['results'])
-                tasks[task_id]['results'].append({})
-                test_single_version(end_version, sql, expected_sql, other_check, task_id, result_index,
+                    tasks[task_id]['results'][result_index] = {'version': f"{version}-{commit_sha}",
+                                                               'status': 'Skip', 'error': '编译失败，已跳过'}
+                    return 'Skip'
+                test_single_version(version, sql, expected_sql, other_check, task_id, result_index,
                                     cleanup_after=True, commit=commit_sha, binary_path=binary_path)
+            return tasks[task_id]['results'][result_index].get('status')
 
-                result_data = tasks[task_id]['results'][result_index]
-                if result_data.get('status') == 'Failure':
-                    first_bad_commit = commit_sha
-                    high = mid - 1
-                elif result_data.get('status') == 'Success':
-                    low = mid + 1
-                else:
-                    tasks[task_id]['log'].append(f"commit {commit_sha[:7]} 测试时发生环境错误，中止。")
-                    tasks[task_id]['status'] = 'error'
-                    return None
-            return first_bad_commit
+        def commit_binary_search_logic(start_version, end_version, repo_path):
+            commits = get_commit_list(start_version, end_version, task_id, repo_path)
+            if not commits: return None, []
+            commits = prune_commits(commits, task_id, repo_path, path_filters)
+            if not commits: return None, []
+            return bisect_commits(commits, lambda c: probe_commit(c, end_version, repo_path), task_id,
+                                  ways=bisect_ways,
+                                  probe_seconds=expected_probe_seconds(end_version, topology_name, build=True,
+                                                                       check=bool(other_check.strip())))
 
         # ... (binary_search_logic and baseline checks remain the same, they call test_single_version which doesn't need repo_path)
         all_versions = get_tidb_versions()
+        topology_name = topology_label(task_topology(task_id))
+        version_probe_seconds = expected_probe_seconds(end_v_str, topology_name, check=bool(other_check.strip()))
+
+        def versions_between(start_version, end_version):
+            return sorted((v for v in all_versions if Version(start_version) <= Version(v) <= Version(end_version)),
+                          key=Version)
 
         def binary_search_logic(start_version, end_version):
             # This logic doesn't directly interact with git repo, so no repo_path is needed
-            search_space = [v for v in all_versions if
-                            Version(v) >= Version(start_version) and Version(v) <= Version(end_version)]
-            search_space.sort(key=Version)
+            search_space = versions_between(start_version, end_version)
             low, high, first_bad_version = 0, len(search_space) - 1, None
+            skipped = set()
             while low <= high:
-                mid_idx = (low + high) // 2
+                check_cancelled(task_id)
+                rounds = bisect_rounds(high - low + 1)
+                update_eta(task_id, 'version', rounds, rounds * version_probe_seconds)
+                mid_idx = _nearest_unskipped((low + high) // 2, low, high, skipped)
+                if mid_idx is None:
+                    tasks[task_id]['log'].append(f"⚠️ 剩余的 {high - low + 1} 个版本均无法得出结论，无法继续缩小范围。")
+                    break
                 version_to_test = search_space[mid_idx]
                 result_index = len(tasks[task_id]['results'])
                 tasks[task_id]['results'].append({})
                 test_single_version(version_to_test, sql, expected_sql, other_check, task_id, result_index,
                                     cleanup_after=True)
-                result_data = tasks[task_id]['results'][result_index]
-                if result_data.get('status') == 'Failure':
+                check_cancelled(task_id)
+                status = effective_status(task_id, tasks[task_id]['results'][result_index].get('status'))
+                if status == 'Failure':
                     first_bad_version = version_to_test
                     high = mid_idx - 1
-                elif result_data.get('status') == 'Success':
+                elif status == 'Success':
                     low = mid_idx + 1
+                elif status == 'Skip':
+                    tasks[task_id]['log'].append(f"⏭️ 版本 {version_to_test} 无法得出结论，改为测试相邻版本。")
+                    skipped.add(mid_idx)
                 else:
                     tasks[task_id]['log'].append(f"版本 {version_to_test} 测试时发生环境错误，中止。")
                     tasks[task_id]['status'] = 'error'
                     return None
+            if first_bad_version:
+                uncertain = [search_space[i] for i in sorted(skipped)
+                             if low <= i < search_space.index(first_bad_version)]
+                if uncertain:
+                    tasks[task_id]['log'].append(f"⚠️ 以下版本无法得出结论，问题也可能由它们引入: {', '.join(uncertain)}")
             return first_bad_version
 
         # --- 执行流程 ---
+        # 基线和健全性检查之后是版本二分，ETA 暂不包括之后的 commit 二分 (commit 数未知)
+        rounds = bisect_rounds(len(versions_between(start_v_str, end_v_str)))
+        update_eta(task_id, 'baseline', 2 + rounds, (2 + rounds) * version_probe_seconds)
         # # 1. 基线检查
         tasks[task_id]['log'].append(f"\n--- 正在执行基线检查: {start_v_str} ---")
         start_index = len(tasks[task_id]['results'])
         tasks[task_id]['results'].append({})
         test_single_version(start_v_str, sql, expected_sql, other_check, task_id, start_index, cleanup_after=True)
+        check_cancelled(task_id)
         start_result = tasks[task_id]['results'][start_index]
-        if start_result.get('status') == 'Failure':
+        if effective_status(task_id, start_result.get('status')) == 'Failure':
             tasks[task_id]['log'].append(f"\n❌ 基线检查失败: 起始版本 {start_v_str} 已不符合预期。")
             tasks[task_id]['final_result'] = "本范围内无法找到引入问题的pr,请在更早的版本或者 commit 范围内查找"
             return
@@ -666,8 +3576,9 @@ def run_binary_search_with_version(start_v_str, end_v_str, sql, expected_sql, ot
         end_index = len(tasks[task_id]['results'])
         tasks[task_id]['results'].append({})
         test_single_version(end_v_str, sql, expected_sql, other_check, task_id, end_index, cleanup_after=True)
+        check_cancelled(task_id)
         end_result = tasks[task_id]['results'][end_index]
-        if end_result.get('status') == 'Success':
+        if effective_status(task_id, end_result.get('status')) == 'Success':
             error_msg = f"健全性检查失败: 'Bug 上报版本' ({end_v_str}) 的测试结果为成功，无法进行二分查找。"
             tasks[task_id]['log'].append(f"\n❌ {error_msg}")
             tasks[task_id]['final_result'] = error_msg
@@ -687,15 +3598,21 @@ def run_binary_search_with_version(start_v_str, end_v_str, sql, expected_sql, ot
         good_version_index = tidb_versions.index(found_version) + 1
         good_version = tidb_versions[good_version_index]
 
-        found_commit = commit_binary_search_logic(good_version, found_version, task_repo_path)
+        found_commit, culprits = commit_binary_search_logic(good_version, found_version, task_repo_path)
         if found_commit:
             output = run_command(["git", "show", found_commit, "--no-patch"], work_dir=task_repo_path)
 
             tasks[task_id][
                 'final_result'] = f"定位到第一个出错的commit是: {found_version}-{found_commit}\n\nCommit Info:\n{output}"
+            if len(culprits) > 1:
+                tasks[task_id]['culprit_commits'] = culprits
+                tasks[task_id]['final_result'] += "\n" + format_culprit_range(culprits)
         else:
             tasks[task_id]['final_result'] += f"\n但在 {good_version} 和 {found_version} 之间未定位到具体的 commit。"
 
+    except TaskCancelled:
+        tasks[task_id]['log'].append("🛑 任务已取消，二分查找中止。")
+        tasks[task_id]['final_result'] = "任务已取消。"
     except Exception as e:
         tasks[task_id]['log'].append(f"❌ 二分查找过程中发生严重错误: {e}")
         tasks[task_id]['status'] = 'error'
@@ -705,14 +3622,17 @@ def run_binary_search_with_version(start_v_str, end_v_str, sql, expected_sql, ot
             tasks[task_id]['log'].append(f"清理任务 {task_id} 的工作目录: {task_repo_path}")
             try:
                 # 使用 git worktree remove 更干净
-                run_command(["git", "worktree", "remove", "--force", task_repo_path], work_dir=TIDB_REPO_PATH)
+                with trace_span(task_id, 'worktree_cleanup'):
+                    run_command(["git", "worktree", "remove", "--force", task_repo_path], work_dir=TIDB_REPO_PATH)
             except Exception as e:
                 tasks[task_id]['log'].append(f"⚠️ Git worktree remove 失败: {e}. 尝试手动删除目录...")
                 shutil.rmtree(task_repo_path, ignore_errors=True)
-        tasks[task_id]['status'] = 'complete'
+        if not is_cancelled(task_id):
+            tasks[task_id]['status'] = 'complete'
 
 
-def run_binary_search_with_commit(start_commit, end_commit, branch, sql, expected_sql, other_check, task_id):
+def run_binary_search_with_commit(start_commit, end_commit, branch, sql, expected_sql, other_check, task_id,
+                                  path_filters=None):
     """二分查找逻辑，现在包含隔离环境的创建和清理"""
     task_repo_path = os.path.join(TIDB_WORKTREE_BASE, task_id)
 
@@ -720,69 +3640,63 @@ def run_binary_search_with_commit(start_commit, end_commit, branch, sql, expecte
         # --- 创建隔离环境 ---
         tasks[task_id]['log'].append(f"为任务 {task_id} 创建隔离的工作目录: {task_repo_path}")
         os.makedirs(TIDB_WORKTREE_BASE, exist_ok=True)
-        run_command(["git", "worktree", "add", "-f", task_repo_path, branch], work_dir=TIDB_REPO_PATH)
-        tasks[task_id]['log'].append(f"✅ Git worktree 创建成功，基于分支 {branch}。")
+        with trace_span(task_id, 'worktree_setup', branch=branch):
+            run_command(["git", "worktree", "add", "-f", task_repo_path, branch], work_dir=TIDB_REPO_PATH)
+            tasks[task_id]['log'].append(f"✅ Git worktree 创建成功，基于分支 {branch}。")
 
-        tasks[task_id]['log'].append(f"🔄 正在更新仓库代码...")
-        run_command(["git", "pull"], work_dir=task_repo_path, print_output=True)
+            tasks[task_id]['log'].append(f"🔄 正在更新仓库代码...")
+            run_command(["git", "pull"], work_dir=task_repo_path, print_output=True, task_id=task_id)
         tasks[task_id]['log'].append(f"✅ 仓库代码已更新。")
 
+        install_version = 'nightly' if branch == 'master' else f'v{branch.replace("release-", "")}.0'
+        probe_seconds = expected_probe_seconds(install_version, topology_label(task_topology(task_id)), build=True,
+                                               check=bool(other_check.strip()))
+
         # --- 内部函数 ---
         def commit_binary_search_logic(repo_path):
             command = ["git", "rev-list", "--reverse", f"{start_commit}..{end_commit}"]
             result = run_command(command, work_dir=repo_path)
             commits_after_start = [line for line in result.strip().split('\n') if line]
-            commits = [start_commit] + commits_after_start
-
-            low, high, first_bad_commit = 0, len(commits) - 1, None
-
-            while low <= high:
-                mid = (low + high) // 2
-                commit_sha = commits[mid]
-                tasks[task_id]['log'].append(
-                    f"\n--- 正在测试第 {mid + 1}/{len(commits)} 个 commit: {commit_sha[:12]} ---")
+            # 起始 commit 是已知的基线，始终保留；只对其后的 commits 做路径剪枝
+            commits = [start_commit] + prune_commits(commits_after_start, task_id, repo_path, path_filters)
+            return bisect_commits(commits, lambda c: probe_commit(c, repo_path), task_id, ways=bisect_ways,
+                                  probe_seconds=probe_seconds)
 
-                install_version = 'nightly' if branch == 'master' else f'v{branch.replace("release-", "")}.0'
-                binary_path = compile_at_commit(commit_sha, task_id, install_version, repo_path)
-                if binary_path is None:
-                    high = mid - 1
-                    continue
+        def probe_commit(commit_sha, repo_path):
+            result_index = new_result_slot(task_id)
+            test_a_commit(commit_sha, result_index, repo_path)
+            return tasks[task_id]['results'][result_index].get('status')
 
-                result_index = len(tasks[task_id]['results'])
-                tasks[task_id]['results'].append({})
-                test_single_version(install_version, sql, expected_sql, other_check, task_id, result_index,
-                                    cleanup_after=True, commit=commit_sha, binary_path=binary_path)
-
-                result_data = tasks[task_id]['results'][result_index]
-                if result_data.get('status') == 'Failure':
-                    first_bad_commit = commit_sha
-                    high = mid - 1
-                elif result_data.get('status') == 'Success':
-                    low = mid + 1
-                else:
-                    tasks[task_id]['log'].append(f"commit {commit_sha[:7]} 测试时发生环境错误，中止。")
-                    tasks[task_id]['status'] = 'error'
-                    return None
-            return first_bad_commit
+        local_build_lock = threading.Lock()
 
         def test_a_commit(commit_sha, index, repo_path):
-            install_version = 'nightly' if branch == 'master' else f'v{branch.replace("release-", "")}.0'
-            binary_path = compile_at_commit(commit_sha, task_id, install_version, repo_path)
-            if binary_path is None:
-                tasks[task_id]['results'][index] = {'version': commit_sha, 'status': 'Failure', 'error': '编译失败'}
+            if fill_from_verdict_cache(task_id, index, install_version, commit_sha, sql, expected_sql, other_check):
                 return
-            test_single_version(install_version, sql, expected_sql, other_check, task_id, index, cleanup_after=True,
-                                commit=commit_sha, binary_path=binary_path)
+            if agent_capacity() and probe_on_agent(task_id, index, install_version, commit_sha, sql, expected_sql,
+                                                   other_check) is not None:
+                return
+            # 本机只有一个 worktree，编译和探测必须串行
+            with local_build_lock:
+                binary_path = build_commit_or_skip(commit_sha, task_id, install_version, repo_path)
+                if binary_path is None:
+                    tasks[task_id]['results'][index] = {'version': commit_sha, 'status': 'Skip',
+                                                        'error': '编译失败，已跳过'}
+                    return
+                test_single_version(install_version, sql, expected_sql, other_check, task_id, index,
+                                    cleanup_after=True, commit=commit_sha, binary_path=binary_path)
 
         # --- 执行流程 ---
+        # commit 列表在检查之后才取得，这里的 ETA 只包括基线和健全性检查
+        update_eta(task_id, 'baseline', 2, 2 * probe_seconds)
         # 1. 基线检查
         tasks[task_id]['log'].append(f"\n--- 正在执行基线检查 (起始 Commit): {start_commit[:7]} ---")
         start_index = len(tasks[task_id]['results'])
         tasks[task_id]['results'].append({})
         test_a_commit(start_commit, start_index, task_repo_path)
+        check_cancelled(task_id)
 
         start_result = tasks[task_id]['results'][start_index]
-        if start_result.get('status') == 'Failure':
+        if effective_status(task_id, start_result.get('status')) == 'Failure':
             tasks[task_id]['log'].append(f"\n❌ 基线检查失败: 起始 Commit {start_commit[:7]} 已不符合预期。")
             tasks[task_id]['final_result'] = "本范围内无法找到引入问题的pr,请在更早的版本或者commit 范围内查找"
             return
@@ -792,23 +3706,30 @@ def run_binary_search_with_commit(start_commit, end_commit, branch, sql, expecte
         end_index = len(tasks[task_id]['results'])
         tasks[task_id]['results'].append({})
         test_a_commit(end_commit, end_index, task_repo_path)
+        check_cancelled(task_id)
 
         end_result = tasks[task_id]['results'][end_index]
-        if end_result.get('status') == 'Success':
+        if effective_status(task_id, end_result.get('status')) == 'Success':
             error_msg = f"健全性检查失败: 'Bug 上报commit' ({end_commit}) 的测试结果为成功，无法进行二分查找。"
             tasks[task_id]['log'].append(f"\n❌ {error_msg}")
             tasks[task_id]['final_result'] = error_msg
             return
 
         # 2. 开始二分查找
-        found_commit = commit_binary_search_logic(task_repo_path)
+        found_commit, culprits = commit_binary_search_logic(task_repo_path)
         if found_commit:
             output = run_command(["git", "show", found_commit, "--no-patch"], work_dir=task_repo_path)
             tasks[task_id]['final_result'] = f"定位到第一个出错的commit是: {found_commit}\n\nCommit Info:\n{output}"
+            if len(culprits) > 1:
+                tasks[task_id]['culprit_commits'] = culprits
+                tasks[task_id]['final_result'] += "\n" + format_culprit_range(culprits)
         else:
             tasks[task_id][
                 'final_result'] = f"在 {branch} 分支的 {start_commit[:7]}..{end_commit[:7]} 范围内未找到不符合预期的commit。"
 
+    except TaskCancelled:
+        tasks[task_id]['log'].append("🛑 任务已取消，二分查找中止。")
+        tasks[task_id]['final_result'] = "任务已取消。"
     except Exception as e:
         tasks[task_id]['log'].append(f"❌ 二分查找过程中发生严重错误: {e}")
         tasks[task_id]['status'] = 'error'
@@ -817,74 +3738,437 @@ def run_binary_search_with_commit(start_commit, end_commit, branch, sql, expecte
         if os.path.exists(task_repo_path):
             tasks[task_id]['log'].append(f"清理任务 {task_id} 的工作目录: {task_repo_path}")
             try:
-                run_command(["git", "worktree", "remove", "--force", task_repo_path], work_dir=TIDB_REPO_PATH)
+                with trace_span(task_id, 'worktree_cleanup'):
+                    run_command(["git", "worktree", "remove", "--force", task_repo_path], work_dir=TIDB_REPO_PATH)
             except Exception as e:
                 tasks[task_id]['log'].append(f"⚠️ Git worktree remove 失败: {e}. 尝试手动删除目录...")
                 shutil.rmtree(task_repo_path, ignore_errors=True)
-        tasks[task_id]['status'] = 'complete'
+        if not is_cancelled(task_id):
+            tasks[task_id]['status'] = 'complete'
+
+
+# --- 版本全量扫描 (sweep) ---
+# 二分假设问题只出现一次且不会消失；扫描模式并发测试范围内的全部版本，输出各发布分支上的通过 / 失败时间线，
+# 并报告所有变化点 (引入和修复)。同时运行的集群数受 budget 限制，信息量大的版本先测。
+SWEEP_MAX_CLUSTERS = 8
+
+
+def release_line(version):
+    """v8.1.2 -> v8.1"""
+    return 'v' + '.'.join(version.lstrip('v').split('.')[:2])
+
+
+def _bisection_order(n):
+    """先两端、再逐层取中点的下标顺序：任意时刻已测的版本都尽量均匀地覆盖整个分支"""
+    order = list(dict.fromkeys([0, n - 1]))[:n]
+    intervals = deque([(0, n - 1)])
+    while intervals:
+        low, high = intervals.popleft()
+        if high - low < 2:
+            continue
+        mid = (low + high) // 2
+        order.append(mid)
+        intervals.extend([(low, mid), (mid, high)])
+    return order
+
+
+def sweep_order(versions):
+    """按信息量排序：各发布分支轮流出版本，每个分支内先两端后中点，因此各分支的 .0 版本最先测试"""
+    lines = {}
+    for version in sorted(versions, key=Version):
+        lines.setdefault(release_line(version), []).append(version)
+    per_line = [[line_versions[i] for i in _bisection_order(len(line_versions))] for line_versions in lines.values()]
+    order = []
+    for round_versions in zip_longest(*per_line):
+        order += [v for v in round_versions if v]
+    return order
+
+
+def version_transitions(timeline):
+    """
+    timeline: {分支: [{'version', 'status'}]} (按版本排序，status 为 effective_status)。
+    返回所有变化点：分支内相邻的两个有结论的版本，以及相邻分支的第一个有结论的版本 (分支从主干切出)。
+    """
+    def changes(points, scope):
+        found, previous, skipped = [], None, []
+        for point in points:
+            if point['status'] not in ('Success', 'Failure'):
+                skipped.append(point['version'])
+                continue
+            if previous and previous['status'] != point['status']:
+                found.append({'scope': scope, 'from': previous['version'], 'to': point['version'],
+                              'kind': 'regression' if point['status'] == 'Failure' else 'fix',
+                              'inconclusive_between': skipped})
+            previous, skipped = point, []
+        return found
+
+    transitions = []
+    heads = []
+    for line, points in timeline.items():
+        transitions += changes(points, line)
+        head = next((p for p in points if p['status'] in ('Success', 'Failure')), None)
+        if head:
+            heads.append(head)
+    transitions += changes(heads, 'branch points')
+    return transitions
+
+
+def format_sweep(timeline, transitions):
+    marks = {'Success': '✅', 'Failure': '❌'}
+    lines = ["版本扫描结果 (✅ 符合预期 / ❌ 不符合预期 / ❔ 无结论):"]
+    for line, points in timeline.items():
+        lines.append(f"  {line}: " + " ".join(f"{p['version']}{marks.get(p['status'], '❔')}" for p in points))
+    if not transitions:
+        lines.append("范围内所有有结论的版本结果一致，没有变化点。")
+    for t in transitions:
+        kind = "引入问题" if t['kind'] == 'regression' else "问题被修复"
+        lines.append(f"  [{t['scope']}] {t['from']} -> {t['to']}: {kind}"
+                     + (f" (中间无结论: {', '.join(t['inconclusive_between'])})" if t['inconclusive_between'] else ""))
+    return "\n".join(lines)
+
+
+async def sweep_versions(start_v_str, end_v_str, sql, expected_sql, other_check, task_id, budget):
+    """并发探测 [start, end] 内的全部版本，同时最多 budget 个集群"""
+    try:
+        all_versions = await run_blocking(get_tidb_versions)
+        versions = sweep_order([v for v in all_versions if Version(start_v_str) <= Version(v)
+                                and (not end_v_str or Version(v) <= Version(end_v_str))])
+        if not versions:
+            tasks[task_id]['final_result'] = f"{start_v_str} - {end_v_str or '最新版本'} 范围内没有可用的版本。"
+            return
+        tasks[task_id]['results'] = [{} for _ in versions]
+        tasks[task_id]['log'].append(f"🧭 扫描 {len(versions)} 个版本，最多同时运行 {budget} 个集群。测试顺序: "
+                                     f"{', '.join(versions)}")
+        semaphore = asyncio.Semaphore(budget)  # FIFO，先创建的协程先拿到集群额度
+        statuses = {}
+        probe_seconds = expected_probe_seconds(versions[0], topology_label(task_topology(task_id)),
+                                               check=bool(other_check.strip()))
+
+        def refresh_eta():
+            remaining = len(versions) - len(statuses)
+            update_eta(task_id, 'sweep', remaining, math.ceil(remaining / budget) * probe_seconds)
+
+        def timeline():
+            by_line = {}
+            for version in sorted(versions, key=Version):
+                by_line.setdefault(release_line(version), []).append(
+                    {'version': version, 'status': statuses.get(version)})
+            return by_line
+
+        async def probe(index, version):
+            async with semaphore:
+                check_cancelled(task_id)
+                await probe_version(version, sql, expected_sql, other_check, task_id, index, cleanup_after=True)
+            statuses[version] = effective_status(task_id, tasks[task_id]['results'][index].get('status'))
+            refresh_eta()
+            current = timeline()
+            tasks[task_id]['sweep'] = {'timeline': current, 'transitions': version_transitions(current)}
+
+        refresh_eta()
+        outcomes = await asyncio.gather(*(probe(i, v) for i, v in enumerate(versions)), return_exceptions=True)
+        check_cancelled(task_id)
+        for version, outcome in zip(versions, outcomes):
+            if isinstance(outcome, BaseException):
+                tasks[task_id]['log'].append(f"❌ 版本 {version} 探测异常退出: {outcome}")
+        current = timeline()
+        transitions = version_transitions(current)
+        tasks[task_id]['sweep'] = {'timeline': current, 'transitions': transitions}
+        tasks[task_id]['final_result'] = format_sweep(current, transitions)
+        tasks[task_id]['log'].append("\n" + tasks[task_id]['final_result'])
+    except TaskCancelled:
+        tasks[task_id]['log'].append("🛑 任务已取消，版本扫描中止。")
+        tasks[task_id]['final_result'] = "任务已取消。"
+    except Exception as e:
+        tasks[task_id]['log'].append(f"❌ 版本扫描过程中发生严重错误: {e}")
+        tasks[task_id]['status'] = 'error'
+    finally:
+        if tasks[task_id]['status'] == 'running':
+            tasks[task_id]['status'] = 'complete'
 
 
 @app.route('/start_locate', methods=['POST'])
 def start_locate():
-    global COMPONENT_COUNTS
     data = request.json
     locate_mode = data.get('locate_mode')
     sql = data.get('sql')
     expected_sql_result = data.get('expected_sql_result', '').strip()
     other_check_script = data.get('other_check_script', '').strip()
 
-    COMPONENT_COUNTS = {
-        'tidb': int(data.get('tidb') or COMPONENT_COUNTS['tidb']),
-        'tikv': int(data.get('tikv') or COMPONENT_COUNTS['tikv']),
-        'pd': int(data.get('pd') or COMPONENT_COUNTS['pd']),
-        'tiflash': int(data.get('tiflash') or COMPONENT_COUNTS['tiflash'])
+    path_filters = {
+        'include': parse_path_filters(data.get('include_paths')),
+        'exclude': parse_path_filters(data.get('exclude_paths'))
     }
 
-    task_id = str(uuid4())
-    tasks[task_id] = {'status': 'running', 'log': [], 'results': [], 'processes': [], 'type': 'locate'}
-    session.setdefault('task_ids', []).append(task_id)
-    session.modified = True
+    try:
+        inference = infer_request_topology(data)
+        topology = inference['topology'] if inference else parse_topology(data)
+        probe_options = parse_probe_options(data)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
+    # 先校验全部参数再登记任务：被拒绝的请求不能留下一个永远 running 的任务 (会计入任务指标并续租集群)
     if locate_mode == 'version':
         bug_version = data.get('bug_version')
         start_version_str = data.get('start_version') or "v5.4.0"
         if not bug_version or Version(start_version_str) >= Version(bug_version):
             return jsonify({'error': '版本设置无效：“起始版本”必须早于“Bug 上报版本”'}), 400
-        thread = threading.Thread(target=run_binary_search_with_version,
-                                  args=(start_version_str, bug_version, sql, expected_sql_result, other_check_script,
-                                        task_id))
     elif locate_mode == 'commit':
         branch = data.get('branch')
         start_commit = data.get('start_commit')
         end_commit = data.get('end_commit')
         if not all([branch, start_commit, end_commit]):
             return jsonify({'error': '分支、起始 Commit 和结束 Commit 均为必填项'}), 400
+    elif locate_mode == 'sweep':
+        start_version_str = data.get('start_version') or "v5.4.0"
+        end_version_str = data.get('bug_version') or data.get('end_version')
+        if end_version_str and Version(start_version_str) > Version(end_version_str):
+            return jsonify({'error': '版本设置无效：“起始版本”不能晚于“结束版本”'}), 400
+        budget = max(1, int(data.get('sweep_budget') or SWEEP_MAX_CLUSTERS))
+    else:
+        return jsonify({'error': f'未知的定位模式: {locate_mode}'}), 400
+
+    task_id = str(uuid4())
+    tasks[task_id] = {'status': 'running', 'log': TaskLog(task_id), 'results': [], 'processes': [], 'type': 'locate',
+                      'probe_options': probe_options, 'topology': topology}
+    session.setdefault('task_ids', []).append(task_id)
+    session.modified = True
+    log_topology_inference(task_id, inference)
+
+    if locate_mode == 'version':
+        thread = threading.Thread(target=run_binary_search_with_version,
+                                  args=(start_version_str, bug_version, sql, expected_sql_result, other_check_script,
+                                        task_id, path_filters))
+    elif locate_mode == 'commit':
         thread = threading.Thread(target=run_binary_search_with_commit,
                                   args=(start_commit, end_commit, branch, sql, expected_sql_result, other_check_script,
-                                        task_id))
+                                        task_id, path_filters))
     else:
-        return jsonify({'error': f'未知的定位模式: {locate_mode}'}), 400
+        run_on_probe_loop(sweep_versions(start_version_str, end_version_str, sql, expected_sql_result,
+                                         other_check_script, task_id, budget))
+        return jsonify({'task_id': task_id})
 
     thread.start()
     return jsonify({'task_id': task_id})
 
 
+@app.route('/infer_topology', methods=['POST'])
+def preview_topology():
+    """只推断拓扑不启动任务，供页面在提交前展示"""
+    try:
+        inference = infer_request_topology(dict(request.json, auto_topology=True))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(dict(inference, label=topology_label(inference['topology'])))
+
+
 @app.route('/status/<task_id>')
 def task_status(task_id):
     task = tasks.get(task_id)
     if not task:
         return jsonify({'status': 'not_found'}), 404
 
+    # since 为上次返回的 log_next，只返回新增的日志；level / phase 为逗号分隔的过滤条件
+    events, truncated = task['log'].since(request.args.get('since', 0, type=int))
+    events = filter_log_events(events, parse_log_filter(request.args.get('level')),
+                               parse_log_filter(request.args.get('phase')), request.args.get('probe'))
     serializable_task = {
         'status': task.get('status'),
-        'log': task.get('log', []),
+        'log': [e['message'] for e in events],
+        'log_events': events,
+        'log_next': len(task['log']),
+        'log_truncated': truncated,
         'results': task.get('results', []),
         'type': task.get('type'),
         'final_result': task.get('final_result'),
+        'culprit_commits': task.get('culprit_commits'),
+        'retry_stats': task.get('retry_stats', {}),
+        'matrix': task.get('matrix'),
+        'sweep': task.get('sweep'),
+        'topology_inference': task.get('topology_inference'),
+        'eta': eta_view(task),
     }
     return jsonify(serializable_task)
 
 
+@app.route('/cancel/<task_id>', methods=['POST'])
+def cancel_task(task_id):
+    """取消任务：通知后台线程在下一个阶段边界退出，并立即杀掉编译进程和集群"""
+    task = tasks.get(task_id)
+    if not task:
+        return jsonify({'status': 'not_found'}), 404
+    if task.get('status') != 'running':
+        return jsonify({'status': task.get('status'), 'message': '任务已结束，无需取消。'})
+
+    cancel_event(task_id).set()
+    task['status'] = 'cancelled'
+    task['log'].append("🛑 收到取消请求，正在停止编译进程和集群...")
+
+    killed_commands, stopped_clusters = stop_task_processes(task_id)
+    cancel_remote_jobs(task_id)
+    return jsonify({'status': 'cancelled', 'killed_commands': killed_commands, 'stopped_clusters': stopped_clusters})
+
+
+def stop_task_processes(task_id):
+    """杀掉任务的编译进程并停止它的集群，返回 (被杀的命令 pid, 被停止的集群 pid)"""
+    task = tasks[task_id]
+    killed_commands, stopped_clusters = [], []
+    for process in list(task.get('commands', [])):
+        if process.returncode is None:
+            try:
+                os.killpg(process.pid, signal.SIGKILL)
+                killed_commands.append(process.pid)
+            except (ProcessLookupError, PermissionError):
+                pass
+    with clusters_lock:
+        owned = [c['process'] for c in clusters.values() if c['task_id'] == task_id]
+    for process in owned:
+        # 并行停止，避免请求被逐个等待集群退出阻塞
+        threading.Thread(target=stop_cluster, args=(process, 10), daemon=True).start()
+        stopped_clusters.append(process.pid)
+    return killed_commands, stopped_clusters
+
+
+@app.route('/agents/register', methods=['POST'])
+def register_agent():
+    """agent 注册：返回 agent_id 和轮询间隔"""
+    data = request.json or {}
+    agent_id = str(uuid4())
+    now = time.time()
+    agent = {'agent_id': agent_id, 'name': data.get('name') or agent_id[:8],
+             'capacity': max(1, int(data.get('capacity') or 1)), 'host': request.remote_addr,
+             'last_seen': now, 'registered': now, 'jobs': set(), 'cancel': set(), 'completed': 0}
+    with agents_lock:
+        agents[agent_id] = agent
+    print(f"🛰️ agent {agent['name']} ({agent['host']}) 已注册，并发容量 {agent['capacity']}。")
+    return jsonify({'agent_id': agent_id, 'poll_interval': AGENT_POLL_INTERVAL})
+
+
+@app.route('/agents/<agent_id>/poll', methods=['POST'])
+def poll_agent(agent_id):
+    """agent 心跳：领取新的探测，并获取需要取消的探测"""
+    data = request.json or {}
+    assigned = []
+    with agents_lock:
+        _expire_agents(time.time())
+        agent = agents.get(agent_id)
+        if not agent:
+            return jsonify({'status': 'not_found'}), 404
+        agent['last_seen'] = time.time()
+        if 'running' in data:
+            # 已派发但 agent 报告不在执行、结果也没有送达的探测 (结果回传失败、派发的响应丢失) 重新排队
+            running = set(data['running'])
+            for job_id in [j for j in agent['jobs'] if j not in running]:
+                agent['jobs'].discard(job_id)
+                job = agent_jobs.get(job_id)
+                if job and not job['future'].done():
+                    job['agent_id'] = None
+                    agent_job_queue.appendleft(job_id)
+                    tasks[job['task_id']]['log'].append(
+                        f"⚠️ agent {agent['name']} 上的探测 {job['label']} 没有回传结果，重新排队。")
+        cancel = list(agent['cancel'])
+        agent['cancel'].clear()
+        free = min(int(data.get('free_slots', agent['capacity'])), agent['capacity'] - len(agent['jobs']))
+        while free > 0 and agent_job_queue:
+            job = agent_jobs.get(agent_job_queue.popleft())
+            if not job or job['future'].done():
+                continue
+            job['agent_id'] = agent_id
+            agent['jobs'].add(job['job_id'])
+            assigned.append(job)
+            free -= 1
+    for job in assigned:
+        tasks[job['task_id']]['log'].append(f"🛰️ 探测 {job['label']} 已派发给 agent {agent['name']}。")
+    return jsonify({'jobs': [job['payload'] for job in assigned], 'cancel': cancel})
+
+
+@app.route('/agents/<agent_id>/jobs/<job_id>/log', methods=['POST'])
+def agent_job_log(agent_id, job_id):
+    """agent 回传探测日志：events 为结构化事件，旧版本 agent 只回传 lines"""
+    data = request.json or {}
+    events = data.get('events') or [{'message': line} for line in data.get('lines', [])]
+    with agents_lock:
+        job = agent_jobs.get(job_id)
+        agent = agents.get(agent_id)
+    if job and agent and job['agent_id'] == agent_id:
+        log = tasks[job['task_id']]['log']
+        for event in events:
+            log.append(f"[{agent['name']}] {event['message']}", level=event.get('level'), phase=event.get('phase'),
+                       probe=event.get('probe') or job['label'], at=event.get('time'))
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/agents/<agent_id>/jobs/<job_id>/result', methods=['POST'])
+def agent_job_result(agent_id, job_id):
+    """agent 回传探测结果；超时被重新派发的探测以先到的结果为准"""
+    result = (request.json or {}).get('result') or {}
+    with agents_lock:
+        job = agent_jobs.get(job_id)
+        if not job or job['agent_id'] != agent_id:
+            return jsonify({'status': 'ignored'})
+        agent = agents.get(agent_id)
+        if agent:
+            result['agent'] = agent['name']
+            agent['completed'] += 1
+        _finish_remote_job(job, result)
+    payload = job['payload']
+    record_probe_durations(result.get('durations'), payload['version'], topology_label(payload['topology']),
+                           get_go_version(payload['version']))
+    return jsonify({'status': 'ok'})
+
+
+@app.route('/agents')
+def list_agents():
+    """在线 agent 及排队中的探测数量"""
+    with agents_lock:
+        _expire_agents(time.time())
+        online = [{'agent_id': a['agent_id'], 'name': a['name'], 'host': a['host'], 'capacity': a['capacity'],
+                   'running': len(a['jobs']), 'completed': a['completed'],
+                   'last_seen': round(time.time() - a['last_seen'], 1)} for a in agents.values()]
+        queued = sum(1 for job_id in agent_job_queue if job_id in agent_jobs)
+    return jsonify({'agents': online, 'queued': queued})
+
+
+@app.route('/fixtures/<sha256>.<fmt>')
+def download_fixture(sha256, fmt):
+    """供 agent 下载任务的 fixture 文件"""
+    return send_from_directory(os.path.abspath(FIXTURE_DIR), f"{sha256}.{fmt}")
+
+
+@app.route('/trace/<task_id>')
+def task_trace(task_id):
+    """下载任务的阶段追踪 (Chrome trace-event JSON，可在 Perfetto 中打开)"""
+    task = tasks.get(task_id)
+    if not task:
+        return jsonify({'status': 'not_found'}), 404
+    return Response(json.dumps(to_chrome_trace(task), ensure_ascii=False), mimetype='application/json',
+                    headers={'Content-Disposition': f'attachment; filename=trace_{task_id[:8]}.json'})
+
+
+@app.route('/logs/<task_id>')
+def task_log(task_id):
+    """下载任务的完整日志 (包括已溢出到磁盘的部分)，JSON Lines 格式，支持与 /status 相同的过滤条件"""
+    task = tasks.get(task_id)
+    if not task:
+        return jsonify({'status': 'not_found'}), 404
+    events = filter_log_events(task['log'].all_events(), parse_log_filter(request.args.get('level')),
+                               parse_log_filter(request.args.get('phase')), request.args.get('probe'))
+    return Response(''.join(json.dumps(e, ensure_ascii=False) + '\n' for e in events),
+                    mimetype='application/x-ndjson',
+                    headers={'Content-Disposition': f'attachment; filename=log_{task_id[:8]}.jsonl'})
+
+
+@app.route('/metrics')
+def metrics():
+    """Prometheus 指标"""
+    return Response(generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+
+@app.route('/clusters')
+def list_clusters():
+    """存活集群数量及资源占用"""
+    return jsonify(cluster_stats())
+
+
 @app.route('/clean', methods=['POST'])
 def clean_env():
     """清理当前 session 创建的所有 tiup playground 进程和日志文件"""
@@ -898,11 +4182,10 @@ def clean_env():
 
         for proc_info in task['processes']:
             process = proc_info.get('process')
-            if process and process.poll() is None:
+            if process and process.returncode is None:
                 try:
                     pid = process.pid
-                    process.terminate()
-                    process.wait(timeout=30)
+                    stop_cluster(process)
                     cleaned_pids.append(pid)
                 except Exception as e:
                     errors.append(f"清理进程 PID {pid} 失败: {e}")
@@ -929,5 +4212,8 @@ def clean_env():
 if __name__ == '__main__':
     # 确保 worktree 基准目录存在
     os.makedirs(TIDB_WORKTREE_BASE, exist_ok=True)
+    # debug 模式下 Werkzeug reloader 的父进程只负责重启服务进程；在父进程里回收会用空的集群表覆盖磁盘上的登记表
+    if os.environ.get('WERKZEUG_RUN_MAIN') == 'true':
+        ensure_cluster_reaper()
     app.run(debug=True, host='0.0.0.0', port=5001)
 
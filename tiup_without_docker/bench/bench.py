@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+"""
+离线编排压测：用 fake_tiup / mysql_stub / fake_make 代替真实的 tiup playground、TiDB 和编译，
+在进程内通过 Flask test client 并发提交 /start_test 和 /start_locate，统计：
+  - 吞吐 (每秒完成的探测数)
+  - 调度延迟 (提交任务到探测真正开始的时间)
+  - tasks 字典的增长 (日志行数、结果数、trace span 数、序列化大小) 和进程 RSS
+  - /status 的响应时间
+
+不需要 tiup、Go、TiDB 源码或网络，所有临时文件都在一个临时目录中，结束后删除。
+
+用法 (在 tiup_without_docker 目录下)：
+  python bench/bench.py --tests 20 --versions-per-test 5 --locates 5
+  python bench/bench.py --tests 50 --versions-per-test 2 --startup-seconds 5 --json result.json
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+FAKE_VERSIONS = ['v7.5.0', 'v7.5.1', 'v7.5.2', 'v8.0.0', 'v8.1.0', 'v8.1.1', 'v8.1.2', 'v8.2.0', 'v8.3.0', 'v8.4.0',
+                 'v8.5.0', 'v8.5.1']
+LOCATE_BRANCH = 'release-8.5'
+FINISHED_STATUSES = ('complete', 'error', 'cancelled')
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    k = min(len(values) - 1, max(0, int(round(p / 100.0 * (len(values) - 1)))))
+    return values[k]
+
+
+def summarize(values, scale=1000.0):
+    """返回 p50/p95/p99/max (默认换算为毫秒)"""
+    if not values:
+        return {}
+    return {'count': len(values),
+            'p50': round(percentile(values, 50) * scale, 2),
+            'p95': round(percentile(values, 95) * scale, 2),
+            'p99': round(percentile(values, 99) * scale, 2),
+            'max': round(max(values) * scale, 2)}
+
+
+def rss_mb():
+    try:
+        with open('/proc/self/status', 'r') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return round(int(line.split()[1]) / 1024.0, 1)
+    except OSError:
+        pass
+    return None
+
+
+def git(args, cwd):
+    return subprocess.check_output(['git'] + args, cwd=cwd, text=True, stderr=subprocess.STDOUT).strip()
+
+
+def create_fake_repo(work_dir, commit_count):
+    """创建一个带 origin 的假 TiDB 仓库，LOCATE_BRANCH 上有 commit_count 个线性 commit"""
+    origin = os.path.join(work_dir, 'tidb-origin.git')
+    seed = os.path.join(work_dir, 'tidb-seed')
+    repo = os.path.join(work_dir, 'tidb')
+    git(['init', '-q', '--bare', origin], work_dir)
+    git(['init', '-q', seed], work_dir)
+    for key, value in (('user.name', 'bench'), ('user.email', 'bench@example.com')):
+        git(['config', key, value], seed)
+    with open(os.path.join(seed, '.gitignore'), 'w') as f:
+        f.write('bin/\n')
+    os.makedirs(os.path.join(seed, 'pkg', 'executor'))
+    for i in range(commit_count):
+        with open(os.path.join(seed, 'pkg', 'executor', f'file_{i % 8}.go'), 'a') as f:
+            f.write(f'// change {i}\n')
+        git(['add', '-A'], seed)
+        git(['commit', '-q', '-m', f'executor: change {i}'], seed)
+    git(['branch', '-M', LOCATE_BRANCH], seed)
+    git(['remote', 'add', 'origin', origin], seed)
+    git(['push', '-q', 'origin', LOCATE_BRANCH], seed)
+    git(['clone', '-q', '-b', LOCATE_BRANCH, origin, repo], work_dir)
+    shutil.rmtree(seed)
+    return repo, git(['rev-list', '--reverse', LOCATE_BRANCH], repo).split()
+
+
+def setup_environment(work_dir, args):
+    """准备假的 tiup / make / go / asdf，并通过环境变量配置它们的行为"""
+    bin_dir = os.path.join(work_dir, 'bin')
+    home = os.path.join(work_dir, 'home')
+    go_root = os.path.join(work_dir, 'go-root')
+    os.makedirs(bin_dir)
+    os.makedirs(os.path.join(home, '.asdf'))
+    os.makedirs(os.path.join(go_root, 'go', 'bin'))
+    for name, target in (('tiup', 'fake_tiup.py'), ('make', 'fake_make.py')):
+        os.symlink(os.path.join(BENCH_DIR, target), os.path.join(bin_dir, name))
+    with open(os.path.join(home, '.asdf', 'asdf.sh'), 'w') as f:
+        f.write(f'asdf() {{ echo "{go_root}"; }}\n')
+    go_path = os.path.join(go_root, 'go', 'bin', 'go')
+    with open(go_path, 'w') as f:
+        f.write('#!/bin/sh\necho "go version go1.23.0 linux/amd64 (fake)"\n')
+    os.chmod(go_path, 0o755)
+
+    os.environ.update({
+        'PATH': f"{bin_dir}:{os.environ.get('PATH', '')}",
+        'HOME': home,
+        'FAKE_TIUP_VERSIONS': ','.join(FAKE_VERSIONS),
+        'FAKE_TIUP_STARTUP_SECONDS': str(args.startup_seconds),
+        'FAKE_TIUP_FAIL_RATE': str(args.startup_fail_rate),
+        'FAKE_SQL_SECONDS': str(args.sql_seconds),
+        'FAKE_MAKE_SECONDS': str(args.make_seconds),
+    })
+
+
+def tasks_footprint(tasks):
+    """统计 tasks 字典的规模；序列化时跳过进程对象等无法 JSON 化的字段"""
+    skip = ('processes', 'commands', 'cancel_event')
+    footprint = {'tasks': len(tasks), 'log_lines': 0, 'results': 0, 'trace_spans': 0, 'json_bytes': 0}
+    for task in list(tasks.values()):
+        footprint['log_lines'] += len(task.get('log', []))
+        footprint['results'] += len(task.get('results', []))
+        footprint['trace_spans'] += len(task.get('trace', []))
+        serializable = {k: v for k, v in task.items() if k not in skip}
+        if 'log' in task:
+            serializable['log'] = task['log'].since(0)[0]  # 只统计仍在内存中的日志事件
+        footprint['json_bytes'] += len(json.dumps(serializable, default=str, ensure_ascii=False))
+    return footprint
+
+
+def submit_tests(client, args, submitted):
+    for _ in range(args.tests):
+        versions = random.sample(FAKE_VERSIONS, min(args.versions_per_test, len(FAKE_VERSIONS)))
+        bad_since = random.choice(FAKE_VERSIONS)
+        payload = {'versions': versions, 'sql': f'select 1 /* bad_since={bad_since} */',
+                   'expected_sql_result': 'good', 'other_check_script': '',
+                   'force_reprobe': not args.use_verdict_cache}
+        started = time.time()
+        resp = client.post('/start_test', json=payload)
+        submitted[resp.get_json()['task_id']] = {
+            'kind': 'test', 'submitted': started, 'post_seconds': time.time() - started,
+            'expected': {v: ('Failure' if FAKE_VERSIONS.index(v) >= FAKE_VERSIONS.index(bad_since) else 'Success')
+                         for v in versions}}
+
+
+def submit_locates(client, args, submitted, commits):
+    for _ in range(args.locates):
+        culprit = random.choice(commits[1:])
+        payload = {'locate_mode': 'commit', 'branch': LOCATE_BRANCH, 'start_commit': commits[0],
+                   'end_commit': commits[-1], 'sql': f'select 1 /* bad_since={culprit} */',
+                   'expected_sql_result': 'good', 'other_check_script': '',
+                   'force_reprobe': not args.use_verdict_cache}
+        started = time.time()
+        resp = client.post('/start_locate', json=payload)
+        submitted[resp.get_json()['task_id']] = {'kind': 'locate', 'submitted': started,
+                                                 'post_seconds': time.time() - started, 'expected': culprit}
+
+
+def wait_for_tasks(client, submitted, args):
+    """轮询 /status 直到所有任务结束，返回每次请求的耗时和期间的最大线程数"""
+    latencies, peak_threads = [], threading.active_count()
+    pending = set(submitted)
+    deadline = time.time() + args.timeout
+    while pending and time.time() < deadline:
+        for task_id in list(pending):
+            started = time.time()
+            resp = client.get(f'/status/{task_id}')
+            latencies.append(time.time() - started)
+            if resp.get_json().get('status') in FINISHED_STATUSES:
+                submitted[task_id]['finished'] = time.time()
+                pending.discard(task_id)
+        peak_threads = max(peak_threads, threading.active_count())
+        time.sleep(args.status_interval)
+    return latencies, pending, peak_threads
+
+
+def check_correctness(tasks, submitted):
+    wrong = []
+    for task_id, info in submitted.items():
+        task = tasks[task_id]
+        if info['kind'] == 'test':
+            for result in task['results']:
+                expected = info['expected'].get(result.get('version'))
+                if result.get('status') != expected:
+                    wrong.append({'task_id': task_id, 'version': result.get('version'),
+                                  'expected': expected, 'actual': result.get('status'), 'error': result.get('error')})
+        elif info['expected'] not in (task.get('final_result') or ''):
+            wrong.append({'task_id': task_id, 'expected': info['expected'],
+                          'actual': (task.get('final_result') or '')[:200], 'log_tail': task['log'][-3:]})
+    return wrong
+
+
+def run(args):
+    random.seed(args.seed)
+    original_cwd = os.getcwd()
+    work_dir = tempfile.mkdtemp(prefix='tiup_bench_')
+    try:
+        setup_environment(work_dir, args)
+        repo, commits = create_fake_repo(work_dir, args.commits) if args.locates else (None, [])
+        # app.py 的 cache/ 和 logs/ 都使用相对路径，放到临时目录中
+        os.chdir(work_dir)
+        sys.path.insert(0, APP_DIR)
+        import app as tester
+
+        if repo:
+            tester.TIDB_REPO_PATH = repo
+            os.environ['FAKE_TIDB_REPO'] = repo
+        tester.TIDB_WORKTREE_BASE = os.path.join(work_dir, 'worktrees')
+        tester.CLUSTER_READY_POLL_INTERVAL = args.ready_poll_interval
+        client = tester.app.test_client()
+
+        rss_before = rss_mb()
+        submitted = {}
+        started = time.time()
+        submit_tests(client, args, submitted)
+        if args.locates:
+            submit_locates(client, args, submitted, commits)
+        status_latencies, unfinished, peak_threads = wait_for_tasks(client, submitted, args)
+        wall_seconds = time.time() - started
+
+        # 调度延迟：提交任务到该任务第一个探测开始执行的时间 (/start_test 中每个版本单独计算)
+        schedule_latencies, probe_seconds, probes = [], [], 0
+        for task_id, info in submitted.items():
+            spans = [s for s in tester.tasks[task_id].get('trace', []) if s['name'] == 'probe']
+            probes += len(spans)
+            probe_seconds += [s['end'] - s['start'] for s in spans]
+            starts = sorted(s['start'] for s in spans)
+            if info['kind'] == 'test':
+                schedule_latencies += [s - info['submitted'] for s in starts]
+            elif starts:
+                schedule_latencies.append(starts[0] - info['submitted'])
+
+        footprint = tasks_footprint(tester.tasks)
+        report = {
+            'config': {k: v for k, v in vars(args).items() if k != 'json'},
+            'wall_seconds': round(wall_seconds, 2),
+            'tasks': len(submitted),
+            'unfinished_tasks': len(unfinished),
+            'probes': probes,
+            'probes_per_second': round(probes / wall_seconds, 3) if wall_seconds else None,
+            'probe_duration_ms': summarize(probe_seconds),
+            'schedule_latency_ms': summarize(schedule_latencies),
+            'submit_latency_ms': summarize([i['post_seconds'] for i in submitted.values()]),
+            'status_latency_ms': summarize(status_latencies),
+            'tasks_footprint': footprint,
+            'json_bytes_per_task': round(footprint['json_bytes'] / max(1, footprint['tasks'])),
+            'rss_mb': {'before': rss_before, 'after': rss_mb()},
+            'peak_threads': peak_threads,
+            'wrong_results': check_correctness(tester.tasks, submitted),
+        }
+
+        # /start_test 的集群默认保留给用户排查，压测结束时统一清理
+        for task in tester.tasks.values():
+            for p in task.get('processes', []):
+                tester.stop_cluster(p['process'], timeout=5)
+        return report
+    finally:
+        os.chdir(original_cwd)
+        if args.keep:
+            print(f'临时目录保留在: {work_dir}')
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def print_report(report):
+    print('\n===== 压测结果 =====')
+    print(f"任务数: {report['tasks']} (未完成 {report['unfinished_tasks']})，探测数: {report['probes']}，"
+          f"耗时 {report['wall_seconds']} 秒，吞吐 {report['probes_per_second']} 探测/秒")
+    for key, label in (('schedule_latency_ms', '调度延迟'), ('probe_duration_ms', '单次探测耗时'),
+                       ('submit_latency_ms', '提交请求耗时'), ('status_latency_ms', '/status 响应时间')):
+        stats = report[key]
+        if stats:
+            print(f"{label} (ms): p50={stats['p50']} p95={stats['p95']} p99={stats['p99']} max={stats['max']} "
+                  f"(n={stats['count']})")
+    footprint = report['tasks_footprint']
+    print(f"tasks: 日志 {footprint['log_lines']} 行，结果 {footprint['results']} 个，span {footprint['trace_spans']} 个，"
+          f"序列化 {footprint['json_bytes'] / 1024.0:.1f} KiB (每任务 {report['json_bytes_per_task']} 字节)")
+    print(f"RSS (MiB): {report['rss_mb']['before']} -> {report['rss_mb']['after']}，最大线程数: {report['peak_threads']}")
+    if report['wrong_results']:
+        print(f"⚠️ {len(report['wrong_results'])} 个结果与预期不符:")
+        for wrong in report['wrong_results'][:10]:
+            print(f"  {wrong}")
+    else:
+        print('✅ 所有结果与预期一致')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='离线编排压测 (fake tiup / MySQL stub / fake make)')
+    parser.add_argument('--tests', type=int, default=20, help='/start_test 任务数')
+    parser.add_argument('--versions-per-test', type=int, default=5, help='每个 /start_test 任务测试的版本数')
+    parser.add_argument('--locates', type=int, default=2, help='/start_locate (commit 模式) 任务数')
+    parser.add_argument('--commits', type=int, default=64, help='假仓库中的 commit 数')
+    parser.add_argument('--startup-seconds', type=float, default=2.0, help='假集群的启动耗时')
+    parser.add_argument('--startup-fail-rate', type=float, default=0.0, help='假集群启动失败的概率')
+    parser.add_argument('--sql-seconds', type=float, default=0.0, help='每条用户 SQL 的执行耗时')
+    parser.add_argument('--make-seconds', type=float, default=1.0, help='假编译耗时')
+    parser.add_argument('--ready-poll-interval', type=float, default=0.5, help='等待集群就绪的轮询间隔')
+    parser.add_argument('--status-interval', type=float, default=0.5, help='轮询 /status 的间隔')
+    parser.add_argument('--timeout', type=float, default=1800, help='整个压测的超时时间')
+    parser.add_argument('--use-verdict-cache', action='store_true', help='允许命中结果缓存 (默认强制重新探测)')
+    parser.add_argument('--seed', type=int, default=42)
+    parser.add_argument('--keep', action='store_true', help='保留临时目录')
+    parser.add_argument('--json', help='把结果写入 JSON 文件')
+    args = parser.parse_args()
+
+    report = run(args)
+    print_report(report)
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    return 1 if report['wrong_results'] or report['unfinished_tasks'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
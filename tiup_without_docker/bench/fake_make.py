@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+"""
+压测用的假 make：模拟编译耗时，把当前 commit 写入 bin/tidb-server，供 fake_tiup 的 tidb_version() 返回。
+
+环境变量：
+  FAKE_MAKE_SECONDS       编译耗时 (默认 3)
+  FAKE_MAKE_FAIL_COMMITS  编译失败的 commit 前缀 (逗号分隔)，用于模拟无法编译的 commit
+"""
+import os
+import subprocess
+import sys
+import time
+
+
+def main():
+    commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], text=True).strip()
+    print(f'CGO_ENABLED=1 go build -o bin/tidb-server ./cmd/tidb-server ({commit[:8]})', flush=True)
+    time.sleep(float(os.environ.get('FAKE_MAKE_SECONDS', '3')))
+    fail_commits = [c.strip() for c in os.environ.get('FAKE_MAKE_FAIL_COMMITS', '').split(',') if c.strip()]
+    if any(commit.startswith(c) for c in fail_commits):
+        print('pkg/executor/fake.go:1:1: undefined: fakeSymbol', flush=True)
+        return 2
+    os.makedirs('bin', exist_ok=True)
+    with open(os.path.join('bin', 'tidb-server'), 'w', encoding='utf-8') as f:
+        f.write(commit + '\n')
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
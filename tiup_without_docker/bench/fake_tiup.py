@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+压测用的假 tiup，只支持 app.py 用到的子命令：
+  tiup update --self
+  tiup list tidb
+  tiup playground [--db.binpath=...] [--tag=...] <version> --port-offset=N ...
+
+playground 模拟启动耗时后在 4000+N 端口上启动 mysql_stub，直到收到 SIGTERM。
+指定 --tag 时数据目录为 $TIUP_HOME/data/<tag>，退出后保留。INSERT / LOAD DATA LOCAL INFILE 在其中写入一个
+SST 文件 (每行数据一行)，SELECT loaded_rows() 返回已写入的总行数，用于验证数据快照和 fixture 导入。
+SQL 中带有 /* log=<text> */ 标记时把 text 追加到 tidb.log，用于验证日志检查。
+SQL 中带有 /* bad_since=<version 或 commit> */ 标记时，晚于 (包含) 该版本 / commit 的集群返回 'bad'，
+否则返回 'good'，这样 bench.py 可以构造出确定的二分查找场景。再带上 /* flaky=<p> */ 时有问题的集群只以概率 p
+返回 'bad'，用于模拟偶发问题。
+
+环境变量：
+  FAKE_TIUP_VERSIONS         tiup list tidb 返回的版本列表 (逗号分隔)
+  FAKE_TIUP_STARTUP_SECONDS  集群启动耗时 (默认 2)
+  FAKE_TIUP_STARTUP_JITTER   启动耗时的随机抖动比例 (默认 0.2)
+  FAKE_TIUP_FAIL_RATE        启动失败的概率 (默认 0)
+  FAKE_SQL_SECONDS           每条用户 SQL 的执行耗时 (默认 0)
+  FAKE_TIDB_REPO             判断 commit 先后关系时使用的 git 仓库
+"""
+import os
+import random
+import re
+import shutil
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import mysql_stub  # noqa: E402
+
+DEFAULT_VERSIONS = 'v7.5.0,v7.5.1,v7.5.2,v8.0.0,v8.1.0,v8.1.1,v8.1.2,v8.2.0,v8.3.0,v8.4.0,v8.5.0,v8.5.1'
+BAD_SINCE_RE = re.compile(r'bad_since=([0-9A-Za-z.\-]+)')
+LOG_MARKER_RE = re.compile(r'/\* log=(.*?) \*/')
+FLAKY_RE = re.compile(r'/\* flaky=([0-9.]+) \*/')
+LOAD_DATA_RE = re.compile(r"load data local infile '([^']+)'.*?ignore (\d+) lines", re.IGNORECASE | re.DOTALL)
+OK_PREFIXES = ('set', 'use', 'kill', 'commit', 'rollback', 'begin', 'create', 'insert', 'drop', 'analyze')
+
+
+def version_tuple(version):
+    return tuple(int(p) if p.isdigit() else 0 for p in version.lstrip('v').split('-')[0].split('.'))
+
+
+def is_ancestor(repo, ancestor, commit):
+    return subprocess.run(['git', '-C', repo, 'merge-base', '--is-ancestor', ancestor, commit],
+                          stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL).returncode == 0
+
+
+def is_bad(marker, version, commit):
+    if marker.startswith('v'):
+        return version_tuple(version) >= version_tuple(marker)
+    if not commit:
+        return False
+    repo = os.environ.get('FAKE_TIDB_REPO')
+    if repo:
+        return is_ancestor(repo, marker, commit)
+    return commit.startswith(marker)
+
+
+def list_tidb():
+    print('Available versions for tidb:')
+    print('Version  Installed  Release                    Platforms')
+    print('-------  ---------  -------                    ---------')
+    for version in os.environ.get('FAKE_TIUP_VERSIONS', DEFAULT_VERSIONS).split(','):
+        print(f'{version.strip()}             2024-01-01T00:00:00+08:00  linux/amd64')
+
+
+def parse_playground_args(args):
+    options = {'version': None, 'port_offset': 0, 'binpath': None, 'tag': None}
+    value_flags = {'--kv', '--tiflash', '--pd', '--db', '--tag'}
+    i = 0
+    while i < len(args):
+        arg = args[i]
+        if arg.startswith('--port-offset='):
+            options['port_offset'] = int(arg.split('=', 1)[1])
+        elif arg.startswith('--db.binpath='):
+            options['binpath'] = arg.split('=', 1)[1]
+        elif arg.startswith('--tag='):
+            options['tag'] = arg.split('=', 1)[1]
+        elif arg in value_flags:
+            i += 1
+        elif not arg.startswith('-') and options['version'] is None:
+            options['version'] = arg
+        i += 1
+    return options
+
+
+def playground(args):
+    options = parse_playground_args(args)
+    version = options['version'] or 'nightly'
+    port = 4000 + options['port_offset']
+    # fake make 生成的 "二进制" 内容就是编译时的 commit
+    commit = ''
+    if options['binpath']:
+        with open(options['binpath'], 'r', encoding='utf-8') as f:
+            commit = f.read().strip()
+
+    startup = float(os.environ.get('FAKE_TIUP_STARTUP_SECONDS', '2'))
+    jitter = float(os.environ.get('FAKE_TIUP_STARTUP_JITTER', '0.2'))
+    print(f'Start pd, tikv, tidb for {version} (port {port})', flush=True)
+    time.sleep(max(0.0, startup * random.uniform(1 - jitter, 1 + jitter)))
+    if random.random() < float(os.environ.get('FAKE_TIUP_FAIL_RATE', '0')):
+        print('Error: fake playground failed to start: connection refused', flush=True)
+        sys.exit(1)
+
+    if options['tag']:
+        tiup_home = os.environ.get('TIUP_HOME') or os.path.join(os.path.expanduser('~'), '.tiup')
+        data_dir = os.path.join(tiup_home, 'data', options['tag'])
+    else:
+        data_dir = tempfile.mkdtemp(prefix='fake_playground_')
+    log_path = os.path.join(data_dir, 'tidb-0', 'tidb.log')
+    sst_dir = os.path.join(data_dir, 'tikv-0', 'db')
+    os.makedirs(os.path.dirname(log_path), exist_ok=True)
+    os.makedirs(sst_dir, exist_ok=True)
+    with open(log_path, 'w', encoding='utf-8') as f:
+        f.write(f'[INFO] ["Welcome to TiDB."] [version={version}] [commit={commit}]\n')
+    sql_seconds = float(os.environ.get('FAKE_SQL_SECONDS', '0'))
+
+    def write_sst(rows):
+        with tempfile.NamedTemporaryFile('w', dir=sst_dir, suffix='.sst', delete=False) as f:
+            f.write(rows)
+        return rows.count('\n')
+
+    def answer(query):
+        q = query.strip().lower()
+        if 'tidb_version()' in q:
+            return ['tidb_version()'], [[f'Release Version: {version}\nGit Commit Hash: {commit or "fake"}']]
+        if q.startswith('show config'):
+            return ['Type', 'Instance', 'Name', 'Value'], [['tidb', f'127.0.0.1:{port}', 'log.file.filename', log_path]]
+        if q.startswith('select loaded_rows()'):
+            rows = 0
+            for name in os.listdir(sst_dir):
+                with open(os.path.join(sst_dir, name), 'rb') as f:
+                    rows += f.read().count(b'\n')
+            return ['loaded_rows()'], [[str(rows)]]
+        if q.startswith('insert'):
+            write_sst(''.join(f'{row}\n' for row in query.split('),(')))
+            return None
+        load = LOAD_DATA_RE.search(query)
+        if load:
+            return mysql_stub.LocalInfile(
+                load.group(1), lambda data: write_sst(b''.join(data.splitlines(True)[int(load.group(2)):]).decode()))
+        if q.startswith(OK_PREFIXES):
+            return None
+        for text in LOG_MARKER_RE.findall(query):
+            with open(log_path, 'a', encoding='utf-8') as f:
+                f.write(f'[ERROR] {text}\n')
+        if sql_seconds:
+            time.sleep(sql_seconds)
+        match = BAD_SINCE_RE.search(query)
+        bad = bool(match) and is_bad(match.group(1), version, commit)
+        flaky = FLAKY_RE.search(query)
+        if bad and flaky:
+            bad = random.random() < float(flaky.group(1))
+        return ['result'], [['bad' if bad else 'good']]
+
+    def shutdown(signum, frame):
+        print('Playground receive signal: terminated', flush=True)
+        if not options['tag']:
+            shutil.rmtree(data_dir, ignore_errors=True)
+        os._exit(0)
+
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+    print(f'TiDB Playground Cluster is started, connect with: mysql --host 127.0.0.1 --port {port} -u root',
+          flush=True)
+    mysql_stub.serve_forever(port, answer, server_version=f'8.0.11-TiDB-{version}')
+
+
+def main(args):
+    if args[:2] == ['update', '--self']:
+        return 0
+    if args[:2] == ['list', 'tidb']:
+        list_tidb()
+        return 0
+    if args and args[0] == 'playground':
+        playground(args[1:])
+        return 0
+    print(f'fake tiup: unsupported command: {" ".join(args)}', file=sys.stderr)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
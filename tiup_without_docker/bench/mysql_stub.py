@@ -0,0 +1,173 @@
+"""
+一个极简的 MySQL 协议服务端，只实现压测所需的部分：握手 (不校验密码)、COM_QUERY、COM_PING、COM_QUIT。
+查询结果由调用方提供的 answer(query) 决定，返回 None 表示 OK 包，返回 (columns, rows) 表示结果集，
+返回 LocalInfile 表示向客户端请求 LOAD DATA LOCAL INFILE 的文件内容，抛出 StubError 表示 ERR 包。
+"""
+import os
+import socket
+import struct
+import threading
+
+CAPABILITIES = (
+    0x00000001 |  # CLIENT_LONG_PASSWORD
+    0x00000004 |  # CLIENT_LONG_FLAG
+    0x00000008 |  # CLIENT_CONNECT_WITH_DB
+    0x00000080 |  # CLIENT_LOCAL_FILES
+    0x00000200 |  # CLIENT_PROTOCOL_41
+    0x00002000 |  # CLIENT_TRANSACTIONS
+    0x00008000 |  # CLIENT_SECURE_CONNECTION
+    0x00010000 |  # CLIENT_MULTI_STATEMENTS
+    0x00020000 |  # CLIENT_MULTI_RESULTS
+    0x00080000 |  # CLIENT_PLUGIN_AUTH
+    0x00100000 |  # CLIENT_CONNECT_ATTRS
+    0x00200000    # CLIENT_PLUGIN_AUTH_LENENC_CLIENT_DATA
+)
+CHARSET_UTF8MB4 = 45
+STATUS_AUTOCOMMIT = 0x0002
+TYPE_VAR_STRING = 0xfd
+
+
+class StubError(Exception):
+    def __init__(self, code, message):
+        super().__init__(message)
+        self.code = code
+        self.message = message
+
+
+class LocalInfile:
+    """请求客户端发送文件内容；on_data(bytes) 返回影响的行数"""
+
+    def __init__(self, filename, on_data):
+        self.filename = filename
+        self.on_data = on_data
+
+
+def _lenenc_int(n):
+    if n < 251:
+        return bytes([n])
+    if n < 2 ** 16:
+        return b'\xfc' + struct.pack('<H', n)
+    if n < 2 ** 24:
+        return b'\xfd' + struct.pack('<I', n)[:3]
+    return b'\xfe' + struct.pack('<Q', n)
+
+
+def _lenenc_str(value):
+    data = value if isinstance(value, bytes) else str(value).encode('utf-8')
+    return _lenenc_int(len(data)) + data
+
+
+class _Connection:
+    def __init__(self, sock, connection_id, server_version, answer):
+        self.sock = sock
+        self.connection_id = connection_id
+        self.server_version = server_version
+        self.answer = answer
+        self.seq = 0
+
+    def _recv_exact(self, n):
+        buf = b''
+        while len(buf) < n:
+            chunk = self.sock.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError('client closed')
+            buf += chunk
+        return buf
+
+    def read_packet(self):
+        header = self._recv_exact(4)
+        length = header[0] | (header[1] << 8) | (header[2] << 16)
+        self.seq = (header[3] + 1) & 0xff
+        return self._recv_exact(length)
+
+    def write_packet(self, payload):
+        self.sock.sendall(struct.pack('<I', len(payload))[:3] + bytes([self.seq]) + payload)
+        self.seq = (self.seq + 1) & 0xff
+
+    def ok(self, affected_rows=0):
+        self.write_packet(b'\x00' + _lenenc_int(affected_rows) + _lenenc_int(0) +
+                          struct.pack('<HH', STATUS_AUTOCOMMIT, 0))
+
+    def eof(self):
+        self.write_packet(b'\xfe' + struct.pack('<HH', 0, STATUS_AUTOCOMMIT))
+
+    def err(self, code, message):
+        self.write_packet(b'\xff' + struct.pack('<H', code) + b'#HY000' + message.encode('utf-8'))
+
+    def result_set(self, columns, rows):
+        self.write_packet(_lenenc_int(len(columns)))
+        for name in columns:
+            self.write_packet(
+                _lenenc_str('def') + _lenenc_str('') + _lenenc_str('') + _lenenc_str('') +
+                _lenenc_str(name) + _lenenc_str(name) + b'\x0c' +
+                struct.pack('<HIBHB', CHARSET_UTF8MB4, 1024, TYPE_VAR_STRING, 0, 0) + b'\x00\x00')
+        self.eof()
+        for row in rows:
+            self.write_packet(b''.join(b'\xfb' if v is None else _lenenc_str(v) for v in row))
+        self.eof()
+
+    def handshake(self):
+        salt = os.urandom(20).replace(b'\x00', b'\x01')
+        payload = (b'\x0a' + self.server_version.encode('utf-8') + b'\x00' +
+                   struct.pack('<I', self.connection_id) + salt[:8] + b'\x00' +
+                   struct.pack('<HBHH', CAPABILITIES & 0xffff, CHARSET_UTF8MB4, STATUS_AUTOCOMMIT,
+                               CAPABILITIES >> 16) +
+                   bytes([21]) + b'\x00' * 10 + salt[8:] + b'\x00' + b'mysql_native_password\x00')
+        self.write_packet(payload)
+        self.read_packet()  # 握手响应，不校验
+        self.ok()
+
+    def serve(self):
+        self.handshake()
+        while True:
+            packet = self.read_packet()
+            command = packet[0]
+            if command == 0x01:  # COM_QUIT
+                return
+            if command != 0x03:  # COM_PING / COM_INIT_DB 等一律返回 OK
+                self.ok()
+                continue
+            query = packet[1:].decode('utf-8', errors='replace')
+            try:
+                result = self.answer(query)
+            except StubError as e:
+                self.err(e.code, e.message)
+                continue
+            if result is None:
+                self.ok()
+            elif isinstance(result, LocalInfile):
+                self.write_packet(b'\xfb' + result.filename.encode('utf-8'))
+                data = b''
+                while True:
+                    chunk = self.read_packet()
+                    if not chunk:
+                        break
+                    data += chunk
+                self.ok(result.on_data(data))
+            else:
+                self.result_set(*result)
+
+
+def serve_forever(port, answer, server_version='8.0.11-TiDB-stub', host='127.0.0.1'):
+    """在 host:port 上监听，每个连接一个线程"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(128)
+    next_id = [0]
+    lock = threading.Lock()
+
+    def handle(sock, connection_id):
+        try:
+            _Connection(sock, connection_id, server_version, answer).serve()
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            sock.close()
+
+    while True:
+        sock, _ = listener.accept()
+        with lock:
+            next_id[0] += 1
+            connection_id = next_id[0]
+        threading.Thread(target=handle, args=(sock, connection_id), daemon=True).start()